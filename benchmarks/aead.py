@@ -0,0 +1,46 @@
+"""Compare Fernet Encrypted messages with Sealed ones: bytes on the wire and
+messages per second, from the message to the frame body and back.
+
+    python -m benchmarks.aead
+"""
+from timeit import Timer
+
+from pychat.client import diffiehellman as dh
+from pychat.common.codec import BINARY
+from pychat.common.sealed import seal
+from pychat.common import models
+from pychat.common import request as req
+
+NUMBER = 2000
+TEXT_SIZES = (30, 300, 3000)
+
+
+def main():
+    secret = dh.secret_key()
+    fernet, aead = dh.create_fernet(secret), dh.create_aead(secret)
+    user = models.User(name='alice', uid='a1b2c3d4e5')
+
+    envelopes = {
+        'fernet': (lambda msg: msg.encrypt(fernet, 'R0omUid123', 1),
+                   lambda enc: enc.decrypt(fernet)),
+        'sealed': (lambda msg: seal(msg, aead, 'R0omUid123', 1),
+                   lambda enc: enc.decrypt(aead)),
+    }
+
+    print(f"{'text':>6}  {'envelope':<10}{'bytes':>8}{'send/s':>12}{'receive/s':>12}")
+    for size in TEXT_SIZES:
+        msg = models.ChatMessage(user=user, text='x' * size, room_uid='R0omUid123')
+        for name, (encrypt, decrypt) in envelopes.items():
+            send = lambda: BINARY.encode(req.PostMessage(message=encrypt(msg)))
+            body = send()
+            receive = lambda: decrypt(BINARY.decode(body).message)
+            assert receive() == msg
+
+            send_time = Timer(send).timeit(NUMBER)
+            receive_time = Timer(receive).timeit(NUMBER)
+            print(f"{size:>6}  {name:<10}{len(body):>8}"
+                  f"{NUMBER / send_time:>12.0f}{NUMBER / receive_time:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Compare messages/sec broadcast to rooms of growing size by writing to each
+member (encoding the message per member) and with stream.broadcast (encoding
+it once).
+
+    python -m benchmarks.broadcast
+"""
+import asyncio
+import time
+
+from pychat.common.codec import BINARY
+from pychat.common.stream import DataStream, broadcast
+from benchmarks.samples import sample_frames
+
+ROOM_SIZES = (1, 10, 100, 1000)
+MESSAGES = 20000  # members reached per run, split over the messages
+
+
+class NullWriter:
+    """StreamWriter stand-in that discards frames"""
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def writelines(self, frames):
+        pass
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+
+async def per_member(streams, message):
+    await asyncio.gather(*[s.write(message) for s in streams], return_exceptions=True)
+
+
+async def run(send, streams, message, n: int) -> float:
+    start = time.perf_counter()
+    for _ in range(n):
+        await send(streams, message)
+        await asyncio.sleep(0)  # let the writer tasks drain
+    return n / (time.perf_counter() - start)
+
+
+async def main():
+    message = sample_frames()['PostMessage(Encrypted)']
+    print(f"{'members':>8}{'per member msg/s':>18}{'broadcast msg/s':>17}{'speedup':>9}")
+
+    for size in ROOM_SIZES:
+        streams = [DataStream(None, NullWriter(), BINARY) for _ in range(size)]
+        for s in streams:
+            s.type_ids = True
+        n = max(MESSAGES // size, 10)
+
+        before = await run(per_member, streams, message, n)
+        after = await run(broadcast, streams, message, n)
+        print(f"{size:>8}{before:>18.0f}{after:>17.0f}{after / before:>8.1f}x")
+
+        for s in streams:
+            s._writer_task.cancel()
+        await asyncio.gather(*[s._writer_task for s in streams], return_exceptions=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,29 @@
+"""Compare bytes-per-frame and frames-per-second of each codec.
+
+    python -m benchmarks.codec
+"""
+from timeit import Timer
+
+from pychat.common.codec import CODECS
+from benchmarks.samples import sample_frames
+
+NUMBER = 2000
+
+
+def main():
+    print(f"{'frame':<26}{'codec':<8}{'bytes':>8}{'encode/s':>12}{'decode/s':>12}")
+
+    for name, frame in sample_frames().items():
+        for codec in CODECS.values():
+            body = codec.encode(frame)
+            assert codec.decode(body) == frame
+
+            encode = Timer(lambda: codec.encode(frame)).timeit(NUMBER)
+            decode = Timer(lambda: codec.decode(body)).timeit(NUMBER)
+
+            print(f"{name:<26}{codec.name:<8}{len(body):>8}"
+                  f"{NUMBER / encode:>12.0f}{NUMBER / decode:>12.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""Compare compression ratio and cost per frame for each codec and compressor.
+
+    python -m benchmarks.compression
+"""
+from timeit import Timer
+
+from pychat.common.codec import CODECS
+from pychat.common.compression import COMPRESSORS, CompressionStats, decompress
+from benchmarks.samples import sample_frames
+
+NUMBER = 2000
+
+
+def main():
+    print(f"{'frame':<26}{'codec':<8}{'compressor':<11}{'bytes':>7}{'sent':>7}"
+          f"{'us/compress':>13}{'us/decompress':>15}")
+
+    for name, frame in sample_frames().items():
+        for codec in CODECS.values():
+            body = codec.encode(frame)
+            for compressor in COMPRESSORS.values():
+                stats = CompressionStats()
+                sent, flags = compressor.compress(body, stats)
+                assert decompress(sent, flags) == body if flags else sent == body
+
+                t_compress = Timer(lambda: compressor.compress(body, stats)).timeit(NUMBER)
+                t_decompress = Timer(lambda: decompress(sent, flags)).timeit(NUMBER) if flags else 0
+
+                print(f"{name:<26}{codec.name:<8}{compressor.name:<11}{len(body):>7}"
+                      f"{len(sent):>7}{t_compress / NUMBER * 1e6:>13.1f}"
+                      f"{t_decompress / NUMBER * 1e6:>15.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Measure how long the client's event loop is held up by a burst of
+incoming encrypted messages (a busy room, or a page of history), decrypting
+each one in the handler like before and through the DecryptionPipeline.
+The pipeline holds the loop up for about a GIL switch interval however big
+the burst is, at the cost of some throughput.
+
+    python -m benchmarks.decryption
+"""
+import asyncio
+
+from pychat.client import diffiehellman as dh
+from pychat.client.decryption import DecryptionPipeline
+from pychat.client.rooms import ChatRoom
+from pychat.common import models
+from benchmarks.dh_offload import max_lag
+
+BURSTS = (100, 1000, 5000)
+
+
+def make_burst(room: ChatRoom, size: int) -> list:
+    user = models.User(name='alice', uid='a1b2c3d4e5')
+    return [
+        room.encrypt(models.ChatMessage(user=user, text=f'message {i}' * 5, room_uid=room.uid))
+        for i in range(size)
+    ]
+
+
+async def main():
+    room = ChatRoom('room', 'R0omUid123')
+    room.use_key(dh.secret_key(), epoch=1, seal=True)
+
+    print(f"{'burst':>6}{'decrypt':>10}{'max loop lag ms':>17}{'total ms':>10}")
+    for size in BURSTS:
+        burst = make_burst(room, size)
+
+        async def inline():
+            for msg in burst:
+                msg.decrypt(room.aead_for(msg))
+                # frames already buffered are handled without yielding
+
+        pipeline = DecryptionPipeline({room.uid: room}, lambda m: None)
+
+        async def pipelined():
+            for msg in burst:
+                pipeline.submit(msg)
+            await pipeline.drain()
+
+        for name, work in (('inline', inline), ('pipeline', pipelined)):
+            lag, elapsed = await max_lag(work)
+            print(f"{size:>6}{name:>10}{lag * 1000:>17.1f}{elapsed * 1000:>10.1f}")
+        print(f"{'':>6}{pipeline.stats}")
+        pipeline.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,78 @@
+"""Measure how long the client's event loop is held up while it does the
+math of a key exchange, with the math on the loop and in the executor, and
+how long a room takes to answer RegenerateDHKeyPair with and without the
+pool of pre-generated keypairs.
+
+    python -m benchmarks.dh_offload
+"""
+import asyncio
+import statistics
+import time
+
+from pychat.client import diffiehellman as dh
+
+MIXES = 32  # GetDHMixedKey hops a member answers in a ring exchange of 33
+TICK = 0.001  # seconds between loop lag samples
+REGENERATIONS = 20
+
+
+async def max_lag(work) -> tuple[float, float]:
+    """Run `work` while sampling how late a 1 ms timer fires. Returns the
+    worst lag and how long the work took"""
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - start - TICK)
+
+    task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await work()
+    elapsed = time.perf_counter() - start
+    done.set()
+    await task
+    return max(lags, default=elapsed), elapsed
+
+
+async def mixes():
+    secret, public = dh.keypair()
+    for _ in range(MIXES):
+        public = await dh.run(dh.mix_keys, secret, public)
+
+
+async def regenerate(pool: dh.KeyPool | None) -> float:
+    """Median time to get a new keypair"""
+    times = []
+    for _ in range(REGENERATIONS):
+        if pool is not None:
+            await asyncio.sleep(0.05)  # time between exchanges to refill
+        start = time.perf_counter()
+        if pool is not None:
+            await pool.take()
+        else:
+            await dh.run(dh.keypair)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+async def main():
+    await dh.run(dh.keypair)  # start the worker processes
+
+    print(f"{'math':>10}{'max loop lag ms':>17}{'total ms':>10}")
+    for name, executor in (('on loop', None), ('executor', dh.executor())):
+        dh.set_executor(executor)
+        lag, elapsed = await max_lag(mixes)
+        print(f"{name:>10}{lag * 1000:>17.1f}{elapsed * 1000:>10.1f}")
+
+    pool = dh.KeyPool()
+    pool.fill()
+    await asyncio.sleep(0.5)
+    without, with_pool = await regenerate(None), await regenerate(pool)
+    print(f"\nnew keypair: {without * 1000:.2f} ms, from the pool: {with_pool * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
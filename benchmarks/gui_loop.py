@@ -0,0 +1,66 @@
+"""Measure the client GUI's CPU use while idle, and how long input takes to
+reach the screen, with the Tk loop polled like before (update() on every
+loop iteration) and with the idle-aware polling. Needs a display, e.g. run
+it under xvfb-run.
+
+    python -m benchmarks.gui_loop
+"""
+import asyncio
+import random
+import statistics
+import time
+
+from pychat.client.gui.root import GUIRoot
+
+IDLE_SECONDS = 3
+INPUTS = 100
+
+
+class BusyGUIRoot(GUIRoot):
+    """The old integration, for comparison"""
+    def _mainloop(self):
+        self.update()
+        self._poll_handle = self.loop.call_soon(self._mainloop)
+
+
+async def idle_cpu(root: GUIRoot) -> float:
+    """CPU seconds used per second while nothing happens"""
+    await asyncio.sleep(0.5)
+    cpu, wall = time.process_time(), time.perf_counter()
+    await asyncio.sleep(IDLE_SECONDS)
+    return (time.process_time() - cpu) / (time.perf_counter() - wall)
+
+
+async def input_latency(root: GUIRoot) -> list[float]:
+    """Seconds from an input event being queued to the redraw after its
+    handler, with the inputs arriving at random times"""
+    latencies = []
+    sent = 0.0
+
+    def on_input(_):
+        root.after_idle(lambda: latencies.append(time.perf_counter() - sent))
+    root.bind('<<Input>>', on_input)
+
+    for i in range(INPUTS):
+        await asyncio.sleep(random.uniform(0.01, 0.1))
+        sent = time.perf_counter()
+        root.event_generate('<<Input>>', when='tail')
+        while len(latencies) <= i:
+            await asyncio.sleep(0)
+    return latencies
+
+
+async def main():
+    print(f"{'loop':<8}{'idle cpu %':>12}{'p50 input ms':>14}{'p99 input ms':>14}")
+    for name, root_type in (('busy', BusyGUIRoot), ('idle', GUIRoot)):
+        root = root_type()
+        cpu = await idle_cpu(root)
+        latencies = sorted(await input_latency(root))
+        p50 = statistics.median(latencies)
+        p99 = latencies[int(len(latencies) * 0.99) - 1]
+        print(f"{name:<8}{cpu * 100:>12.1f}{p50 * 1000:>14.2f}{p99 * 1000:>14.2f}")
+        root.destroy()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
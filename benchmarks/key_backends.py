@@ -0,0 +1,68 @@
+"""Compare the finite field and X25519 key backends: how long a member
+joining a room takes to agree on a key, and how many bytes of key requests
+and responses the server sends and receives for it (binary codec).
+
+    python -m benchmarks.key_backends
+"""
+import asyncio
+import time
+
+from pychat.client import diffiehellman as dh
+from pychat.common.codec import BINARY
+from pychat.common.envelope import encode_frame
+from pychat.server.diffiehellman import TreeKeyAgreement, dh_Key_exchange
+from benchmarks.rekey import Loopback, seed_tree
+
+TREE_SIZES = (8, 64, 256)
+RING_SIZES = (4, 16)
+BACKENDS = ('ffdh', 'x25519')
+
+
+class CountingLoopback(Loopback):
+    """Loopback that adds up the size of the frames that would be sent"""
+    sent = 0
+
+    async def write(self, r):
+        resp = await super().write(r)
+        CountingLoopback.sent += len(encode_frame(r, BINARY))
+        if resp is not None:
+            CountingLoopback.sent += len(encode_frame(resp, BINARY))
+        return resp
+
+
+async def tree_join(size: int, key_backend: str) -> tuple[float, int]:
+    agreement = TreeKeyAgreement('room', debounce=0)
+    streams = [CountingLoopback(key_backend) for _ in range(size)]
+    seed_tree(agreement, streams[:-1])
+
+    CountingLoopback.sent = 0
+    start = time.perf_counter()
+    agreement.join(streams[-1], streams[-1])
+    await agreement.settled()
+    return time.perf_counter() - start, CountingLoopback.sent
+
+
+async def ring_join(size: int, key_backend: str) -> tuple[float, int]:
+    streams = [CountingLoopback(key_backend) for _ in range(size)]
+
+    CountingLoopback.sent = 0
+    start = time.perf_counter()
+    await dh_Key_exchange('room', streams, epoch=1)
+    return time.perf_counter() - start, CountingLoopback.sent
+
+
+async def main():
+    # on the loop, the executor's overhead would hide the difference
+    dh.set_executor(None)
+    print(f"{'exchange':>10}{'members':>9}"
+          + ''.join(f"{name + ' ms':>12}{'bytes':>9}" for name in BACKENDS) + f"{'speedup':>9}")
+
+    for exchange, sizes, join in (('tree', TREE_SIZES, tree_join), ('ring', RING_SIZES, ring_join)):
+        for size in sizes:
+            results = [await join(size, name) for name in BACKENDS]
+            cols = ''.join(f"{t * 1000:>12.1f}{sent:>9}" for t, sent in results)
+            print(f"{exchange:>10}{size:>9}{cols}{results[0][0] / results[1][0]:>8.1f}x")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,348 @@
+"""Drive a PychatServer with simulated clients, for capacity planning.
+
+Each simulated client is a real DataStream and ChatRooms without the GUI.
+Clients are put in rooms of `--room-size`: one creates the room, the others
+join with its invite code, and the real key exchange runs. Once every room
+has a key, each client posts encrypted messages at `--rate` per second for
+`--duration` seconds. Rooms that got no key in time don't post, and are
+reported as unkeyed. Every combination of `--clients` and `--room-size`
+is a run against a fresh server on localhost, started in its own
+process(es) so it doesn't share a core with the clients. With --processes,
+the rooms are split over several client processes.
+
+Reported per run: messages delivered per second, p50/p99 delivery latency
+(post to decrypted at each other member), and how long rooms took to have
+a key, as a table and, with --json, one JSON object per line.
+
+    python -m benchmarks.loadgen --clients 100,500 --room-size 2,10 --json results.jsonl
+"""
+import argparse
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import time
+
+from pychat.client import diffiehellman, events
+from pychat.client.client import MAX_CONCURRENT_REQUESTS
+from pychat.client.rooms import ChatRooms
+from pychat.common import models
+from pychat.common import request as req
+from pychat.common.stream import DataStream
+from pychat.server.server import PychatServer
+from pychat.server.workers import run_workers
+
+HOST = '127.0.0.1'
+PORT = 8940
+CONNECT_CONCURRENCY = 100  # connections being set up at once
+KEY_TIMEOUT = 120  # seconds for every room to have a key
+STARTUP_TIMEOUT = 30  # seconds for the server to start accepting
+DRAIN_SECONDS = 2  # to wait for messages still on their way after the last post
+
+
+def _serve(port: int, workers: int):
+    # without a line per closed connection, from the workers too
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    if workers > 1:
+        run_workers(workers, HOST, port, remote_stats=True)
+    else:
+        asyncio.run(PychatServer(host=HOST, port=port, remote_stats=True).run())
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Client:
+    """A simulated client. Messages it decrypts are timed instead of being
+    published to the GUI"""
+    def __init__(self, n: int, run: 'Run'):
+        self.n = n
+        self.run = run
+        self.rooms: ChatRooms | None = None
+        self.room_uid: str | None = None
+
+    async def connect(self, port: int):
+        stream = DataStream(*await asyncio.open_connection(HOST, port),
+                            max_concurrent_requests=MAX_CONCURRENT_REQUESTS)
+        self.rooms = ChatRooms(stream)
+        self.rooms.decryption.deliver = self.on_message
+        self._listening = asyncio.create_task(stream.listen())
+        await stream.handshake()
+
+    async def create_room(self, key_backend: str) -> str:
+        resp: req.CreateRoom.Response = await self.rooms.stream.write(
+            req.CreateRoom(room_name=f'load{self.n}', key_backend=key_backend),
+            on_response=lambda resp: self.rooms.add_room(resp.room)
+        )
+        self.room_uid = resp.room.uid
+        return resp.invite_code
+
+    async def join_room(self, invite_code: str):
+        resp: req.JoinRoom.Response = await self.rooms.stream.write(
+            req.JoinRoom(invite_code=invite_code),
+            on_response=lambda resp: resp.room and self.rooms.add_room(resp.room)
+        )
+        if resp.error is not None:
+            raise RuntimeError(f'client{self.n} could not join: {resp.error}')
+        self.room_uid = resp.room.uid
+
+    @property
+    def room(self):
+        return self.rooms.rooms[self.room_uid]
+
+    async def post(self, rate: float, duration: float):
+        user = models.User(name=f'client{self.n}', uid=str(self.n))
+        interval = 1 / rate
+        # spread the clients' posts over the interval
+        await asyncio.sleep(interval * (self.n % 100) / 100)
+        end = time.perf_counter() + duration
+        while (now := time.perf_counter()) < end:
+            msg = models.ChatMessage(user=user, text=f'{self.n} {now}', room_uid=self.room_uid)
+            await self.rooms.on_send_message(events.SendMessage(message=msg))
+            self.run.sent += 1
+            await asyncio.sleep(max(0.0, now + interval - time.perf_counter()))
+
+    def on_message(self, msg: models.ChatMessage):
+        sender, _, sent = msg.text.partition(' ')
+        if sender == str(self.n) or not sent:
+            return  # its own message coming back, or not a load message
+        self.run.latencies.append(time.perf_counter() - float(sent))
+
+    async def close(self):
+        self._listening.cancel()
+        self.rooms.decryption.close()
+        await self.rooms.stream.close_connection()
+
+
+class Run:
+    def __init__(self, clients: int, room_size: int, rate: float, duration: float,
+                 key_backend: str):
+        self.clients = clients
+        self.room_size = room_size
+        self.rate = rate
+        self.duration = duration
+        self.key_backend = key_backend
+        self.sent = 0
+        self.latencies: list[float] = []
+        self.key_times: list[float] = []
+
+    async def __call__(self, port: int) -> dict:
+        limit = asyncio.Semaphore(CONNECT_CONCURRENCY)
+        clients = [Client(n, self) for n in range(self.clients)]
+
+        async def connect(client: Client):
+            async with limit:
+                await client.connect(port)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(connect(c) for c in clients))
+        connect_time = time.perf_counter() - started
+
+        rooms = [clients[i:i + self.room_size] for i in range(0, len(clients), self.room_size)]
+        rooms = [members for members in rooms if len(members) > 1]
+        has_key = await asyncio.gather(*(self.set_up_room(members, limit) for members in rooms))
+        # without a key, messages would be sent in the clear
+        keyed = [members for members, ok in zip(rooms, has_key) if ok]
+
+        posting = [c for members in keyed for c in members]
+        started = time.perf_counter()
+        await asyncio.gather(*(c.post(self.rate, self.duration) for c in posting))
+        await asyncio.sleep(DRAIN_SECONDS)
+        elapsed = time.perf_counter() - started - DRAIN_SECONDS
+
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            await asyncio.gather(*(c.close() for c in clients))
+
+        return {
+            'rooms': len(rooms),
+            'expected': sum(len(members) * (len(members) - 1) for members in keyed)
+                        * self.rate * self.duration,
+            'connect_seconds': connect_time,
+            'rooms_keyed': len(keyed),
+            'rooms_unkeyed': len(rooms) - len(keyed),
+            'key_times': self.key_times,
+            'sent': self.sent,
+            'latencies': self.latencies,
+            'elapsed': elapsed,
+        }
+
+    async def set_up_room(self, members: list[Client], limit: asyncio.Semaphore) -> bool:
+        """Create and join the room, then time how long until every member
+        has the key of the same exchange. Returns False if that took longer
+        than KEY_TIMEOUT"""
+        async with limit:
+            invite_code = await members[0].create_room(self.key_backend)
+        for member in members[1:]:
+            async with limit:
+                await member.join_room(invite_code)
+
+        started = time.perf_counter()
+        deadline = started + KEY_TIMEOUT
+        while time.perf_counter() < deadline:
+            epochs = {m.room.epoch for m in members if m.room.dh_aead is not None}
+            if len(epochs) == 1 and all(m.room.dh_aead is not None for m in members):
+                self.key_times.append(time.perf_counter() - started)
+                return True
+            await asyncio.sleep(0.01)
+        return False
+
+
+def _generate(port: int, *args) -> dict:
+    """One generator process's share of the clients"""
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return asyncio.run(Run(*args)(port))
+    finally:
+        # or the process waits for the key exchange workers when it exits
+        diffiehellman.executor().shutdown()
+
+
+def shares(clients: int, room_size: int, processes: int) -> list[int]:
+    """Split the clients over the processes in whole rooms"""
+    rooms, rest = divmod(clients, room_size)
+    counts = [room_size * (rooms // processes + (i < rooms % processes)) for i in range(processes)]
+    counts[-1] += rest
+    return [n for n in counts if n]
+
+
+def summarise(args, clients: int, room_size: int, parts: list[dict], server_stats: dict) -> dict:
+    key_times = [t for part in parts for t in part['key_times']]
+    latencies = [t for part in parts for t in part['latencies']]
+    expected = sum(part['expected'] for part in parts)
+    elapsed = max(part['elapsed'] for part in parts)
+    return {
+        'clients': clients, 'room_size': room_size,
+        'rooms': sum(part['rooms'] for part in parts),
+        'rate': args.rate, 'duration': args.duration, 'key_backend': args.key_backend,
+        'processes': len(parts), 'server_workers': args.server_workers,
+        'connect_seconds': max(part['connect_seconds'] for part in parts),
+        'rooms_keyed': sum(part['rooms_keyed'] for part in parts),
+        'rooms_unkeyed': sum(part['rooms_unkeyed'] for part in parts),
+        'key_exchange_p50': percentile(key_times, 50),
+        'key_exchange_p99': percentile(key_times, 99),
+        'key_exchange_max': max(key_times, default=0.0),
+        'sent': sum(part['sent'] for part in parts),
+        'delivered': len(latencies),
+        'delivered_ratio': len(latencies) / expected if expected else 0.0,
+        'delivered_per_second': len(latencies) / elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'latency_mean': statistics.fmean(latencies) if latencies else 0.0,
+        'server': server_stats,
+    }
+
+
+async def wait_for_server(port: int, server: multiprocessing.Process):
+    """Wait until the server accepts connections"""
+    deadline = time.perf_counter() + STARTUP_TIMEOUT
+    while True:
+        try:
+            _, writer = await asyncio.open_connection(HOST, port)
+        except OSError:
+            if not server.is_alive():
+                raise RuntimeError(f'the server exited with {server.exitcode}')
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f'the server is not accepting on port {port}')
+            await asyncio.sleep(0.05)
+        else:
+            writer.close()
+            return
+
+
+async def server_stats(port: int) -> dict:
+    stream = DataStream(*await asyncio.open_connection(HOST, port))
+    listening = asyncio.create_task(stream.listen())
+    await stream.handshake()
+    resp: req.GetServerStats.Response = await stream.write(req.GetServerStats())
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        listening.cancel()
+        await asyncio.gather(listening, return_exceptions=True)
+        await stream.close_connection()
+    return resp.stats
+
+
+def print_row(result: dict):
+    print(f"{result['clients']:>8}{result['room_size']:>6}{result['rooms_keyed']:>7}"
+          f"{result['key_exchange_p50'] * 1e3:>9.1f}{result['key_exchange_p99'] * 1e3:>9.1f}"
+          f"{result['delivered_per_second']:>10.0f}{result['delivered_ratio'] * 100:>7.1f}"
+          f"{result['latency_p50'] * 1e3:>9.1f}{result['latency_p99'] * 1e3:>9.1f}")
+    if result['rooms_unkeyed']:
+        print(f"{'':>8}{result['rooms_unkeyed']} rooms had no key after {KEY_TIMEOUT}s "
+              f"and didn't post")
+
+
+def numbers(text: str) -> list[int]:
+    return [int(n) for n in text.split(',')]
+
+
+async def main(args):
+    print(f"{'clients':>8}{'room':>6}{'keyed':>7}{'kx p50':>9}{'kx p99':>9}"
+          f"{'msg/s':>10}{'deliv%':>7}{'lat p50':>9}{'lat p99':>9}   (ms)")
+
+    loop = asyncio.get_running_loop()
+    out = open(args.json, 'a') if args.json else None
+    port = args.port
+    context = multiprocessing.get_context('spawn')
+    try:
+        for clients in args.clients:
+            for room_size in args.room_size:
+                # not a daemon, those can't start the workers
+                server = context.Process(target=_serve, args=(port, args.server_workers))
+                server.start()
+
+                counts = shares(clients, room_size, args.processes)
+                try:
+                    await wait_for_server(port, server)
+                    with ProcessPoolExecutor(len(counts), mp_context=context) as pool:
+                        parts = await asyncio.gather(*(
+                            loop.run_in_executor(
+                                pool, _generate, port, n, room_size,
+                                args.rate, args.duration, args.key_backend
+                            )
+                            for n in counts
+                        ))
+                    stats = await server_stats(port)
+                finally:
+                    server.terminate()
+                    server.join()
+
+                result = summarise(args, clients, room_size, parts, stats)
+                print_row(result)
+                if out is not None:
+                    out.write(json.dumps(result) + '\n')
+                    out.flush()
+                port += 1  # the last server's port may still be in TIME_WAIT
+    finally:
+        if out is not None:
+            out.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test a PyChat server on localhost')
+    parser.add_argument('--clients', type=numbers, default=[100],
+                        help='simulated clients per run, comma separated for several runs')
+    parser.add_argument('--room-size', type=numbers, default=[10],
+                        help='members per room, comma separated for several runs')
+    parser.add_argument('--rate', type=float, default=1.0,
+                        help='messages per second each client posts')
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help='seconds each client posts for')
+    parser.add_argument('--key-backend', default=models.DEFAULT_KEY_BACKEND,
+                        choices=models.KEY_BACKENDS)
+    parser.add_argument('--processes', type=int, default=1,
+                        help='client processes, so the clients aren\'t held up by one core')
+    parser.add_argument('--server-workers', type=int, default=1,
+                        help='server worker processes')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--json', help='append a JSON line per run to this file')
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,59 @@
+"""Overhead of the DataStream metrics: round trips per second over a local
+connection with and without them, and the cost of each recording call.
+
+    python -m benchmarks.metrics
+"""
+import asyncio
+import time
+from timeit import Timer
+
+from pychat.common.metrics import Histogram, StreamMetrics
+from pychat.common import request as req
+from pychat.common.stream import DataStream
+
+PORT = 8931
+ROUND_TRIPS = 5000
+NUMBER = 200000
+
+
+async def round_trips(metrics: bool) -> float:
+    """Round trips per second of GetDHKey, both ends with or without metrics"""
+    async def on_connect(r, w):
+        stream = DataStream(r, w, metrics=metrics)
+        stream.register_request_handler(req.GetDHKey, lambda r: req.GetDHKey.Response(key=1))
+        await stream.listen()
+
+    server = await asyncio.start_server(on_connect, '127.0.0.1', PORT)
+    client = DataStream(*await asyncio.open_connection('127.0.0.1', PORT), metrics=metrics)
+    listening = asyncio.create_task(client.listen())
+
+    start = time.perf_counter()
+    for _ in range(ROUND_TRIPS):
+        await client.write(req.GetDHKey(fernet_uid='R0omUid123'))
+    elapsed = time.perf_counter() - start
+
+    listening.cancel()
+    await client.close_connection()
+    await asyncio.sleep(0.05)  # for the server's end to close
+    server.close()
+    await server.wait_closed()
+    return ROUND_TRIPS / elapsed
+
+
+async def main():
+    metrics, histogram = StreamMetrics(), Histogram()
+    for name, call in (
+        ('received/sent', lambda: metrics.received(req.PostMessage, 300)),
+        ('round_trip', lambda: metrics.round_trip(req.GetDHKey, 0.0012)),
+        ('Histogram.observe', lambda: histogram.observe(0.0012)),
+    ):
+        print(f"{name:<20}{Timer(call).timeit(NUMBER) / NUMBER * 1e9:>8.0f} ns")
+
+    print()
+    for enabled in (False, True, False, True):
+        rate = await round_trips(enabled)
+        print(f"metrics {'on ' if enabled else 'off'}{rate:>10.0f} round trips/s")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
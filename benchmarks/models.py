@@ -0,0 +1,46 @@
+"""Compare the cost of encoding and decoding each model type with pydantic's
+dict()/parse_obj and with the cached Serializers.
+
+    python -m benchmarks.models
+"""
+import json
+from timeit import Timer
+
+from pychat.common.models import serializer_for
+from benchmarks.samples import sample_frames
+
+NUMBER = 5000
+
+
+def pydantic_dump(frame):
+    d = frame.dict()
+    d['__name__'] = frame.__class__.__qualname__
+    return d
+
+
+def main():
+    print(f"{'frame':<26}{'path':<12}{'us/encode':>11}{'us/decode':>11}")
+
+    for name, frame in sample_frames().items():
+        serializer = serializer_for(frame.__class__)
+        d = pydantic_dump(frame)
+        assert serializer.to_dict(frame) == d
+        assert serializer.parse(d) == frame
+
+        paths = {
+            'pydantic': (lambda: pydantic_dump(frame), lambda: frame.parse_obj(d)),
+            'serializer': (lambda: serializer.to_dict(frame), lambda: serializer.parse(d)),
+            'trusted': (lambda: serializer.to_dict(frame), lambda: serializer.parse(d, trusted=True)),
+            'json': (lambda: json.dumps(pydantic_dump(frame), separators=(', ', ': ')),
+                     lambda: frame.parse_raw(frame.json())),
+            'json cached': (frame.json, lambda: serializer.parse(json.loads(frame.json()))),
+        }
+        for path, (encode, decode) in paths.items():
+            t_encode = Timer(encode).timeit(NUMBER)
+            t_decode = Timer(decode).timeit(NUMBER)
+            print(f"{name:<26}{path:<12}{t_encode / NUMBER * 1e6:>11.2f}"
+                  f"{t_decode / NUMBER * 1e6:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""Cost of publishing a MessageReceived with many open room tabs, when every
+tab subscribes to all of them and checks the room uid (like RoomTab used
+to), and when each tab subscribes to its own room's key.
+
+    python -m benchmarks.pubsub
+"""
+from timeit import Timer
+
+from pychat.client import events
+from pychat.common.pubsub import PubSub
+from pychat.common import models
+
+NUMBER = 20000
+TABS = (1, 10, 100)
+
+
+class Tab:
+    def __init__(self, room_uid: str):
+        self.uid = room_uid
+        self.received = 0
+
+    def on_any_message(self, e: events.MessageReceived):
+        if e.message.room_uid == self.uid:
+            self.received += 1
+
+    def on_message(self, e: events.MessageReceived):
+        self.received += 1
+
+
+def main():
+    user = models.User(name='alice', uid='a1b2c3d4e5')
+    event = events.MessageReceived(
+        message=models.ChatMessage(user=user, text='hello', room_uid='room0')
+    )
+
+    print(f"{'tabs':>6}{'every tab us':>14}{'keyed us':>10}")
+    for count in TABS:
+        tabs = [Tab(f'room{i}') for i in range(count)]
+        every, keyed = PubSub(), PubSub()
+        for tab in tabs:
+            every.subscribe(events.MessageReceived, tab.on_any_message)
+            keyed.subscribe(events.MessageReceived, tab.on_message, key=tab.uid, weak=True)
+
+        every_time = Timer(lambda: every.publish(event)).timeit(NUMBER)
+        keyed_time = Timer(lambda: keyed.publish(event)).timeit(NUMBER)
+        assert tabs[0].received == 2 * NUMBER
+        print(f"{count:>6}{every_time / NUMBER * 1e6:>14.2f}{keyed_time / NUMBER * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""Compare how long a room takes to agree on a new key when a member joins,
+with the ring exchange (every member mixes N - 1 keys in each of N chains)
+and the key tree (each member works out the O(log N) keys on its path that
+changed, two on average). Clients are called
+directly in one process, so the times add up the key math of every member
+along with the server's bookkeeping. Exponentiations are counted over the
+room, and rounds are the messages that must go one after another.
+
+A second table has members join a room one every JOIN_INTERVAL seconds,
+with and without the server coalescing changes into one exchange.
+
+    python -m benchmarks.rekey
+"""
+import asyncio
+import time
+
+from pychat.client import diffiehellman as dh
+from pychat.client.rooms import ChatRoom as ClientRoom, ChatRooms as ClientRooms
+from pychat.server.diffiehellman import KEY_EXCHANGE_DEBOUNCE, TreeKeyAgreement, dh_Key_exchange
+
+ROOM_SIZES = (2, 4, 8, 16, 32, 64, 128, 256)
+MAX_RING_SIZE = 32  # the ring takes minutes past this
+ROOM_UID = 'room'
+BURST_ROOM_SIZE = 64
+BURST_JOINS = (1, 4, 16)
+JOIN_INTERVAL = 0.005  # seconds
+
+
+class Loopback:
+    """Stands in for a client's connection by calling its handlers directly"""
+    def __init__(self, key_backend: str = 'ffdh'):
+        self.handlers = {}
+        self.sealed = True
+        self.client = ClientRooms(self)
+        self.client.rooms[ROOM_UID] = ClientRoom('room', ROOM_UID, key_backend)
+
+    def register_request_handlers(self, *handlers):
+        for type_, callback, *_ in handlers:
+            self.handlers[type_] = callback
+
+    async def write(self, r):
+        resp = self.handlers[type(r)](r)
+        if asyncio.iscoroutine(resp):
+            resp = await resp
+        return resp
+
+
+class ExpCounter:
+    """Count the client's modular exponentiations"""
+    def __init__(self):
+        self.count = 0
+        self._pow = dh.pow if hasattr(dh, 'pow') else pow
+
+    def __call__(self, *args):
+        self.count += 1
+        return self._pow(*args)
+
+    def __enter__(self):
+        dh.pow = self
+        return self
+
+    def __exit__(self, *exc):
+        del dh.pow
+
+
+async def ring_join(size: int) -> tuple[float, int]:
+    streams = [Loopback() for _ in range(size)]
+    with ExpCounter() as exps:
+        start = time.perf_counter()
+        await dh_Key_exchange(ROOM_UID, streams)
+        return time.perf_counter() - start, exps.count
+
+
+def seed_tree(agreement: TreeKeyAgreement, streams: list[Loopback]):
+    """Build the key tree of a room in one pass instead of joining members
+    one at a time, which would take O(N^2) exponentiations"""
+    for stream in streams:
+        room = stream.client.rooms[ROOM_UID]
+        room.set_keys(room.keys.keypair())
+        agreement.tree.insert(stream, room.dh_public)
+        agreement.members[stream] = stream
+        agreement.streams[stream] = stream
+
+    secrets = {}
+
+    keys = streams[0].client.rooms[ROOM_UID].keys
+
+    def secret(node) -> int:
+        if node.is_leaf:
+            node_secret = node.member.client.rooms[ROOM_UID].dh_secret
+        else:
+            left_secret = secret(node.left)
+            secret(node.right)  # sets its blinded key
+            node_secret = keys.tree_node_secret(left_secret, node.right.key)
+            if node.parent is not None:
+                node.key = keys.public_key(node_secret)
+        secrets[node] = node_secret
+        return node_secret
+
+    secret(agreement.tree.root)
+
+    # what each member would have worked out so far
+    for stream in streams:
+        room = stream.client.rooms[ROOM_UID]
+        node = agreement.tree.leaves[stream]
+        room.tree_secrets = [secrets[node]]
+        while node.parent is not None:
+            node = node.parent
+            room.tree_secrets.append(secrets[node])
+        room.tree_co_path = agreement.tree.co_path(stream)
+
+
+async def tree_join(size: int) -> tuple[float, int]:
+    agreement = TreeKeyAgreement(ROOM_UID, debounce=0)
+    streams = [Loopback() for _ in range(size)]
+    seed_tree(agreement, streams[:-1])
+
+    with ExpCounter() as exps:
+        start = time.perf_counter()
+        agreement.join(streams[-1], streams[-1])
+        await agreement.settled()
+        return time.perf_counter() - start, exps.count
+
+
+async def tree_burst(joins: int, debounce: float) -> tuple[float, int, int]:
+    agreement = TreeKeyAgreement(ROOM_UID, debounce=debounce)
+    seed_tree(agreement, [Loopback() for _ in range(BURST_ROOM_SIZE)])
+    joining = [Loopback() for _ in range(joins)]
+
+    with ExpCounter() as exps:
+        start = time.perf_counter()
+        for stream in joining:
+            agreement.join(stream, stream)
+            await asyncio.sleep(JOIN_INTERVAL)
+        await agreement.settled()
+        return time.perf_counter() - start, exps.count, agreement.epoch
+
+
+async def main():
+    # on the loop, so the exponentiations can be counted
+    dh.set_executor(None)
+    print(f"{'members':>8}{'ring ms':>10}{'exps':>8}{'rounds':>8}"
+          f"{'tree ms':>10}{'exps':>8}{'rounds':>8}{'speedup':>9}")
+    for size in ROOM_SIZES:
+        tree, tree_exps = await tree_join(size)
+        tree_cols = f"{tree * 1000:>10.1f}{tree_exps:>8}{3:>8}"
+        if size <= MAX_RING_SIZE:
+            ring, ring_exps = await ring_join(size)
+            print(f"{size:>8}{ring * 1000:>10.1f}{ring_exps:>8}{size + 1:>8}"
+                  f"{tree_cols}{ring / tree:>8.1f}x")
+        else:
+            print(f"{size:>8}{'-':>10}{'-':>8}{'-':>8}{tree_cols}{'-':>9}")
+
+    print(f"\n{BURST_ROOM_SIZE} members, joins {JOIN_INTERVAL * 1000:.0f} ms apart")
+    print(f"{'joins':>8}{'each ms':>10}{'exps':>8}{'epochs':>8}"
+          f"{'coalesced ms':>14}{'exps':>8}{'epochs':>8}")
+    for joins in BURST_JOINS:
+        each = await tree_burst(joins, debounce=0)
+        coalesced = await tree_burst(joins, debounce=KEY_EXCHANGE_DEBOUNCE)
+        print(f"{joins:>8}{each[0] * 1000:>10.1f}{each[1]:>8}{each[2]:>8}"
+              f"{coalesced[0] * 1000:>14.1f}{coalesced[1]:>8}{coalesced[2]:>8}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+"""Compare the server's cost of relaying a PostMessage to a room by decoding
+and encoding it again (eager) with forwarding its envelope (lazy).
+
+    python -m benchmarks.relay
+"""
+from timeit import Timer
+
+from pychat.common.codec import CODECS
+from pychat.common.envelope import Envelope
+from pychat.common.models import id_to_type
+from pychat.common.stream import DataStream
+from pychat.common.transport import FRAME_HEADER, HEADER_SIZE
+from benchmarks.samples import sample_frames
+
+NUMBER = 2000
+ROOM_SIZE = 8
+
+
+class NullWriter:
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+def make_stream(codec) -> DataStream:
+    stream = DataStream(None, NullWriter(), codec)
+    stream.type_ids = True
+    return stream
+
+
+def main():
+    print(f"{'frame':<26}{'codec':<8}{'us/eager':>10}{'us/lazy':>10}{'speedup':>9}")
+
+    for name, frame in sample_frames().items():
+        if not name.startswith('PostMessage'):
+            continue
+
+        for codec in CODECS.values():
+            stream = make_stream(codec)
+            raw = stream.encode_frame(frame)
+            flags, codec_id, type_id, _ = FRAME_HEADER.unpack_from(raw)
+            body = memoryview(raw)[HEADER_SIZE:]
+
+            def eager():
+                model = Envelope(id_to_type(type_id), flags, codec_id, body).model
+                for _ in range(ROOM_SIZE):
+                    stream.encode_frame(model)
+
+            def lazy():
+                envelope = Envelope(id_to_type(type_id), flags, codec_id, body).detach()
+                for _ in range(ROOM_SIZE):
+                    stream.encode_frame(envelope)
+
+            t_eager = Timer(eager).timeit(NUMBER) / NUMBER
+            t_lazy = Timer(lazy).timeit(NUMBER) / NUMBER
+            print(f"{name:<26}{codec.name:<8}{t_eager * 1e6:>10.1f}"
+                  f"{t_lazy * 1e6:>10.1f}{t_eager / t_lazy:>8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
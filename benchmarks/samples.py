@@ -0,0 +1,22 @@
+"""Representative frames used by the benchmarks"""
+from pychat.client import diffiehellman as dh
+from pychat.common import models
+from pychat.common import request as req
+from pychat.common.sealed import seal
+
+
+def sample_frames() -> dict[str, models.StreamData]:
+    secret = dh.secret_key()
+    fernet, aead = dh.create_fernet(secret), dh.create_aead(secret)
+    user = models.User(name='alice', uid='a1b2c3d4e5')
+    msg = models.ChatMessage(user=user, text='hello there, how is everyone?', room_uid='R0omUid123')
+    room = models.ChatRoom(uid='R0omUid123', name='general')
+
+    return {
+        'PostMessage(ChatMessage)': req.PostMessage(message=msg),
+        'PostMessage(Encrypted)': req.PostMessage(message=msg.encrypt(fernet, room.uid)),
+        'PostMessage(Sealed)': req.PostMessage(message=seal(msg, aead, room.uid)),
+        'GetDHMixedKey': req.GetDHMixedKey(fernet_uid=room.uid, key=dh.public_key(dh.secret_key())),
+        'GetDHKey.Response': req.GetDHKey.Response(uid='abcdefghij', key=dh.public_key(dh.secret_key())),
+        'JoinRoom.Response': req.JoinRoom.Response(uid='abcdefghij', room=room),
+    }
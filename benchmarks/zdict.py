@@ -0,0 +1,156 @@
+"""Build the preset compression dictionary (CHAT_DICTIONARY) from real traffic.
+
+Runs load generator rooms against a server in this process, records the
+bodies of the frames written with the binary codec (the part of a frame
+that's compressed), and keeps the byte strings that many frames of a type
+share: field names and the tags around them, not keys or ciphertext. Prints
+how well each compressor does on the recorded bodies. With --write, the
+dictionary is written to pychat/common/chat_dictionary.py. Peers must agree
+on it byte for byte, so rename the compressor that uses it along with it.
+
+    python -m benchmarks.zdict --write
+"""
+import argparse
+import asyncio
+from collections import Counter
+from contextlib import redirect_stdout
+import os
+
+from pychat.client import diffiehellman
+from pychat.common.codec import BINARY, Codec
+from pychat.common.compression import (
+    COMPRESSION_THRESHOLD, COMPRESSORS, CompressionStats, Compressor
+)
+from pychat.common import models, stream
+from pychat.common.models import StreamData, serializer_for
+from pychat.server.server import PychatServer
+from benchmarks.loadgen import HOST, Run
+
+PORT = 8990
+ROOM_SIZES = (2, 4, 8)
+CLIENTS = 24
+RATE = 5.0  # messages per second per client
+DURATION = 2.0  # seconds
+
+GRAM = 6  # bytes, shared strings are grown from runs of these
+# of the bodies of a type a string has to be in, more than any one room's
+# share so room uids aren't picked
+MIN_SHARE = 0.15
+MAX_SIZE = 2048  # bytes, only the last 32KB of a dictionary are used anyway
+OUTPUT = os.path.join(os.path.dirname(__file__), '..', 'pychat', 'common', 'chat_dictionary.py')
+
+
+async def record() -> dict[str, list[bytes]]:
+    """The bodies of the frames the streams wrote, by type, big enough to be
+    compressed"""
+    bodies: dict[str, list[bytes]] = {}
+    encode_frame = stream.encode_frame
+
+    def recording_encode_frame(data: StreamData, codec: Codec, *args) -> bytes:
+        # the body as encode_frame writes it, without the envelope
+        d = serializer_for(data.__class__).to_dict(data, named=False)
+        d.pop('uid', None)
+        body = codec.dumps(d)
+        if codec is BINARY and len(body) >= COMPRESSION_THRESHOLD:
+            bodies.setdefault(data.__class__.__qualname__, []).append(body)
+        return encode_frame(data, codec, *args)
+
+    server = PychatServer(host=HOST, port=PORT)
+    serving = asyncio.create_task(server.run())
+    await server.listening.wait()
+    stream.encode_frame = recording_encode_frame
+    try:
+        for key_backend in models.KEY_BACKENDS:
+            for room_size in ROOM_SIZES:
+                await Run(CLIENTS, room_size, RATE, DURATION, key_backend)(PORT)
+    finally:
+        stream.encode_frame = encode_frame
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+    return bodies
+
+
+def shared_strings(bodies: list[bytes]) -> Counter:
+    """Runs of bytes made of GRAMs that are in at least MIN_SHARE of the
+    bodies, by the number of bodies they're in"""
+    grams = Counter()
+    for body in bodies:
+        grams.update({body[i:i + GRAM] for i in range(len(body) - GRAM + 1)})
+    common = {gram for gram, n in grams.items() if n >= MIN_SHARE * len(bodies)}
+
+    runs = Counter()
+    for body in bodies:
+        found, start, end = set(), None, 0
+        for i in range(len(body) - GRAM + 1):
+            if body[i:i + GRAM] not in common:
+                continue
+            if start is None or i > end:
+                if start is not None:
+                    found.add(body[start:end])
+                start = i
+            end = i + GRAM
+        if start is not None:
+            found.add(body[start:end])
+        runs.update(found)
+    return runs
+
+
+def build(bodies: dict[str, list[bytes]], max_size: int = MAX_SIZE) -> bytes:
+    """Pick the strings shared by the frames of each type that save the
+    most, up to `max_size` bytes"""
+    shared = Counter()
+    for of_type in bodies.values():
+        shared.update(shared_strings(of_type))
+
+    chosen, size = [], 0
+    for s, n in sorted(shared.items(), key=lambda x: (-x[1] * len(x[0]), x[0])):
+        if size + len(s) > max_size or any(s in other for other, _ in chosen):
+            continue
+        chosen.append((s, n))
+        size += len(s)
+    # zlib favours matches near the end, so the most common strings go last
+    chosen.sort(key=lambda x: (x[1], x[0]))
+    return b''.join(s for s, _ in chosen)
+
+
+def write(zdict: bytes, path: str = OUTPUT):
+    lines = [repr(zdict[i:i + 48]) for i in range(0, len(zdict), 48)]
+    with open(path, 'w') as f:
+        f.write('"""Preset compression dictionary, made by `python -m benchmarks.zdict '
+                '--write`\nfrom recorded frames. Don\'t edit by hand"""\n\n')
+        f.write('CHAT_DICTIONARY = (\n')
+        f.writelines(f'    {line}\n' for line in lines)
+        f.write(')\n')
+
+
+def report(bodies: dict[str, list[bytes]], zdict: bytes):
+    compressors = (*COMPRESSORS.values(), Compressor('built', zdict))
+    print(f"dictionary {len(zdict)} bytes, bytes sent per byte encoded:")
+    print(f"{'frame':<26}{'frames':>7}" + ''.join(f"{c.name:>11}" for c in compressors))
+    for name, of_type in sorted(bodies.items()):
+        ratios = []
+        for compressor in compressors:
+            stats = CompressionStats()
+            for body in of_type:
+                compressor.compress(body, stats)
+            ratios.append(stats.ratio)
+        print(f"{name:<26}{len(of_type):>7}" + ''.join(f"{r:>11.3f}" for r in ratios))
+
+
+def main(args):
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        try:
+            bodies = asyncio.run(record())
+        finally:
+            diffiehellman.executor().shutdown()
+    zdict = build(bodies)
+    if args.write:
+        write(zdict)
+    report(bodies, zdict)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the preset compression dictionary')
+    parser.add_argument('--write', action='store_true',
+                        help='write it to pychat/common/chat_dictionary.py')
+    main(parser.parse_args())
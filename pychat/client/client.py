@@ -6,10 +6,13 @@ from pychat.common import models
 
 
 USER = models.User(name='', uid='')
+# key requests handled at once, their math runs in the key executor
+MAX_CONCURRENT_REQUESTS = 8
 
 
 async def start_client():
     r, w = await asyncio.open_connection(host=SERVER_IP, port=PORT)
-    stream: DataStream = DataStream(r, w)
+    stream: DataStream = DataStream(r, w, max_concurrent_requests=MAX_CONCURRENT_REQUESTS)
     rooms = ChatRooms(stream)
     asyncio.create_task(stream.listen())
+    await stream.handshake()
@@ -0,0 +1,198 @@
+"""Decrypts incoming room messages in batches, off the event loop.
+
+Messages are queued in the order they arrive. A worker task takes everything
+that's pending (up to BATCH_SIZE), looks up each message's key on the loop,
+where the room's keys change, then decrypts the whole batch in one call on a
+thread and hands the results back in the same order. While a batch is being
+decrypted the next one builds up, so a burst of messages (or a page of
+history) costs a thread hop per batch instead of holding up the loop and the
+GUI for each message. A batch of only a few messages, the usual case in a
+quiet room, is decrypted on the loop straight away."""
+import asyncio
+from collections import deque
+from time import perf_counter
+from typing import Callable, TYPE_CHECKING
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
+
+from pychat.common import models
+from pychat.common.sealed import Sealed
+
+if TYPE_CHECKING:
+    from pychat.client.rooms import ChatRoom
+
+BATCH_SIZE = 256  # messages decrypted per thread hop
+INLINE_BATCH_SIZE = 4  # batches this small are decrypted on the loop, a thread hop costs more
+
+Incoming = models.ChatMessage | models.Encrypted | Sealed
+
+
+class DecryptionStats:
+    """Running totals for the messages the pipeline handled"""
+    def __init__(self):
+        self.messages = 0
+        self.batches = 0
+        self.failed = 0  # sent with a key the room doesn't have, or malformed
+        self.seconds = 0.0  # from arriving to being delivered, summed
+        self.max_seconds = 0.0
+        self.max_queue_depth = 0
+
+    @property
+    def seconds_per_message(self) -> float:
+        return self.seconds / self.messages if self.messages else 0.0
+
+    @property
+    def messages_per_batch(self) -> float:
+        return self.messages / self.batches if self.batches else 0.0
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(messages={self.messages}, "
+                f"batches={self.batches}, failed={self.failed}, "
+                f"ms_per_message={self.seconds_per_message * 1e3:.2f}, "
+                f"max_ms={self.max_seconds * 1e3:.2f}, "
+                f"max_queue_depth={self.max_queue_depth})")
+
+
+def _decrypt_batch(batch: list[tuple[Incoming, object]]) -> list[models.StreamData | None]:
+    """Decrypt each message with the key found for it, None for the ones that
+    can't be. Runs on a thread"""
+    results = []
+    for msg, key in batch:
+        if key is None:  # not encrypted
+            results.append(msg)
+            continue
+        try:
+            results.append(msg.decrypt(key))
+        except (InvalidToken, InvalidTag):
+            results.append(None)
+        except Exception as exc:
+            # decrypted, but what's inside isn't a message
+            print(f'Dropped a malformed message for {msg.fernet_id}: {exc!r}')
+            results.append(None)
+    return results
+
+
+class DecryptionPipeline:
+    """Decrypts messages for `rooms` and calls `deliver` with each one, in
+    the order they were submitted. Messages that can't be decrypted are
+    dropped"""
+    def __init__(self, rooms: dict[str, 'ChatRoom'],
+                 deliver: Callable[[models.ChatMessage], None],
+                 batch_size: int = BATCH_SIZE):
+        self.rooms = rooms
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.stats = DecryptionStats()
+
+        self._pending: deque[tuple[Incoming, float]] = deque()
+        self._in_flight = 0
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        """Messages submitted and not delivered yet"""
+        return len(self._pending) + self._in_flight
+
+    def submit(self, msg: Incoming):
+        self._pending.append((msg, perf_counter()))
+        self.stats.max_queue_depth = max(self.stats.max_queue_depth, self.queue_depth)
+        self._drained.clear()
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def drain(self):
+        """Wait until every message submitted so far has been delivered"""
+        await self._drained.wait()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    def _key_for(self, msg: Incoming, keys: dict):
+        """The Fernet or AEAD to decrypt the message with, looked up once per
+        room and epoch in a batch. None if it isn't encrypted"""
+        if not isinstance(msg, (models.Encrypted, Sealed)):
+            return None
+        cache_key = (msg.fernet_id, msg.epoch, isinstance(msg, Sealed))
+        if cache_key not in keys:
+            key = None
+            room = self.rooms.get(msg.fernet_id)
+            if room is not None:
+                key = room.aead_for(msg) if isinstance(msg, Sealed) else room.fernet_for(msg)
+            # False when the room or its key for the epoch isn't known
+            keys[cache_key] = False if key is None else key
+        return keys[cache_key]
+
+    async def _run(self):
+        try:
+            while True:
+                if not self._pending:
+                    self._drained.set()
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+
+                taken = [self._pending.popleft()
+                         for _ in range(min(self.batch_size, len(self._pending)))]
+                self._in_flight = len(taken)
+                try:
+                    await self._handle(taken)
+                except Exception as exc:
+                    self.stats.failed += len(taken)
+                    asyncio.get_running_loop().call_exception_handler({
+                        'message': f'Decrypting a batch of {len(taken)} messages failed',
+                        'exception': exc,
+                    })
+                finally:
+                    self._in_flight = 0
+        finally:
+            # closed, nothing more gets delivered, so no one should wait for it
+            self._drained.set()
+
+    async def _handle(self, taken: list[tuple[Incoming, float]]):
+        """Decrypt one batch and deliver what could be decrypted"""
+        keys = {}
+        batch, failed = [], 0
+        for msg, _ in taken:
+            try:
+                key = self._key_for(msg, keys)
+            except Exception as exc:
+                print(f'Dropped a message, looking up its key failed: {exc!r}')
+                key = False
+            if key is False:  # no key for it, from before we joined
+                failed += 1
+                continue
+            batch.append((msg, key))
+
+        if len(batch) <= INLINE_BATCH_SIZE:
+            results = _decrypt_batch(batch)
+        else:
+            results = await asyncio.to_thread(_decrypt_batch, batch)
+
+        now = perf_counter()
+        stats = self.stats
+        stats.batches += 1
+        stats.messages += len(taken)
+        for _, arrived in taken:
+            stats.seconds += now - arrived
+        stats.max_seconds = max(stats.max_seconds, now - taken[0][1])
+
+        stats.failed += failed + results.count(None)
+        for msg in results:
+            if msg is not None:
+                self._deliver(msg)
+
+    def _deliver(self, msg: models.ChatMessage):
+        try:
+            self.deliver(msg)
+        except Exception as exc:
+            # one bad subscriber shouldn't stop the messages after it
+            asyncio.get_running_loop().call_exception_handler({
+                'message': f'Delivering {msg!r} failed',
+                'exception': exc,
+            })
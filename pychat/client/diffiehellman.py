@@ -1,35 +1,210 @@
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 from cryptography.hazmat.primitives import hashes
 from cryptography.fernet import Fernet
+from abc import ABC, abstractmethod
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+import hashlib
+import multiprocessing
 import secrets
 import base64
 
-# prime modulus (2048 bit) and base for diffie-hellman key exchange
+# prime modulus (2048 bit) and base for finite field diffie-hellman
 PRIME = 32317006071311007300714876688669951960444102669715484032130345427524655138867890893197201411522913463688717960921898019494119559150490921095088152386448283120630877367300996091750197750389652106796057638384067568276792218642619756161838094338476170470581645852036305042887575891541065808607552399123930385521914333389668342420684974786564569494856176035326322058077805659331026192708460314150258592864177116725943603718461857357598351152334063994785580370721665417662212881203104945914551140008147396357886767669820042828793708588252247031092071155540224751031064253209884099238184688246467489498721336450133889385773
 BASE = 5
 
+# pow() holds the GIL, so the math runs in other processes to keep the event
+# loop (and the GUI) responsive
+EXECUTOR_WORKERS = 2
+KEY_POOL_SIZE = 4  # keypairs generated ahead of time
 
-def secret_key() -> int:
-    return secrets.randbits(1024)
 
+class KeyBackend(ABC):
+    """The group a room's Diffie-Hellman keys are in. Keys of every backend
+    are ints, so they fit the `key: int` fields of the key requests. A room
+    picks its backend when it's created"""
+    name: str
+    key_size: int  # bytes
 
-def public_key(secret_key: int) -> int:
-    return pow(BASE, secret_key, PRIME)
-        
+    @abstractmethod
+    def secret_key(self) -> int:
+        """A new random secret key"""
 
-def mix_keys(secret_key: int, public_key: int) -> int:
-    """Mix the client's secret key with another public key"""
-    return pow(public_key, secret_key, PRIME)
-     
+    @abstractmethod
+    def public_key(self, secret_key: int) -> int:
+        """The public key of a secret key"""
 
-def create_fernet(secret_key: int):
-    """Use a secret key to create a Fernet for symmetric encryption"""
-    hkdf = HKDF(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=None,
-        info=None
-    )
-    k: bytes = hkdf.derive(secret_key.to_bytes(256, 'big'))
-    k: bytes = base64.urlsafe_b64encode(k)
-    return Fernet(k)
+    @abstractmethod
+    def mix_keys(self, secret_key: int, public_key: int) -> int:
+        """Mix the client's secret key with another public key"""
+
+    def public_keys(self, secret_keys: list[int]) -> list[int]:
+        return [self.public_key(secret) for secret in secret_keys]
+
+    def keypair(self) -> tuple[int, int]:
+        secret = self.secret_key()
+        return secret, self.public_key(secret)
+
+    def tree_node_secret(self, secret_key: int, sibling_key: int) -> int:
+        """The secret of the parent of a key tree node. The mixed key is
+        hashed down to 256 bits so the next level up costs less to work out"""
+        mixed = self.mix_keys(secret_key, sibling_key).to_bytes(self.key_size, 'big')
+        return int.from_bytes(hashlib.sha256(mixed).digest(), 'big')
+
+    def tree_path_secrets(self, secret_key: int, co_path: list[int]) -> list[int]:
+        """Work out the secrets of the key tree nodes from a leaf's parent up
+        to the root, from the leaf's secret and the blinded keys of the
+        siblings on the way up. The last one is the root secret"""
+        path_secrets = []
+        for sibling_key in co_path:
+            secret_key = self.tree_node_secret(secret_key, sibling_key)
+            path_secrets.append(secret_key)
+        return path_secrets
+
+    def create_fernet(self, secret_key: int) -> Fernet:
+        """Use a secret key to create a Fernet for symmetric encryption"""
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=None
+        )
+        k: bytes = hkdf.derive(secret_key.to_bytes(self.key_size, 'big'))
+        k: bytes = base64.urlsafe_b64encode(k)
+        return Fernet(k)
+
+    def create_aead(self, secret_key: int) -> ChaCha20Poly1305:
+        """Use a secret key to create a cipher for Sealed messages. It's
+        derived separately from the Fernet key of the same secret"""
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'pychat sealed'
+        )
+        return ChaCha20Poly1305(hkdf.derive(secret_key.to_bytes(self.key_size, 'big')))
+
+
+class FiniteFieldBackend(KeyBackend):
+    """2048 bit modular exponentiation"""
+    name = 'ffdh'
+    key_size = 256
+
+    def secret_key(self) -> int:
+        return secrets.randbits(1024)
+
+    def public_key(self, secret_key: int) -> int:
+        return pow(BASE, secret_key, PRIME)
+
+    def mix_keys(self, secret_key: int, public_key: int) -> int:
+        return pow(public_key, secret_key, PRIME)
+
+
+class X25519Backend(KeyBackend):
+    """Curve25519 scalar multiplication. X25519 is commutative like modular
+    exponentiation (x(a, x(b, G)) == x(b, x(a, G))), so the same ring and
+    tree exchanges work with it. Keys are 32 byte little-endian values"""
+    name = 'x25519'
+    key_size = 32
+
+    def secret_key(self) -> int:
+        return secrets.randbits(256)
+
+    @staticmethod
+    def _private(secret_key: int) -> X25519PrivateKey:
+        return X25519PrivateKey.from_private_bytes(secret_key.to_bytes(32, 'little'))
+
+    def public_key(self, secret_key: int) -> int:
+        public = self._private(secret_key).public_key()
+        return int.from_bytes(public.public_bytes(Encoding.Raw, PublicFormat.Raw), 'little')
+
+    def mix_keys(self, secret_key: int, public_key: int) -> int:
+        public = X25519PublicKey.from_public_bytes(public_key.to_bytes(32, 'little'))
+        return int.from_bytes(self._private(secret_key).exchange(public), 'little')
+
+
+FFDH = FiniteFieldBackend()
+X25519 = X25519Backend()
+BACKENDS: dict[str, KeyBackend] = {b.name: b for b in (FFDH, X25519)}
+
+# the original module functions, for finite field keys
+secret_key = FFDH.secret_key
+public_key = FFDH.public_key
+mix_keys = FFDH.mix_keys
+public_keys = FFDH.public_keys
+keypair = FFDH.keypair
+tree_node_secret = FFDH.tree_node_secret
+tree_path_secrets = FFDH.tree_path_secrets
+create_fernet = FFDH.create_fernet
+create_aead = FFDH.create_aead
+
+
+_executor: Executor | None = None
+_inline = False
+
+
+def set_executor(executor: Executor | None):
+    """Run the math with `executor`, or on the calling thread if None"""
+    global _executor, _inline
+    _executor, _inline = executor, executor is None
+
+
+def executor() -> Executor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            EXECUTOR_WORKERS, mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+
+async def run(func, *args):
+    """Call one of the functions above without holding up the event loop"""
+    if _inline:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor(), func, *args)
+
+
+class KeyPool:
+    """Keypairs generated in the background, so a new one is ready the
+    moment a key exchange asks for it"""
+    def __init__(self, backend: KeyBackend = FFDH, size: int = KEY_POOL_SIZE):
+        self.backend = backend
+        self.size = size
+        self._pairs: deque[tuple[int, int]] = deque()
+        self._filling: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self._pairs)
+
+    def fill(self):
+        """Start topping up the pool, if there's a running loop to do it on"""
+        if self._filling is not None and not self._filling.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._filling = loop.create_task(self._fill())
+
+    async def _fill(self):
+        while len(self._pairs) < self.size:
+            self._pairs.append(await run(self.backend.keypair))
+
+    async def take(self) -> tuple[int, int]:
+        pair = self._pairs.popleft() if self._pairs else await run(self.backend.keypair)
+        self.fill()
+        return pair
+
+
+_key_pools: dict[str, KeyPool] = {}
+
+
+def key_pool(backend: KeyBackend) -> KeyPool:
+    if backend.name not in _key_pools:
+        _key_pools[backend.name] = KeyPool(backend)
+    return _key_pools[backend.name]
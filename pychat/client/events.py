@@ -5,12 +5,19 @@ from pychat.common import models
 
 
 class Event(BaseModel):
-    pass
+    @property
+    def topic_key(self):
+        """Delivered to subscribers of this key too, see PubSub"""
+        return None
 
 
 class MessageReceived(Event):
     message: models.ChatMessage
 
+    @property
+    def topic_key(self) -> str:
+        return self.message.room_uid
+
 
 class SendMessage(Event):
     message: models.ChatMessage
@@ -18,6 +25,7 @@ class SendMessage(Event):
 
 class CreateRoom(Event):
     room_name: str
+    key_backend: str = models.DEFAULT_KEY_BACKEND
 
 
 class JoinRoom(Event):
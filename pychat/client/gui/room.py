@@ -1,3 +1,4 @@
+from collections import deque
 import tkinter as tk
 
 from pychat.common import models
@@ -6,6 +7,10 @@ from pychat.client.client import USER
 
 USER: models.User
 
+SCROLLBACK_LINES = 1000  # lines kept in the Text widget
+KEPT_LINES = 20000  # older lines kept aside, put back when scrolling up
+PAGE_LINES = 200  # put back at a time
+
 
 class RoomTab(tk.Frame):
     def __init__(self, master, room_uid, *args, **kwargs):
@@ -13,13 +18,22 @@ class RoomTab(tk.Frame):
 
         self.uid = room_uid
 
-        events.pubsub.subscribe(events.MessageReceived, lambda e:
-            self.add_message(e.message)
+        # weak, so closed tabs aren't kept alive by the subscription
+        self._subscription = events.pubsub.subscribe(
+            events.MessageReceived, self.on_message_received, key=room_uid, weak=True
         )
 
+        # messages waiting for the next frame, inserted all at once
+        self._pending: list[str] = []
+        self._flush_id: str | None = None
+        self._lines = 0  # in chat_text
+        self._older: deque[str] = deque(maxlen=KEPT_LINES)  # oldest first
+
         # chat frame widgets
         self.chat_frame = tk.Frame(self)
         self.chat_text = tk.Text(self.chat_frame)
+        self.scrollbar = tk.Scrollbar(self.chat_frame, command=self.chat_text.yview)
+        self.chat_text.configure(yscrollcommand=self._on_scroll)
         self.entry = tk.Entry(self.chat_frame)
         self.send_btn = tk.Button(self.chat_frame, text='Send', command=self.send_message)
 
@@ -35,17 +49,65 @@ class RoomTab(tk.Frame):
         self.chat_frame.columnconfigure(0, weight=90)
         self.chat_frame.columnconfigure(1, weight=10)
         self.chat_text.grid(row=0, column=0, columnspan=2, sticky='nsew')
+        self.scrollbar.grid(row=0, column=2, sticky='ns')
         self.entry.grid(row=1, column=0, sticky='ew')
         self.send_btn.grid(row=1, column=1, sticky='ew')
 
         self.chat_frame.grid(row=0, column=0, sticky='nsew')
     
-    def add_message(self, message: models.ChatMessage):
-        if message.room_uid != self.uid:
-            return
+    def destroy(self):
+        self._subscription.unsubscribe()
+        if self._flush_id is not None:
+            self.after_cancel(self._flush_id)
+        super().destroy()
+
+    def on_message_received(self, e: events.MessageReceived):
+        self.add_message(e.message)
 
-        txt = f"{message.user.name}: {message.text}\n"
+    def add_message(self, message: models.ChatMessage):
+        self._pending.append(f"{message.user.name}: {message.text}\n")
+        if self._flush_id is None:
+            # idle callbacks run once per frame, see GUIRoot
+            self._flush_id = self.after_idle(self._flush)
+
+    def _flush(self):
+        """Insert the messages that came in since the last frame, and move
+        lines over the cap out of the widget if the view is at the bottom"""
+        self._flush_id = None
+        txt = ''.join(self._pending)
+        self._pending.clear()
+
+        at_bottom = self.chat_text.yview()[1] >= 1.0
         self.chat_text.insert('end', txt)
+        self._lines += txt.count('\n')
+
+        # lines put back for reading stay until the view is back at the bottom
+        if at_bottom:
+            self._evict(self._lines - SCROLLBACK_LINES)
+            self.chat_text.see('end')
+
+    def _evict(self, count: int):
+        """Move the oldest `count` lines out of the widget"""
+        if count <= 0:
+            return
+        end = f'{count + 1}.0'
+        self._older.extend(self.chat_text.get('1.0', end).splitlines(keepends=True))
+        self.chat_text.delete('1.0', end)
+        self._lines -= count
+
+    def _on_scroll(self, first: str, last: str):
+        self.scrollbar.set(first, last)
+        if float(first) <= 0.0 and self._older:
+            self._load_older()
+
+    def _load_older(self):
+        """Put a page of older lines back at the top, keeping the view on
+        the line that was at the top"""
+        page = [self._older.pop() for _ in range(min(PAGE_LINES, len(self._older)))]
+        page.reverse()
+        self.chat_text.insert('1.0', ''.join(page))
+        self._lines += len(page)
+        self.chat_text.yview(f'{len(page) + 1}.0')
     
     def send_message(self):
         txt = self.entry.get()
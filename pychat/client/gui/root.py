@@ -1,11 +1,23 @@
 import tkinter as tk
 from tkinter import ttk
 import asyncio
+import time
+import _tkinter
 
 from pychat.client.gui.room import NewRoomTab, JoinRoomTab, RoomTab
 from pychat.client import events
 from pychat.common import models
 
+# Tk is polled from the asyncio loop: again straight away while it has
+# events, then less and less often while it's idle, up to POLL_MAX_INTERVAL
+POLL_MIN_INTERVAL = 0.001  # seconds
+POLL_MAX_INTERVAL = 0.025  # the worst case delay for input when idle
+POLL_BACKOFF = 2
+FRAME_INTERVAL = 1 / 60  # redraws (Tk idle callbacks) at most this often
+MAX_EVENTS_PER_POLL = 100  # so a flood of Tk events can't starve the loop
+
+_TK_EVENTS = _tkinter.WINDOW_EVENTS | _tkinter.FILE_EVENTS | _tkinter.TIMER_EVENTS
+
 
 class GUIRoot(tk.Tk):
     def __init__(self):
@@ -13,6 +25,11 @@ class GUIRoot(tk.Tk):
         self.loop = asyncio.get_running_loop()
         self.closed = asyncio.Event()
 
+        self._poll_interval = POLL_MIN_INTERVAL
+        self._poll_handle: asyncio.TimerHandle | asyncio.Handle | None = None
+        self._last_redraw = 0.0
+        self._dirty = True  # changed since the last redraw
+
         self.title('PyChat')
         self.protocol("WM_DELETE_WINDOW", self._close)
 
@@ -24,9 +41,13 @@ class GUIRoot(tk.Tk):
 
         self._arrange()
 
-        events.pubsub.subscribe(events.RoomCreated, lambda e:
-            self._add_room(e.room)
-        )
+        self._subscriptions = [
+            events.pubsub.subscribe(events.RoomCreated, lambda e:
+                self._add_room(e.room)
+            ),
+            # anything from the network that changes the window
+            events.pubsub.subscribe(events.MessageReceived, lambda e: self.wake()),
+        ]
 
         self._mainloop()
     
@@ -34,8 +55,46 @@ class GUIRoot(tk.Tk):
         self.room_tabs.pack(fill=tk.BOTH, expand=1)
     
     def _mainloop(self):
-        self.update()
-        self.loop.call_soon(self._mainloop)
+        """Handle the Tk events that are waiting and redraw if a frame is
+        due, then schedule the next poll"""
+        self._poll_handle = None
+        handled = 0
+        while handled < MAX_EVENTS_PER_POLL and \
+                self.tk.dooneevent(_TK_EVENTS | _tkinter.DONT_WAIT):
+            handled += 1
+        self._dirty = self._dirty or handled > 0
+
+        now = time.monotonic()
+        redraw_in = self._last_redraw + FRAME_INTERVAL - now
+        if self._dirty and redraw_in <= 0:
+            while self.tk.dooneevent(_tkinter.IDLE_EVENTS | _tkinter.DONT_WAIT):
+                pass
+            self._last_redraw, self._dirty = now, False
+
+        if handled:
+            self._poll_interval = POLL_MIN_INTERVAL
+        else:
+            self._poll_interval = min(self._poll_interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+        interval = self._poll_interval
+        if self._dirty:  # a redraw is waiting for the next frame
+            interval = min(interval, max(redraw_in, 0))
+        self._poll_handle = self.loop.call_later(interval, self._mainloop)
+
+    def wake(self):
+        """Poll Tk now, after something outside it changed the window"""
+        self._dirty = True
+        self._poll_interval = POLL_MIN_INTERVAL
+        if isinstance(self._poll_handle, asyncio.TimerHandle):
+            self._poll_handle.cancel()
+            self._poll_handle = self.loop.call_soon(self._mainloop)
+
+    def destroy(self):
+        for sub in self._subscriptions:
+            sub.unsubscribe()
+        if self._poll_handle is not None:
+            self._poll_handle.cancel()
+            self._poll_handle = None
+        super().destroy()
 
     def _close(self):
         self.closed.set()
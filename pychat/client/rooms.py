@@ -1,95 +1,238 @@
+import asyncio
+
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+
 from pychat.client import diffiehellman as dh
 from pychat.client import events
+from pychat.client.decryption import DecryptionPipeline
 from pychat.common import models
 from pychat.common import request as req
+from pychat.common.pubsub import Overflow
+from pychat.common.sealed import Sealed, seal
 from pychat.common.stream import DataStream
 
+KEPT_EPOCHS = 4  # keys kept per room, for messages sent just before an exchange
+
 
 class ChatRoom:
-    def __init__(self, name: str, uid: str):
+    def __init__(self, name: str, uid: str, key_backend: str = 'ffdh'):
         self.name = name
         self.uid = uid
+        self.keys: dh.KeyBackend = dh.BACKENDS[key_backend]
         
+        # taken from the key pool on the first key request, so adding a room
+        # never waits for a keypair to be made
         self.dh_secret = self.dh_public = None
-        self.generate_keys()
+        self._first_keys: asyncio.Future | None = None
+        # key tree secrets from the leaf up, and the co-path they came from
+        self.tree_secrets: list[int] = []
+        self.tree_co_path: list[int] = []
+        self.leaf_epoch: int | None = None  # when the leaf secret was picked
         
         self.dh_fernet = None
+        self.dh_aead = None
+        # send Sealed messages instead of Fernet Encrypted ones, when every
+        # member can read them (the server says so with each new key)
+        self.sealing = False
+        # keys by the epoch of the exchange that made them, dh_fernet and
+        # dh_aead are the newest
+        self.epoch: int | None = None
+        self.fernets: dict[int, Fernet] = {}
+        self.aeads: dict[int, ChaCha20Poly1305] = {}
+        # requests of one type for the room are handled in order (see
+        # ChatRooms), this keeps those of different types that change the
+        # room's keys from interleaving
+        self.key_lock = asyncio.Lock()
     
-    def generate_keys(self) -> None:
-        self.dh_secret = dh.secret_key()
-        self.dh_public = dh.public_key(self.dh_secret)
-    
-    def mix_dh_public(self, dh_public: int) -> int:
-        return dh.mix_keys(self.dh_secret, dh_public)
+    def set_keys(self, keypair: tuple[int, int]) -> None:
+        self.dh_secret, self.dh_public = keypair
+        self.tree_secrets = [self.dh_secret]
+        self.tree_co_path = []
+
+    async def generate_keys(self) -> None:
+        self.set_keys(await dh.key_pool(self.keys).take())
+
+    async def ensure_keys(self) -> None:
+        """Take the room's first keypair if it doesn't have one yet. Requests
+        that arrive while it's being taken share it"""
+        if self.dh_secret is not None:
+            return
+        if self._first_keys is None:
+            self._first_keys = asyncio.ensure_future(dh.key_pool(self.keys).take())
+        keypair = await self._first_keys
+        if self.dh_secret is None:  # or a regenerated pair got there first
+            self.set_keys(keypair)
     
-    def create_shared_secret(self, dh_final_public: int):
-        dh_secret: int = self.mix_dh_public(dh_final_public)
-        self.dh_fernet = dh.create_fernet(dh_secret)
+    async def mix_dh_public(self, dh_public: int) -> int:
+        await self.ensure_keys()
+        return await dh.run(self.keys.mix_keys, self.dh_secret, dh_public)
     
+    async def create_shared_secret(self, dh_final_public: int, epoch: int | None = None,
+                                   seal: bool = False):
+        dh_secret: int = await self.mix_dh_public(dh_final_public)
+        self.use_key(dh_secret, epoch, seal)
+
+    def use_key(self, dh_secret: int, epoch: int | None, seal: bool = False):
+        """Keep the key made by an exchange, and send with it unless a newer
+        exchange has already finished. With `seal`, messages sent with it are
+        Sealed"""
+        fernet = self.keys.create_fernet(dh_secret)
+        aead = self.keys.create_aead(dh_secret)
+        if epoch is None:  # the server doesn't number its exchanges
+            self.dh_fernet, self.dh_aead, self.sealing = fernet, aead, seal
+            return
+
+        self.fernets[epoch], self.aeads[epoch] = fernet, aead
+        for old in sorted(self.fernets)[:-KEPT_EPOCHS]:
+            del self.fernets[old], self.aeads[old]
+        if self.epoch is None or epoch >= self.epoch:
+            self.dh_fernet, self.dh_aead, self.epoch = fernet, aead, epoch
+            self.sealing = seal
+
+    def fernet_for(self, msg: models.Encrypted) -> Fernet | None:
+        if msg.epoch is None:
+            return self.dh_fernet
+        return self.fernets.get(msg.epoch)
+
+    def aead_for(self, msg: Sealed) -> ChaCha20Poly1305 | None:
+        if msg.epoch is None:
+            return self.dh_aead
+        return self.aeads.get(msg.epoch)
+
+    def encrypt(self, msg: models.Encryptable) -> models.Encrypted | Sealed:
+        if self.sealing:
+            return seal(msg, self.dh_aead, self.uid, self.epoch)
+        return msg.encrypt(self.dh_fernet, self.uid, self.epoch)
+
+    async def refresh_tree_key(self, co_path: list[int], to_root: bool = True,
+                               new_leaf: bool = True, epoch: int | None = None,
+                               seal: bool = False) -> list[int]:
+        """Refresh the path to the root as the sponsor of a key tree change,
+        or as far as the co-path goes. Returns the blinded keys of the nodes
+        worked out, not including the root"""
+        if new_leaf:
+            await self.generate_keys()
+            self.leaf_epoch = epoch
+        path_secrets = await self.tree_path_secrets(co_path)
+        if not to_root:
+            return await dh.run(self.keys.public_keys, path_secrets)
+
+        self.use_key(self.tree_secrets[-1], epoch, seal)
+        return await dh.run(self.keys.public_keys, path_secrets[:-1])
+
+    async def create_tree_secret(self, co_path: list[int], epoch: int | None = None,
+                                 seal: bool = False):
+        if epoch is not None and self.leaf_epoch is not None and epoch < self.leaf_epoch:
+            return  # a late co-path for the leaf secret before this one
+        await self.tree_path_secrets(co_path)
+        self.use_key(self.tree_secrets[-1], epoch, seal)
+
+    async def tree_path_secrets(self, co_path: list[int]) -> list[int]:
+        """The secrets of the key tree nodes above the leaf. Only the nodes
+        above the first sibling that changed since last time are worked out"""
+        await self.ensure_keys()
+        same = 0
+        for old, new in zip(self.tree_co_path, co_path):
+            if old != new:
+                break
+            same += 1
+        kept = self.tree_secrets[:same + 1]
+        self.tree_secrets = kept + await dh.run(
+            self.keys.tree_path_secrets, kept[-1], co_path[same:]
+        )
+        self.tree_co_path = co_path
+        return self.tree_secrets[1:]
+
     def model(self) -> models.ChatRoom:
-        return models.ChatRoom(name=self.name, uid=self.uid)
+        return models.ChatRoom(name=self.name, uid=self.uid, key_backend=self.keys.name)
 
 
 class ChatRooms:
     def __init__(self, stream: DataStream):
         self.rooms: dict[str, ChatRoom] = {}
         self.stream = stream
+        # decrypts incoming messages off the loop, delivering them in order
+        self.decryption = DecryptionPipeline(self.rooms, self._publish_message)
 
         self._register_request_handlers()
         self._register_event_handlers()
+        dh.key_pool(dh.BACKENDS[models.DEFAULT_KEY_BACKEND]).fill()
     
     def _register_request_handlers(self):
+        # with concurrent dispatch, one room's key math doesn't hold up
+        # another's, or the messages read meanwhile
+        by_room = lambda r: r.fernet_uid
         self.stream.register_request_handlers(
-            (req.GetDHKey, self.on_get_dh_key),
-            (req.GetDHMixedKey, self.on_get_dh_mixed_key),
-            (req.PostFinalKey, self.on_post_dh_final_key),
+            (req.GetDHKey, self.on_get_dh_key, by_room),
+            (req.GetDHMixedKey, self.on_get_dh_mixed_key, by_room),
+            (req.PostFinalKey, self.on_post_dh_final_key, by_room),
             (req.PostMessage, self.on_message_received),
-            (req.RegenerateDHKeyPair, self.on_regenerate_dh_key_pair),
+            (req.RegenerateDHKeyPair, self.on_regenerate_dh_key_pair, by_room),
+            (req.RefreshTreeKey, self.on_refresh_tree_key, by_room),
+            (req.PostTreeKeys, self.on_post_tree_keys, by_room),
         )
     
     def _register_event_handlers(self):
-        events.pubsub.subscribe(events.CreateRoom, self.on_create_room)
-        events.pubsub.subscribe(events.JoinRoom, self.on_join_room)
-        events.pubsub.subscribe(events.SendMessage, self.on_send_message)
+        # the user's own actions, never dropped however slow the server is
+        events.pubsub.subscribe(events.CreateRoom, self.on_create_room, overflow=Overflow.KEEP)
+        events.pubsub.subscribe(events.JoinRoom, self.on_join_room, overflow=Overflow.KEEP)
+        events.pubsub.subscribe(events.SendMessage, self.on_send_message, overflow=Overflow.KEEP)
     
     def add_room(self, room: models.ChatRoom):
-        room = ChatRoom(room.name, room.uid)
+        room = ChatRoom(room.name, room.uid, room.key_backend)
         self.rooms[room.uid] = room
         events.pubsub.publish(events.RoomCreated(room=room.model()))
     
     def delete_room(self, room_uid):
         del self.rooms[room_uid]
     
-    def on_get_dh_key(self, r: req.GetDHKey) -> req.GetDHKey.Response:
+    async def on_get_dh_key(self, r: req.GetDHKey) -> req.GetDHKey.Response:
         room_uid = r.fernet_uid
         room = self.rooms[room_uid]
-        
+
+        await room.ensure_keys()
         return req.GetDHKey.Response(key=room.dh_public)
     
-    def on_get_dh_mixed_key(self, r: req.GetDHMixedKey) -> req.GetDHMixedKey.Response:
+    async def on_get_dh_mixed_key(self, r: req.GetDHMixedKey) -> req.GetDHMixedKey.Response:
         room_uid = r.fernet_uid
         room = self.rooms[room_uid]
 
-        mixed_dh_public = room.mix_dh_public(r.key)
+        mixed_dh_public = await room.mix_dh_public(r.key)
         return req.GetDHMixedKey.Response(key=mixed_dh_public)
     
-    def on_post_dh_final_key(self, r: req.PostFinalKey) -> None:
+    async def on_post_dh_final_key(self, r: req.PostFinalKey) -> None:
         room_uid = r.fernet_uid
         room = self.rooms[room_uid]
-        room.create_shared_secret(r.key)
+        async with room.key_lock:
+            await room.create_shared_secret(r.key, r.epoch, r.seal)
+
+    async def on_refresh_tree_key(self, r: req.RefreshTreeKey) -> req.RefreshTreeKey.Response:
+        room = self.rooms[r.fernet_uid]
+        async with room.key_lock:
+            path_keys = await room.refresh_tree_key(
+                r.co_path, r.to_root, r.new_leaf, r.epoch, r.seal
+            )
+            return req.RefreshTreeKey.Response(leaf_key=room.dh_public, path_keys=path_keys)
+
+    async def on_post_tree_keys(self, r: req.PostTreeKeys) -> None:
+        room = self.rooms[r.fernet_uid]
+        async with room.key_lock:
+            await room.create_tree_secret(r.co_path, r.epoch, r.seal)
     
     async def on_create_room(self, event: events.CreateRoom) -> None:
         """Request for the server to make a new room and await
         the server to send back a response with the room model"""
 
-        r = req.CreateRoom(room_name=event.room_name)
-        resp: req.CreateRoom.Response = await self.stream.write(r)
+        r = req.CreateRoom(room_name=event.room_name, key_backend=event.key_backend)
+        # the room is added before the key requests for it are handled
+        resp: req.CreateRoom.Response = await self.stream.write(
+            r, on_response=lambda resp: self.add_room(resp.room)
+        )
 
         room: models.ChatRoom = resp.room
         invite_code: str = resp.invite_code
 
-        self.add_room(room)
-
         # TODO Should this be handled by the server??
         # send a message to the new room containing the invite code
         usr = models.User(name='Pychat', uid='')
@@ -102,9 +245,12 @@ class ChatRooms:
         a match is found, a respone containing the room model is returned"""
 
         r = req.JoinRoom(invite_code=event.invite_code)
-        resp: req.JoinRoom.Response = await self.stream.write(r)
-
-        self.add_room(resp.room)
+        resp: req.JoinRoom.Response = await self.stream.write(
+            r, on_response=lambda resp: resp.room and self.add_room(resp.room)
+        )
+        if resp.error is not None:
+            print(f"Couldn't join a room: {resp.error}")
+            return
 
         # TODO Should this be handled by the server??
         # send a message to the room informing other users
@@ -118,23 +264,32 @@ class ChatRooms:
         msg: models.ChatMessage = event.message
 
         if room.dh_fernet is not None:
-            msg: models.Encrypted = msg.encrypt(room.dh_fernet, room.uid)
+            msg: models.Encrypted | Sealed = room.encrypt(msg)
         
         await self.stream.write(req.PostMessage(message=msg))
     
     def on_message_received(self, r: req.PostMessage) -> None:
-        msg: models.ChatMessage | models.Encrypted = r.message
-         # decrypt the message if needed
-        if isinstance(msg, models.Encrypted):
-            room_uid = msg.fernet_id
-            room = self.rooms[room_uid]
-            msg: models.ChatMessage = msg.decrypt(room.dh_fernet)
+        # decrypted if needed, then published once the ones before it are
+        self.decryption.submit(r.message)
 
+    @staticmethod
+    def _publish_message(msg: models.ChatMessage):
         events.pubsub.publish(events.MessageReceived(message=msg))
+
+    async def get_history(self, room_uid: str, before: int | None = None,
+                          limit: int = 50) -> req.GetHistory.Response:
+        """Ask for the page of room messages before seq `before` (the newest
+        page if not set). The messages arrive like new ones, before this
+        returns. Pass the response's first_seq to get the page before it"""
+        r = req.GetHistory(room_uid=room_uid, before=before, limit=limit)
+        resp = await self.stream.write(r)
+        await self.decryption.drain()
+        return resp
     
     async def on_regenerate_dh_key_pair(self, r: req.RegenerateDHKeyPair) -> req.Response:
         """Tell the room with the matching uid to regenerate its public/private DH keys"""
         room = self.rooms[r.fernet_uid]
-        room.generate_keys()
+        async with room.key_lock:
+            await room.generate_keys()
         # return an empty response to let the server know it was done
         return req.Response()
@@ -0,0 +1,18 @@
+"""Preset compression dictionary, made by `python -m benchmarks.zdict --write`
+from recorded frames. Don't edit by hand"""
+
+CHAT_DICTIONARY = (
+    b'8\xa5epoch\x01\xa4seal\xc3\xa7co_path\x93\xc88\xa5epoch\x01\xa4seal\xc3\xa7co_path\x91\xc8'
+    b'\x01\x01\x01\x008\xa5epoch\x01\xa4seal\xc3\xa7co_path\x92\xc8\x01\xa5epoch\x01\xa4seal\xc3\xa7co_pa'
+    b'th\x91\xc8\x01\x01\x01\x00\x83\xa5error\xc0\xa8leaf_key\xc8\x00 \x01\x87\xa7context\xc0\xaafernet_u'
+    b'id\xaa9\xa9path_keys\x92\xc8\x00 \x01\xa9path_keys\x92\xc8\x01\xa9path_keys\x91\xc8\x01\x01\x01\x00'
+    b'\xa5epoch\x01\xa4seal\xc3\xa7co_path\x92\xc8\x00 \x01\x83\xa5error\xc0\xa8leaf_key\xc8\x01\x00\x01\xa9'
+    b'path_keys\x91\xc8\x01\x00\x01\x83\xa5error\xc0\xa8leaf_key\xc8\x01\x01\x01\x00\xa7to_root\xc2\xa8ne'
+    b'w_leaf\xc3\xa7to_root\xc3\xa8new_leaf\xc3\xa5epoch\x01\xa4seal\xc3\xa7co_path\x93'
+    b'\xc8\x00 \x01\xa5epoch\x01\xa4seal\xc3\xa7co_path\x93\xc8\x01\xa5epoch\x01\xa4seal\xc3\xa7co_pat'
+    b'h\x92\xc8\x01\xa5epoch\x01\xa4seal\xc3\xa7co_path\x91\xc8\x01\x87\xa7context\xc0\xaafernet_ui'
+    b'd\xaa\x82\xa5error\xc0\xa3key\xc8\x01\x00\x01\x82\xa5error\xc0\xa3key\xc8\x01\x01\x01\x00\x85\xa7context\xc0\xaafe'
+    b'rnet_uid\xaa\xaaciphertext\xc4T\xaaciphertext\xc4W\x82\xa7context\xc0\xa7me'
+    b'ssage\x85\xaeencrypted_type\xabChatMessage\xa9fernet_id\xaa\xa5epo'
+    b'ch\x01\xa5nonce\xc4\x0c'
+)
@@ -0,0 +1,276 @@
+from abc import ABC, abstractmethod
+import base64
+import json
+import struct
+from typing import Type
+
+from pychat.common.models import StreamData, dict_to_model, serializer_for
+
+
+class Codec(ABC):
+    """Converts StreamData to and from the body of a frame. Every frame header
+    carries the id of the codec used to encode the body, so a stream can decode
+    any known codec no matter which one it writes with.
+
+    When the frame header carries the type id, the body leaves out the type
+    name (`named=False`) and the type is passed to decode instead"""
+    name: str
+    id: int
+
+    @abstractmethod
+    def dumps(self, d: dict) -> bytes:
+        """Encode a tree of dicts, lists and scalars"""
+
+    @abstractmethod
+    def loads(self, body: bytes | memoryview) -> dict:
+        """Decode a body made by dumps"""
+
+    def encode(self, data: StreamData, named: bool = True) -> bytes:
+        return self.dumps(serializer_for(data.__class__).to_dict(data, named))
+
+    def decode(self, body: bytes | memoryview,
+               type_: Type[StreamData] | None = None) -> StreamData:
+        d = self.loads(body)
+        if type_ is None:
+            return dict_to_model(d)
+        return serializer_for(type_).parse(d)
+
+
+class JSONCodec(Codec):
+    """Human readable encoding, useful for debugging"""
+    name = 'json'
+    id = 0
+
+    # same output as StreamData.json(), bytes values become {"__bytes__": base64}
+    _encoder = json.JSONEncoder(separators=(', ', ': '), default=lambda o: _bytes_to_json(o))
+
+    def dumps(self, d: dict) -> bytes:
+        return self._encoder.encode(d).encode()
+
+    def loads(self, body: bytes | memoryview) -> dict:
+        body = bytes(body) if isinstance(body, memoryview) else body
+        return json.loads(body, object_hook=_json_to_bytes)
+
+
+def _bytes_to_json(o) -> dict:
+    if isinstance(o, (bytes, bytearray, memoryview)):
+        return {'__bytes__': base64.b64encode(o).decode()}
+    raise TypeError(f'Object of type {o.__class__.__name__} is not JSON serializable')
+
+
+def _json_to_bytes(d: dict):
+    if d.keys() == {'__bytes__'}:
+        return base64.b64decode(d['__bytes__'])
+    return d
+
+
+class BinaryCodec(Codec):
+    """Compact msgpack-style encoding. Large ints (DH keys) and bytes are
+    written as raw bytes instead of decimal / base64 text"""
+    name = 'binary'
+    id = 1
+
+    def dumps(self, d: dict) -> bytes:
+        return pack(d)
+
+    def loads(self, body: bytes | memoryview) -> dict:
+        return unpack(body)
+
+
+CODECS: dict[int, Codec] = {c.id: c for c in (JSONCodec(), BinaryCodec())}
+_CODECS_BY_NAME: dict[str, Codec] = {c.name: c for c in CODECS.values()}
+
+JSON = CODECS[JSONCodec.id]
+BINARY = CODECS[BinaryCodec.id]
+
+
+def codec_by_name(name: str) -> Codec:
+    return _CODECS_BY_NAME[name]
+
+
+def choose_codec(names) -> Codec | None:
+    """Return the first codec in `names` that is supported"""
+    for name in names:
+        if name in _CODECS_BY_NAME:
+            return _CODECS_BY_NAME[name]
+
+
+# binary format (subset of msgpack)
+_NIL, _FALSE, _TRUE = 0xC0, 0xC2, 0xC3
+_BIN8, _BIN16, _BIN32 = 0xC4, 0xC5, 0xC6
+_EXT16 = 0xC8
+_FLOAT64 = 0xCB
+_INT64 = 0xD3
+_STR8, _STR16, _STR32 = 0xD9, 0xDA, 0xDB
+_ARRAY32 = 0xDD
+_MAP32 = 0xDF
+
+# extension types
+_EXT_BIGINT = 1  # signed big-endian int that doesn't fit in 64 bits
+
+_U8 = struct.Struct('>B')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+_I64 = struct.Struct('>q')
+_F64 = struct.Struct('>d')
+_EXT16_HEAD = struct.Struct('>Hb')  # length, type
+
+_INT64_MIN, _INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def pack(value) -> bytes:
+    """Encode a tree of dicts, lists and scalars into bytes"""
+    out = bytearray()
+    _pack(value, out)
+    return bytes(out)
+
+
+def _pack_sized(out: bytearray, n: int, tags: tuple[int, int, int]):
+    """Write the tag and length prefix for a str or bin value"""
+    if n < 0x100:
+        out.append(tags[0])
+        out += _U8.pack(n)
+    elif n < 0x10000:
+        out.append(tags[1])
+        out += _U16.pack(n)
+    else:
+        out.append(tags[2])
+        out += _U32.pack(n)
+
+
+def _pack(value, out: bytearray):
+    if value is None:
+        out.append(_NIL)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        if 0 <= value < 0x80:
+            out.append(value)
+        elif -0x20 <= value < 0:
+            out.append(value & 0xFF)
+        elif _INT64_MIN <= value <= _INT64_MAX:
+            out.append(_INT64)
+            out += _I64.pack(value)
+        else:
+            raw = value.to_bytes(value.bit_length() // 8 + 1, 'big', signed=True)
+            out.append(_EXT16)
+            out += _EXT16_HEAD.pack(len(raw), _EXT_BIGINT)
+            out += raw
+    elif isinstance(value, float):
+        out.append(_FLOAT64)
+        out += _F64.pack(value)
+    elif isinstance(value, str):
+        raw = value.encode()
+        if len(raw) < 0x20:
+            out.append(0xA0 | len(raw))
+        else:
+            _pack_sized(out, len(raw), (_STR8, _STR16, _STR32))
+        out += raw
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        _pack_sized(out, len(value), (_BIN8, _BIN16, _BIN32))
+        out += value
+    elif isinstance(value, dict):
+        if len(value) < 0x10:
+            out.append(0x80 | len(value))
+        else:
+            out.append(_MAP32)
+            out += _U32.pack(len(value))
+        for k, v in value.items():
+            _pack(k, out)
+            _pack(v, out)
+    elif isinstance(value, (list, tuple, set)):
+        if len(value) < 0x10:
+            out.append(0x90 | len(value))
+        else:
+            out.append(_ARRAY32)
+            out += _U32.pack(len(value))
+        for v in value:
+            _pack(v, out)
+    else:
+        raise TypeError(f"Can't pack value of type {type(value).__name__}")
+
+
+def unpack(data: bytes | memoryview):
+    """Decode bytes created by pack()"""
+    view = memoryview(data)
+    value, pos = _unpack(view, 0)
+    if pos != len(view):
+        raise ValueError(f'{len(view) - pos} trailing bytes after packed value')
+    return value
+
+
+def _unpack_str(view: memoryview, pos: int, n: int):
+    return str(view[pos:pos + n], 'utf-8'), pos + n
+
+
+def _unpack_bin(view: memoryview, pos: int, n: int):
+    return bytes(view[pos:pos + n]), pos + n
+
+
+def _unpack_array(view: memoryview, pos: int, n: int):
+    items = []
+    for _ in range(n):
+        v, pos = _unpack(view, pos)
+        items.append(v)
+    return items, pos
+
+
+def _unpack_map(view: memoryview, pos: int, n: int):
+    d = {}
+    for _ in range(n):
+        k, pos = _unpack(view, pos)
+        d[k], pos = _unpack(view, pos)
+    return d, pos
+
+
+def _unpack(view: memoryview, pos: int):
+    tag = view[pos]
+    pos += 1
+
+    if tag < 0x80:
+        return tag, pos
+    if tag >= 0xE0:
+        return tag - 0x100, pos
+    if tag >= 0xA0 and tag <= 0xBF:
+        return _unpack_str(view, pos, tag & 0x1F)
+    if tag >= 0x90 and tag <= 0x9F:
+        return _unpack_array(view, pos, tag & 0x0F)
+    if tag >= 0x80 and tag <= 0x8F:
+        return _unpack_map(view, pos, tag & 0x0F)
+
+    if tag == _NIL:
+        return None, pos
+    if tag == _TRUE:
+        return True, pos
+    if tag == _FALSE:
+        return False, pos
+    if tag == _INT64:
+        return _I64.unpack_from(view, pos)[0], pos + _I64.size
+    if tag == _FLOAT64:
+        return _F64.unpack_from(view, pos)[0], pos + _F64.size
+    if tag == _STR8:
+        return _unpack_str(view, pos + 1, view[pos])
+    if tag == _STR16:
+        return _unpack_str(view, pos + 2, _U16.unpack_from(view, pos)[0])
+    if tag == _STR32:
+        return _unpack_str(view, pos + 4, _U32.unpack_from(view, pos)[0])
+    if tag == _BIN8:
+        return _unpack_bin(view, pos + 1, view[pos])
+    if tag == _BIN16:
+        return _unpack_bin(view, pos + 2, _U16.unpack_from(view, pos)[0])
+    if tag == _BIN32:
+        return _unpack_bin(view, pos + 4, _U32.unpack_from(view, pos)[0])
+    if tag == _ARRAY32:
+        return _unpack_array(view, pos + 4, _U32.unpack_from(view, pos)[0])
+    if tag == _MAP32:
+        return _unpack_map(view, pos + 4, _U32.unpack_from(view, pos)[0])
+    if tag == _EXT16:
+        n, ext_type = _EXT16_HEAD.unpack_from(view, pos)
+        pos += _EXT16_HEAD.size
+        if ext_type != _EXT_BIGINT:
+            raise ValueError(f'Unknown extension type {ext_type}')
+        return int.from_bytes(view[pos:pos + n], 'big', signed=True), pos + n
+
+    raise ValueError(f'Unknown type tag {tag:#x}')
@@ -0,0 +1,103 @@
+import time
+import zlib
+
+from pychat.common.chat_dictionary import CHAT_DICTIONARY
+
+# frame header flags
+FLAG_COMPRESSED = 0x01
+FLAG_DICTIONARY = 0x02  # compressed with CHAT_DICTIONARY preset
+
+COMPRESSION_THRESHOLD = 128  # bytes, smaller bodies are sent as they are
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024  # bytes
+LEVEL = 6
+# CHAT_DICTIONARY holds the strings most frames of each type share, made by
+# benchmarks.zdict from recorded traffic. Peers must agree on it byte for
+# byte, so it can only be changed along with the name of the compressor that
+# uses it.
+CHAT_DICTIONARY_COMPRESSOR = 'zlib-chat2'
+
+
+class CompressionStats:
+    """Running totals for the frames a stream tried to compress"""
+    def __init__(self):
+        self.frames = 0  # frames seen, including ones below the threshold
+        self.compressed = 0  # frames sent compressed
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0  # time spent compressing
+
+    @property
+    def ratio(self) -> float:
+        """Bytes sent per byte encoded, lower is better"""
+        return self.bytes_out / self.bytes_in if self.bytes_in else 1.0
+
+    @property
+    def seconds_per_frame(self) -> float:
+        return self.seconds / self.frames if self.frames else 0.0
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(frames={self.frames}, "
+                f"compressed={self.compressed}, ratio={self.ratio:.2f}, "
+                f"us_per_frame={self.seconds_per_frame * 1e6:.1f})")
+
+
+class Compressor:
+    """Compresses frame bodies with zlib, optionally primed with a preset
+    dictionary. Each frame is compressed on its own so frames can be dropped
+    or reordered without breaking the ones after them"""
+    def __init__(self, name: str, zdict: bytes | None = None,
+                 threshold: int = COMPRESSION_THRESHOLD):
+        self.name = name
+        self.zdict = zdict
+        self.threshold = threshold
+        self.flags = FLAG_COMPRESSED | (FLAG_DICTIONARY if zdict else 0)
+
+    def _compress(self, body: bytes) -> bytes:
+        if self.zdict is None:
+            return zlib.compress(body, LEVEL)
+        c = zlib.compressobj(LEVEL, zdict=self.zdict)
+        return c.compress(body) + c.flush()
+
+    def compress(self, body: bytes, stats: CompressionStats) -> tuple[bytes, int]:
+        """Return the body to send and its header flags. Bodies below the
+        threshold, or that don't get smaller, are returned unchanged"""
+        stats.frames += 1
+        stats.bytes_in += len(body)
+
+        if len(body) < self.threshold:
+            stats.bytes_out += len(body)
+            return body, 0
+
+        start = time.perf_counter()
+        compressed = self._compress(body)
+        stats.seconds += time.perf_counter() - start
+
+        if len(compressed) >= len(body):
+            stats.bytes_out += len(body)
+            return body, 0
+
+        stats.compressed += 1
+        stats.bytes_out += len(compressed)
+        return compressed, self.flags
+
+
+def decompress(body: bytes, flags: int) -> bytes:
+    """Undo Compressor.compress using the flags from the frame header"""
+    d = zlib.decompressobj(zdict=CHAT_DICTIONARY) if flags & FLAG_DICTIONARY \
+        else zlib.decompressobj()
+    data = d.decompress(body, MAX_DECOMPRESSED_SIZE)
+    if d.unconsumed_tail:
+        raise ValueError(f'Frame decompresses to more than {MAX_DECOMPRESSED_SIZE} bytes')
+    return data
+
+
+COMPRESSORS: dict[str, Compressor] = {
+    c.name: c for c in (Compressor(CHAT_DICTIONARY_COMPRESSOR, CHAT_DICTIONARY), Compressor('zlib'))
+}
+
+
+def choose_compressor(names) -> Compressor | None:
+    """Return the first compressor in `names` that is supported"""
+    for name in names:
+        if name in COMPRESSORS:
+            return COMPRESSORS[name]
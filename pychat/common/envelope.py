@@ -0,0 +1,131 @@
+"""Envelopes carry the request uid and routing key of a frame ahead of its
+payload, so a stream can find out who a frame is for without decoding it.
+
+    frame: header | envelope | payload
+    envelope: uid length (B) | uid | routing key length (B) | routing key
+
+The payload is the codec-encoded model without its uid, compressed if the
+header says so. Frames with an envelope have FLAG_ENVELOPE set."""
+import struct
+from typing import Type
+
+from pychat.common.codec import CODECS, Codec
+from pychat.common.compression import (
+    FLAG_COMPRESSED, CompressionStats, Compressor, decompress
+)
+from pychat.common.models import StreamData, id_to_type, serializer_for, type_id_of
+from pychat.common.transport import FRAME_HEADER, HEADER_SIZE
+
+FLAG_ENVELOPE = 0x04
+
+_LENGTH = struct.Struct('>B')
+_NONE = 0xFF  # length marking a missing value
+MAX_KEY_SIZE = _NONE - 1  # bytes
+
+
+def _pack_str(value: str | None) -> bytes:
+    if value is None:
+        return _LENGTH.pack(_NONE)
+    raw = value.encode()
+    if len(raw) > MAX_KEY_SIZE:
+        raise ValueError(f'Envelope value is over {MAX_KEY_SIZE} bytes: {value[:20]}...')
+    return _LENGTH.pack(len(raw)) + raw
+
+
+def _unpack_str(body: bytes | memoryview, pos: int) -> tuple[str | None, int]:
+    n = body[pos]
+    pos += 1
+    if n == _NONE:
+        return None, pos
+    return str(body[pos:pos + n], 'utf-8'), pos + n
+
+
+def pack_envelope(uid: str | None, routing_key: str | None) -> bytes:
+    return _pack_str(uid) + _pack_str(routing_key)
+
+
+def encode_frame(data: StreamData, codec: Codec, compressor: Compressor | None = None,
+                 stats: CompressionStats | None = None) -> bytes:
+    """Encode the StreamData into a frame with an envelope, compressing the
+    payload if a compressor is given"""
+    d = serializer_for(data.__class__).to_dict(data, named=False)
+    envelope = pack_envelope(d.pop('uid', None), data.routing_key)
+    body = codec.dumps(d)
+    flags = 0
+    if compressor is not None:
+        body, flags = compressor.compress(body, stats or CompressionStats())
+
+    header = FRAME_HEADER.pack(
+        flags | FLAG_ENVELOPE, codec.id, type_id_of(data.__class__),
+        len(envelope) + len(body)
+    )
+    return b''.join((header, envelope, body))
+
+
+class Envelope:
+    """A received frame that has only had its envelope read. The payload is
+    decoded into `model` the first time it's needed, which also happens when
+    any other model attribute is read from the envelope"""
+    __slots__ = ('type_', 'uid', 'routing_key', 'flags', 'codec_id', 'payload', '_model')
+
+    def __init__(self, type_: Type[StreamData], flags: int, codec_id: int,
+                 body: bytes | memoryview):
+        self.type_ = type_
+        self.flags = flags
+        self.codec_id = codec_id
+
+        self.uid, pos = _unpack_str(body, 0)
+        self.routing_key, pos = _unpack_str(body, pos)
+        self.payload = body[pos:]
+        self._model: StreamData | None = None
+
+    @classmethod
+    def from_frame(cls, frame: bytes) -> 'Envelope':
+        """Read the envelope of a whole frame, e.g. one created by
+        DataStream.encode_frame once type ids are agreed on"""
+        flags, codec_id, type_id, _ = FRAME_HEADER.unpack_from(frame)
+        if not flags & FLAG_ENVELOPE:
+            raise ValueError('Frame has no envelope')
+        return cls(id_to_type(type_id), flags, codec_id, memoryview(frame)[HEADER_SIZE:])
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}({self.type_.__qualname__}, "
+                f"uid={self.uid!r}, routing_key={self.routing_key!r})")
+
+    def __getattr__(self, name):
+        # special names are looked up by isinstance and friends, which
+        # shouldn't decode the payload
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def detach(self) -> 'Envelope':
+        """Copy the payload out of the receive buffer so the envelope can be
+        kept after the next frame is read"""
+        if isinstance(self.payload, memoryview):
+            self.payload = bytes(self.payload)
+        return self
+
+    @property
+    def model(self) -> StreamData:
+        if self._model is None:
+            payload = self.payload
+            if self.flags & FLAG_COMPRESSED:
+                payload = decompress(payload, self.flags)
+
+            d = CODECS[self.codec_id].loads(payload)
+            if 'uid' in self.type_.__fields__:
+                d['uid'] = self.uid
+            self._model = serializer_for(self.type_).parse(d)
+        return self._model
+
+    def needs_response(self) -> bool:
+        return 'Response' in vars(self.type_)
+
+    def frame(self, type_id: int) -> bytes:
+        """Frame the envelope and its undecoded payload again, to forward it"""
+        envelope = pack_envelope(self.uid, self.routing_key)
+        header = FRAME_HEADER.pack(
+            self.flags, self.codec_id, type_id, len(envelope) + len(self.payload)
+        )
+        return b''.join((header, envelope, self.payload))
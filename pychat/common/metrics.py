@@ -0,0 +1,156 @@
+"""Counters and latency histograms kept by DataStream and the server.
+
+Everything is updated on the hot path, so recording is an attribute
+increment, or a bisect over a short list of fixed bucket bounds for
+histograms. Turning the numbers into percentiles and dicts only happens
+when someone asks for them (GetServerStats)."""
+from bisect import bisect_left
+from typing import Type
+
+# upper bounds of the histogram buckets: 10 us doubling up to about 84 s,
+# plus one bucket for anything slower
+BUCKET_BOUNDS = tuple(1e-5 * 2 ** i for i in range(24))
+
+
+class Histogram:
+    """Durations in seconds, counted in log scale buckets. Percentiles are
+    the upper bound of the bucket they fall in, so within a factor of 2"""
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: 'Histogram'):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p: float) -> float:
+        """The duration `p` percent of observations were at most"""
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return BUCKET_BOUNDS[i] if i < len(BUCKET_BOUNDS) else self.max
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count, 'mean': self.mean, 'max': self.max,
+            'p50': self.percentile(50), 'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+    def __repr__(self):
+        return (f"{self.__class__.__name__}(count={self.count}, "
+                f"mean_ms={self.mean * 1e3:.2f}, p99_ms={self.percentile(99) * 1e3:.2f})")
+
+
+class TypeMetrics:
+    """Traffic of one type of StreamData on a stream"""
+    __slots__ = ('frames_in', 'bytes_in', 'frames_out', 'bytes_out', 'round_trip', 'handler')
+
+    def __init__(self):
+        self.frames_in = self.bytes_in = 0
+        self.frames_out = self.bytes_out = 0
+        self.round_trip: Histogram | None = None  # requests sent, until their response
+        self.handler: Histogram | None = None  # requests received, until handled
+
+    def merge(self, other: 'TypeMetrics'):
+        self.frames_in += other.frames_in
+        self.bytes_in += other.bytes_in
+        self.frames_out += other.frames_out
+        self.bytes_out += other.bytes_out
+        for name in ('round_trip', 'handler'):
+            if (theirs := getattr(other, name)) is not None:
+                if (ours := getattr(self, name)) is None:
+                    ours = Histogram()
+                    setattr(self, name, ours)
+                ours.merge(theirs)
+
+    def to_dict(self) -> dict:
+        d = {
+            'frames_in': self.frames_in, 'bytes_in': self.bytes_in,
+            'frames_out': self.frames_out, 'bytes_out': self.bytes_out,
+        }
+        if self.round_trip is not None:
+            d['round_trip'] = self.round_trip.to_dict()
+        if self.handler is not None:
+            d['handler'] = self.handler.to_dict()
+        return d
+
+
+class StreamMetrics:
+    """Frames and bytes in and out of a DataStream, in total and by type,
+    with round trip and handler times of requests by type"""
+    def __init__(self):
+        self.frames_in = self.bytes_in = 0
+        self.frames_out = self.bytes_out = 0
+        self.by_type: dict[Type, TypeMetrics] = {}
+
+    def of(self, type_: Type) -> TypeMetrics:
+        try:
+            return self.by_type[type_]
+        except KeyError:
+            metrics = self.by_type[type_] = TypeMetrics()
+            return metrics
+
+    def received(self, type_: Type, size: int):
+        self.frames_in += 1
+        self.bytes_in += size
+        metrics = self.of(type_)
+        metrics.frames_in += 1
+        metrics.bytes_in += size
+
+    def sent(self, type_: Type, size: int):
+        self.frames_out += 1
+        self.bytes_out += size
+        metrics = self.of(type_)
+        metrics.frames_out += 1
+        metrics.bytes_out += size
+
+    def round_trip(self, type_: Type, seconds: float):
+        metrics = self.of(type_)
+        if metrics.round_trip is None:
+            metrics.round_trip = Histogram()
+        metrics.round_trip.observe(seconds)
+
+    def handled(self, type_: Type, seconds: float):
+        metrics = self.of(type_)
+        if metrics.handler is None:
+            metrics.handler = Histogram()
+        metrics.handler.observe(seconds)
+
+    def merge(self, other: 'StreamMetrics'):
+        self.frames_in += other.frames_in
+        self.bytes_in += other.bytes_in
+        self.frames_out += other.frames_out
+        self.bytes_out += other.bytes_out
+        for type_, metrics in other.by_type.items():
+            self.of(type_).merge(metrics)
+
+    def to_dict(self) -> dict:
+        return {
+            'frames_in': self.frames_in, 'bytes_in': self.bytes_in,
+            'frames_out': self.frames_out, 'bytes_out': self.bytes_out,
+            # nested types, like Request.Response, by their qualified name
+            'by_type': {t.__qualname__: m.to_dict() for t, m in self.by_type.items()},
+        }
@@ -1,17 +1,51 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
+from pydantic.fields import ModelField, SHAPE_SINGLETON
 import json
 from cryptography.fernet import Fernet
-from typing import Type
+from typing import Any, Callable, Optional, Type
 
+from pychat.common.type_ids import TYPE_IDS
+
+
+# bump when an id in pychat.common.type_ids changes, peers only use type ids
+# in frame headers if they agree on this
+TYPE_ID_VERSION = 1
 
 _MODELS: dict[str, Type[BaseModel]] = {}
+_TYPE_IDS: dict[Type[BaseModel], int] = {}
+_TYPES_BY_ID: dict[int, Type[BaseModel]] = {}
+_SERIALIZERS: dict[Type[BaseModel], 'Serializer'] = {}
+
+# same output as json.dumps(d, indent=None, separators=(', ', ': '))
+_JSON_ENCODER = json.JSONEncoder(separators=(', ', ': '))
+_SCALAR_TYPES = (str, int, float, bool)
+
+
+def register_model(type_: Type[BaseModel]):
+    """Add the model to the registries so that the correct class can be
+    selected when raw data is received. StreamData subclasses register
+    themselves when they are created. Its type id is looked up in
+    pychat.common.type_ids"""
+    name = type_.__qualname__
+    other = _MODELS.get(name)
+    if other is not None and other is not type_:
+        raise TypeError(
+            f'{type_.__module__}.{name} has the same name as '
+            f'{other.__module__}.{other.__qualname__}'
+        )
+    _MODELS[name] = type_
+
+    type_id = TYPE_IDS.get(name)
+    if type_id is not None:
+        _TYPES_BY_ID[type_id] = type_
+        _TYPE_IDS[type_] = type_id
 
 
 def register_models(superclass):
-    """Add all models to the _MODELS dict so that that the correct class
-    can be selected when raw data is received"""
+    """Register all subclasses of the model. Only needed for models that
+    don't inherit from StreamData"""
     for subclass in superclass.__subclasses__():
-        _MODELS[subclass.__qualname__] = subclass
+        register_model(subclass)
         register_models(subclass)
 
 
@@ -21,44 +55,207 @@ def name_to_type(name: str) -> Type[BaseModel]:
     return _MODELS[name]
 
 
-def json_to_model(json_: str | bytes):
-    obj: dict = json.loads(json_)
+def type_id_of(type_: Type[BaseModel]) -> int | None:
+    """None if the model has no type id, it names its type in the body"""
+    return _TYPE_IDS.get(type_)
+
+
+def id_to_type(type_id: int) -> Type[BaseModel]:
+    return _TYPES_BY_ID[type_id]
+
+
+def dict_to_model(obj: dict):
+    """Use the __name__ key of a raw dict to parse it into the correct model"""
     type_ = name_to_type(obj['__name__'])
-    return type_.parse_obj(obj)
+    return serializer_for(type_).parse(obj)
+
+
+def json_to_model(json_: str | bytes):
+    return dict_to_model(json.loads(json_))
+
+
+def serializer_for(type_: Type[BaseModel]) -> 'Serializer':
+    """Return the cached Serializer for the model class, building it the
+    first time it's needed"""
+    try:
+        return _SERIALIZERS[type_]
+    except KeyError:
+        serializer = _SERIALIZERS[type_] = Serializer(type_)
+        return serializer
+
+
+def _dump_value(value):
+    """Convert models nested anywhere in the value to dicts"""
+    if isinstance(value, BaseModel):
+        return serializer_for(type(value)).to_dict(value, named=False)
+    if isinstance(value, (list, tuple, set)):
+        return [_dump_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _dump_value(v) for k, v in value.items()}
+    return value
+
+
+class Serializer:
+    """Converts instances of one model class to and from plain dicts.
+
+    The per-field work is worked out once from the class's fields: scalar
+    fields are copied as they are, nested model fields use the nested class's
+    Serializer, and everything else goes through the pydantic field. Parsing
+    validates like parse_obj, but values that already have the exact type of
+    a scalar field are accepted without calling its validators"""
+
+    def __init__(self, type_: Type[BaseModel]):
+        self.type_ = type_
+        self.name = type_.__qualname__
+        fields: dict[str, ModelField] = type_.__fields__
+
+        self._dumpers: list[tuple[str, Callable | None]] = [
+            (name, None if self._is_scalar(f) else _dump_value)
+            for name, f in fields.items()
+        ]
+        self._loaders: list[tuple[str, ModelField, bool, Callable]] = [
+            (name, f, self._is_scalar(f), self._make_loader(f))
+            for name, f in fields.items()
+        ]
+        self.required = frozenset(name for name, f in fields.items() if f.required)
+
+        # validators could change values in ways the fast path can't know
+        # about, and private attributes need BaseModel.__init__ to set them up
+        self._can_skip_validation = not (
+            type_.__validators__ or type_.__pre_root_validators__
+            or type_.__post_root_validators__ or type_.__private_attributes__
+        )
+
+    @staticmethod
+    def _is_scalar(field: ModelField) -> bool:
+        return field.shape == SHAPE_SINGLETON and field.outer_type_ in _SCALAR_TYPES
+
+    def _make_loader(self, field: ModelField) -> Callable[[Any], Any]:
+        def validate(v):
+            if v is None and field.allow_none:
+                return v
+            v, errors = field.validate(v, {}, loc=field.name, cls=self.type_)
+            if errors:
+                raise ValidationError([errors], self.type_)
+            return v
+
+        if self._is_scalar(field):
+            type_ = field.outer_type_
+            allow_none = field.allow_none
+            return lambda v: v if type(v) is type_ or (v is None and allow_none) \
+                else validate(v)
+
+        if field.shape != SHAPE_SINGLETON:
+            return validate
+
+        # a model, or a union of models which are tried in order like pydantic
+        if field.sub_fields:
+            candidates = [f.outer_type_ for f in field.sub_fields]
+        else:
+            candidates = [field.outer_type_]
+        if not all(isinstance(t, type) and issubclass(t, BaseModel) for t in candidates):
+            return validate
+
+        def load_model(v):
+            if not isinstance(v, dict):
+                return validate(v)
+            for t in candidates:
+                serializer = serializer_for(t)
+                if serializer.required <= v.keys():
+                    try:
+                        return serializer.parse(v)
+                    except ValidationError:
+                        pass
+            return validate(v)
+        return load_model
+
+    def to_dict(self, obj: BaseModel, named: bool = True) -> dict:
+        """Same as obj.dict(), plus the class name under '__name__'"""
+        values = obj.__dict__
+        d = {
+            name: values[name] if dump is None else dump(values[name])
+            for name, dump in self._dumpers
+        }
+        if named:
+            d['__name__'] = self.name
+        return d
+
+    def to_json(self, obj: BaseModel, named: bool = True) -> str:
+        return _JSON_ENCODER.encode(self.to_dict(obj, named))
+
+    def parse(self, d: dict, trusted: bool = False) -> BaseModel:
+        """Create a model from a dict. With `trusted`, scalar values are used
+        as they are without checking their type, for data created by this
+        process"""
+        if not self._can_skip_validation or not self.required <= d.keys():
+            return self.type_.parse_obj(d)
+
+        values = {}
+        for name, field, scalar, load in self._loaders:
+            if name not in d:
+                values[name] = field.get_default()
+            elif trusted and scalar:
+                values[name] = d[name]
+            else:
+                values[name] = load(d[name])
+
+        # what BaseModel.construct does, without looking at each field again
+        m = self.type_.__new__(self.type_)
+        object.__setattr__(m, '__dict__', values)
+        object.__setattr__(m, '__fields_set__', d.keys() & values.keys())
+        return m
 
 
 class StreamData(BaseModel):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        register_model(cls)
+
     def __str__(self):
         return repr(self)
 
+    @property
+    def routing_key(self) -> str | None:
+        """The room (or other key) the data is for, used to route frames
+        without decoding them. None if it isn't for anything in particular"""
+        return None
+
     def json(self, *args, **kwargs):
-        d = self.dict(*args, **kwargs)
-        d['__name__'] = self.__class__.__qualname__
-        return json.dumps(d, indent=None, separators=(', ', ': '))
+        if args or kwargs:
+            d = self.dict(*args, **kwargs)
+            d['__name__'] = self.__class__.__qualname__
+            return _JSON_ENCODER.encode(d)
+        return serializer_for(self.__class__).to_json(self)
 
 
 class Encrypted(StreamData):
     encrypted_type: str
     fernet_id: str
     ciphertext: str = Field(repr=False)
+    epoch: Optional[int]  # of the key exchange that made the key
+
+    @property
+    def routing_key(self) -> str:
+        return self.fernet_id
 
     def decrypt(self, f: Fernet) -> StreamData:
         ciphertext: bytes = self.ciphertext.encode()
         model_type = name_to_type(self.encrypted_type)
 
-        return model_type.parse_raw(f.decrypt(ciphertext))
+        return serializer_for(model_type).parse(json.loads(f.decrypt(ciphertext)))
 
 
 class Encryptable(StreamData):
 
-    def encrypt(self, fernet: Fernet, fernet_id: str) -> Encrypted:
+    def encrypt(self, fernet: Fernet, fernet_id: str, epoch: int | None = None) -> Encrypted:
         json_: bytes = self.json().encode()
         ciphertext: bytes = fernet.encrypt(json_).decode()
 
         return Encrypted(
             encrypted_type=self.__class__.__qualname__,
             fernet_id=fernet_id,
-            ciphertext=ciphertext
+            ciphertext=ciphertext,
+            epoch=epoch
         )
 
 
@@ -72,10 +269,18 @@ class ChatMessage(Encryptable):
     text: str
     room_uid: str
 
+    @property
+    def routing_key(self) -> str:
+        return self.room_uid
+
+
+# what a room's Diffie-Hellman keys are, see pychat.client.diffiehellman
+KEY_BACKENDS = ('ffdh', 'x25519')
+DEFAULT_KEY_BACKEND = 'x25519'
+
 
 class ChatRoom(StreamData):
     uid: str
     name: str
+    key_backend: str = 'ffdh'  # of rooms from before there was a choice
 
-
-register_models(StreamData)
@@ -1,22 +1,227 @@
 import asyncio
-from collections import defaultdict
+from collections import deque
+from enum import Enum, auto
 from inspect import iscoroutinefunction
+from typing import Any, Callable, Hashable
+import weakref
+
+DISPATCH_WORKERS = 4  # coroutine subscribers running at once
+DISPATCH_QUEUE_SIZE = 256  # events queued per coroutine subscriber
+
+Topic = tuple[type, Hashable]
+
+
+class Overflow(Enum):
+    """What publish does with an event for a coroutine subscriber whose queue
+    is full. publish_wait waits for room either way"""
+    DROP = auto()  # drop the event, for events that are only worth it when fresh
+    KEEP = auto()  # queue it anyway, for events that must not be lost
+
+
+class Subscription:
+    """Handle returned by PubSub.subscribe, unsubscribe with it"""
+    def __init__(self, pubsub: 'PubSub', topic: Topic, callback: Callable, weak: bool,
+                 overflow: Overflow = Overflow.DROP):
+        self.topic = topic
+        self.is_coroutine = iscoroutinefunction(callback)
+        self.overflow = overflow
+        self._pubsub = weakref.ref(pubsub)
+
+        # events waiting for a coroutine callback, run one at a time in order
+        self.pending: deque = deque()
+        self.running = False
+        self.dropped = 0  # the queue was full, with Overflow.DROP
+        self.delayed = 0  # had to wait for earlier events
+
+        if weak:
+            # bound methods need WeakMethod, a plain ref to one dies at once
+            ref_type = weakref.WeakMethod if hasattr(callback, '__self__') else weakref.ref
+            self._ref = ref_type(callback, lambda _: self.unsubscribe())
+        else:
+            self._ref = lambda: callback
+
+    @property
+    def callback(self) -> Callable | None:
+        """None once a weakly held callback has been garbage collected"""
+        return self._ref()
+
+    def unsubscribe(self):
+        pubsub = self._pubsub()
+        if pubsub is not None:
+            pubsub.unsubscribe(self)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.topic}, {self.callback!r})"
 
 
 class PubSub:
-    def __init__(self):
-        self.subscribers = defaultdict(set)
+    """Calls the subscribers of an event when it's published. Subscribers
+    are kept by topic: the event's class and optionally a key, such as a room
+    uid. Events give their key with a `topic_key` attribute, and an event is
+    delivered to the subscribers of its key and to those of any key (None)
+
+    Plain callbacks are called straight away. Coroutine callbacks are queued
+    per subscriber, up to `queue_size` events, and run by `workers` worker
+    tasks, which exit once there's nothing left to run. A subscriber's events
+    are handled one at a time in the order they were published, so at most
+    `workers` callbacks run at once. When a subscriber's queue is full,
+    publish does what its Overflow policy says, publish_wait waits for room"""
+    def __init__(self, workers: int = DISPATCH_WORKERS,
+                 queue_size: int = DISPATCH_QUEUE_SIZE):
+        self.subscribers: dict[Topic, dict[Subscription, None]] = {}
+
+        self.workers = workers
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.delayed = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    def subscribe(self, trigger_type: type, callback: Callable[[Any], Any],
+                  key: Hashable = None, weak: bool = False,
+                  overflow: Overflow = Overflow.DROP) -> Subscription:
+        """Call `callback` with the events of `trigger_type` for `key`, or all
+        of them if key is None. With `weak`, the subscription doesn't keep the
+        callback (or the object of a bound method) alive, and is removed when
+        it's garbage collected. `overflow` only applies to coroutine callbacks"""
+        sub = Subscription(self, (trigger_type, key), callback, weak, overflow)
+        self.subscribers.setdefault(sub.topic, {})[sub] = None
+        return sub
 
-    def subscribe(self, trigger_type, callback):
-        self.subscribers[trigger_type].add(callback)
+    def unsubscribe(self, sub: Subscription):
+        subs = self.subscribers.get(sub.topic)
+        if subs is not None:
+            subs.pop(sub, None)
+            if not subs:
+                del self.subscribers[sub.topic]
+
+    def _subscribers_of(self, trigger) -> list[Subscription]:
+        key = getattr(trigger, 'topic_key', None)
+        subs = list(self.subscribers.get((trigger.__class__, None), ()))
+        if key is not None:
+            subs += self.subscribers.get((trigger.__class__, key), ())
+        return subs
 
     def publish(self, trigger,):
         """Publish the trigger event to subscribers."""
+        for sub in self._subscribers_of(trigger):
+            if sub.is_coroutine:
+                if not self._queue_nowait(sub, trigger, sub.overflow is Overflow.KEEP):
+                    sub.dropped += 1
+                    self.dropped += 1
+                continue
+            callback = sub.callback
+            if callback is not None:
+                callback(trigger)
 
-        event_type = trigger.__class__
-
-        for callback in self.subscribers[event_type]:
-            if iscoroutinefunction(callback):
-                asyncio.create_task(callback(trigger))
-            else:
+    async def publish_wait(self, trigger):
+        """Like publish, waiting for room in the queues of coroutine
+        subscribers instead of dropping the event"""
+        for sub in self._subscribers_of(trigger):
+            if sub.is_coroutine:
+                while not self._queue_nowait(sub, trigger):
+                    self._space.clear()
+                    await self._space.wait()
+                continue
+            callback = sub.callback
+            if callback is not None:
                 callback(trigger)
+
+    def _start(self, loop: asyncio.AbstractEventLoop):
+        """Set up the dispatch queue and workers' state on the running loop"""
+        self._loop = loop
+        self._ready: asyncio.Queue[Subscription] = asyncio.Queue()
+        self._worker_tasks: set[asyncio.Task] = set()
+        self._running_workers = 0  # until their loop ends, before the task is done
+        self._unfinished = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._space = asyncio.Event()  # set when an event has been handled
+        for subs in self.subscribers.values():  # left over from another loop
+            for sub in subs:
+                sub.pending.clear()
+                sub.running = False
+
+    def _queue_nowait(self, sub: Subscription, trigger, force: bool = False) -> bool:
+        """Queue the event for a coroutine subscriber. Returns False if its
+        queue is full, unless `force`"""
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._start(loop)
+
+        if len(sub.pending) >= self.queue_size and not force:
+            return False
+        if sub.running:
+            sub.delayed += 1
+            self.delayed += 1
+
+        sub.pending.append(trigger)
+        self._unfinished += 1
+        self._idle.clear()
+        if not sub.running:
+            sub.running = True
+            self._ready.put_nowait(sub)
+
+        if not self._ready.empty() and self._running_workers < self.workers:
+            self._running_workers += 1
+            task = asyncio.create_task(self._work())
+            self._worker_tasks.add(task)
+            task.add_done_callback(self._worker_tasks.discard)
+        return True
+
+    async def _work(self):
+        ready = self._ready
+        try:
+            while not ready.empty():
+                sub = ready.get_nowait()
+                trigger = sub.pending.popleft()
+                callback = sub.callback
+                try:
+                    if callback is not None:
+                        await callback(trigger)
+                except Exception as exc:
+                    asyncio.get_running_loop().call_exception_handler({
+                        'message': f'{sub} failed on {trigger!r}',
+                        'exception': exc,
+                    })
+                finally:
+                    if ready is self._ready:  # or it was closed in the meantime
+                        self._done(sub)
+        finally:
+            # in the same step the loop ends, so an event published right
+            # after starts a new worker
+            if ready is self._ready:
+                self._running_workers -= 1
+
+    def _done(self, sub: Subscription):
+        if sub.pending:
+            self._ready.put_nowait(sub)  # behind the subscribers already waiting
+        else:
+            sub.running = False
+
+        self._unfinished -= 1
+        if not self._unfinished:
+            self._idle.set()
+        self._space.set()
+
+    async def join(self):
+        """Wait until every queued event has been handled"""
+        if self._loop is not None:
+            await self._idle.wait()
+
+    def close(self):
+        """Stop running coroutine callbacks and drop the events still queued
+        for them"""
+        if self._loop is None:
+            return
+        for task in self._worker_tasks:
+            task.cancel()
+        self._worker_tasks = set()
+        self._running_workers = 0
+        for subs in self.subscribers.values():
+            for sub in subs:
+                sub.pending.clear()
+                sub.running = False
+        self._ready = asyncio.Queue()
+        self._unfinished = 0
+        self._idle.set()
+        self._space.set()
@@ -2,6 +2,7 @@ from pydantic import Field
 from typing import Optional
 
 from pychat.common import models
+from pychat.common.sealed import Sealed
 from pychat.common.utils import make_uid
 
 
@@ -22,9 +23,29 @@ class Error(Response):
     reason: str
 
 
+# connection setup
+class Handshake(Request):
+    codecs: list[str]
+    compression: list[str] = []
+    type_ids: Optional[int]  # models.TYPE_ID_VERSION
+    sealed: bool = False  # the client can read Sealed messages
+
+    class Response(Response):
+        codec: str
+        compression: Optional[str]
+        type_ids: Optional[int]
+        sealed: bool = False
+
+
 # diffie hellman
 class KeyRequest(Request):
     fernet_uid: str
+    epoch: Optional[int]  # of the exchange, the room's keys are kept by epoch
+    seal: bool = False  # every member reads Sealed, send them with this key
+
+    @property
+    def routing_key(self) -> str:
+        return self.fernet_uid
 
 class GetDHKey(KeyRequest):
     pass
@@ -45,15 +66,54 @@ class RegenerateDHKeyPair(KeyRequest):
     class Response(Response):
         pass
 
+# tree group key agreement, see pychat.server.keytree
+class RefreshTreeKey(KeyRequest):
+    """Ask the sponsor of a tree change to pick a new leaf secret and send
+    back the blinded keys of the nodes on its path"""
+    co_path: list[int] = Field(repr=False)  # leaf level first
+    to_root: bool = True  # or stops short where a sibling isn't known yet
+    new_leaf: bool = True  # False when asked again in the same exchange
+
+    class Response(Response):
+        leaf_key: int = Field(repr=False)
+        path_keys: list[int] = Field(repr=False)  # leaf's parent first, never the root
+
+class PostTreeKeys(KeyRequest):
+    """Send a member its co-path to work out the new room key"""
+    co_path: list[int] = Field(repr=False)
+
 
 # messaging requests
 class PostMessage(Request):
-    message: models.ChatMessage | models.Encrypted
+    # Sealed first, a dict of it also has every field Encrypted needs
+    message: models.ChatMessage | Sealed | models.Encrypted
+
+    @property
+    def routing_key(self) -> str:
+        return self.message.routing_key
+
+
+class GetHistory(Request):
+    """Ask for a page of a room's messages. They're sent as PostMessages,
+    oldest first, before the response"""
+    room_uid: str
+    before: Optional[int]  # seq, the newest messages if not set
+    since: Optional[float]  # unix time
+    limit: int = 50
+
+    @property
+    def routing_key(self) -> str:
+        return self.room_uid
+
+    class Response(Response):
+        first_seq: Optional[int]  # pass as `before` for the page before this one
+        count: int = 0
 
 
 # room creation / joining
 class CreateRoom(Request):
     room_name: str
+    key_backend: str = models.DEFAULT_KEY_BACKEND
 
     class Response(Response):
         room: models.ChatRoom
@@ -64,7 +124,15 @@ class JoinRoom(Request):
     invite_code: str
 
     class Response(Response):
-        room: models.ChatRoom
+        room: Optional[models.ChatRoom]  # not set if the invite code is unknown
+
 
+# operations
+class GetServerStats(Request):
+    """Ask for the server's counters and latency histograms, see
+    pychat.common.metrics. Only answered by servers started with
+    `remote_stats`"""
+
+    class Response(Response):
+        stats: dict
 
-models.register_models(models.StreamData)
@@ -1,124 +1,573 @@
 import asyncio
 from asyncio.exceptions import IncompleteReadError
-from inspect import iscoroutine
-from typing import Callable, Type, Optional, Union, Coroutine
+from collections import deque
+from enum import Enum
+from functools import partial
+from inspect import iscoroutine, iscoroutinefunction
+import time
+from typing import Callable, Hashable, Iterable, Type, Optional, Union, Coroutine
 
-from pychat.common.models import json_to_model, StreamData
-from pychat.common.request import Request, Response
+from pychat.common.codec import Codec, CODECS, JSON, codec_by_name, choose_codec
+from pychat.common.compression import (
+    Compressor, CompressionStats, COMPRESSORS, FLAG_COMPRESSED,
+    choose_compressor, decompress
+)
+from pychat.common.envelope import FLAG_ENVELOPE, Envelope, encode_frame
+from pychat.common.metrics import StreamMetrics
+from pychat.common.models import StreamData, TYPE_ID_VERSION, id_to_type, type_id_of
+from pychat.common.request import Request, Response, Handshake
+from pychat.common.transport import (
+    FRAME_HEADER, HEADER_SIZE, MAX_FRAME_SIZE, Frame, FrameProtocol, check_frame_size
+)
 
 # network settings
 SERVER_IP = '127.0.0.1'
 PORT = 8888
-HEADER_SIZE = 6  # bytes
+PREFERRED_CODECS = ('binary', 'json')
+COMPRESSION: tuple[str, ...] = ()  # opt in with e.g. ('zlib-chat2', 'zlib')
+OUTBOUND_QUEUE_SIZE = 1024  # frames
+REQUEST_TIMEOUT = 30  # seconds
 
 RequestType = Type[Request]
 RequestHandler = Callable[[Request], None | Response]
 RequestTypeAndHandler = tuple[RequestType, RequestHandler]
-      
+OrderKey = Callable[[Request], Hashable]
+ResponseCallback = Callable[[Response], None]
+
+
+class OverflowPolicy(Enum):
+    """What DataStream.write does when the outbound queue is full"""
+    BLOCK = 'block'  # wait for the writer task to make room
+    DROP_OLDEST = 'drop_oldest'  # discard the oldest queued broadcast frame
+    DISCONNECT = 'disconnect'  # close the connection to the slow consumer
+
+
+class RequestWaiters:
+    """Futures of Requests awaiting a Response, keyed by request uid and kept
+    in the order they were added so the oldest is always first. A waiter that
+    passes its deadline fails with asyncio.TimeoutError"""
+    def __init__(self):
+        self._waiters: dict[str, tuple[asyncio.Future, float]] = {}
+        self._deadlines: dict[str, asyncio.TimerHandle] = {}
+        self._callbacks: dict[str, ResponseCallback] = {}
+
+    def __len__(self):
+        return len(self._waiters)
+
+    def __contains__(self, uid: str):
+        return uid in self._waiters
+
+    @property
+    def oldest_age(self) -> float:
+        """Seconds the oldest in-flight request has been waiting"""
+        for _, started in self._waiters.values():
+            return time.monotonic() - started
+        return 0.0
+
+    def add(self, uid: str, timeout: float | None = None,
+            on_response: ResponseCallback | None = None) -> asyncio.Future:
+        """Wait for the response to request `uid`. `on_response` is called
+        with it as soon as it's read, before any later frame is handled"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._waiters[uid] = (future, time.monotonic())
+        if on_response is not None:
+            self._callbacks[uid] = on_response
+
+        if timeout is not None:
+            self._deadlines[uid] = loop.call_later(timeout, self._expire, uid)
+        return future
+
+    def _expire(self, uid: str):
+        del self._deadlines[uid]
+        future, _ = self._waiters[uid]
+        if not future.done():
+            future.set_exception(asyncio.TimeoutError(f'No response to request {uid}'))
+
+    def remove(self, uid: str) -> float:
+        """Stop waiting for a response and return how long it was waited on"""
+        if (deadline := self._deadlines.pop(uid, None)) is not None:
+            deadline.cancel()
+        self._callbacks.pop(uid, None)
+        _, started = self._waiters.pop(uid)
+        return time.monotonic() - started
+
+    def resolve(self, resp: Response) -> bool:
+        """Set the waiter for the response. Returns False if nothing is waiting
+        for it anymore (e.g. the request timed out)"""
+        future, _ = self._waiters.get(resp.uid, (None, None))
+        if future is None or future.done():
+            return False
+
+        callback = self._callbacks.pop(resp.uid, None)
+        try:
+            if callback is not None:
+                callback(resp)
+        except Exception as exc:
+            future.set_exception(exc)  # raised to the requester
+        else:
+            future.set_result(resp)
+        return True
+
+    def fail_all(self, exc: BaseException):
+        for future, _ in self._waiters.values():
+            if not future.done():
+                future.set_exception(exc)
+
 
 class DataStream:
     """High-level facade to asyncio StreamReader and StreamWriter.
-    Handles sending and receiving json to a paired stream. (server or client)"""
-    def __init__(self, reader, writer):
+    Handles sending and receiving StreamData to a paired stream. (server or client)
+    Frames are written with `codec`, and compressed with `compressor` if set,
+    which both sides agree on with a Handshake. Once the Handshake has agreed
+    on `type_ids`, frame headers carry the type id instead of the body naming
+    its type, and an envelope with the request uid and routing key comes before
+    the body. Requests registered as `lazy` are handed to their handler as an
+    Envelope, so they can be routed and forwarded without decoding the body.
+
+    Written frames go into a bounded outbound queue which a writer task drains,
+    so a slow reader on the other end only holds up its own stream. `overflow`
+    decides what happens when the queue is full. Only broadcast frames are
+    ever dropped, requests and responses wait for room instead.
+
+    With `max_concurrent_requests` above 1, request handlers run as tasks so a
+    slow handler doesn't hold up later frames. Requests that share an order key
+    (by default their type) are still handled one at a time, in order. Plain
+    function handlers have nothing to overlap with, and are still called as
+    their frame is read unless a request with the same key is waiting
 
-        self.reader: asyncio.StreamReader = reader
+    With `metrics`, frames and bytes in and out, request round trips and
+    handler times are counted in `metrics`, see pychat.common.metrics"""
+    def __init__(self, reader: asyncio.StreamReader | FrameProtocol,
+                 writer, codec: Codec = JSON,
+                 queue_size: int = OUTBOUND_QUEUE_SIZE,
+                 overflow: OverflowPolicy = OverflowPolicy.BLOCK,
+                 max_concurrent_requests: int = 1,
+                 metrics: bool = True):
+
+        self.reader = reader
         self.writer: asyncio.StreamWriter = writer
+        self.codec = codec
+        self.compressor: Compressor | None = None
+        self.compression_stats = CompressionStats()
+        self.type_ids = False
+        self.sealed = False  # both sides agreed the client reads Sealed messages
+        self.metrics: StreamMetrics | None = StreamMetrics() if metrics else None
+
+        self.overflow = overflow
+        self.frames_dropped = 0
+        self.queue_size = queue_size
+        # frames, and whether they can be dropped (broadcasts)
+        self._outbound: deque[tuple[bytes, bool]] = deque()
+        self._frames_queued = asyncio.Event()
+        self._space = asyncio.Event()  # set when the writer task takes frames
+        self._writer_task: asyncio.Task | None = None
+        self._closed: asyncio.Event | None = None  # set once close_connection is done
+        self._close_task: asyncio.Task | None = None
 
-        self.request_waiters: dict[str, asyncio.Future] = {}
+        self.request_waiters = RequestWaiters()
         self.request_handlers: dict[RequestType, RequestHandler] = {}
+        self._lazy_types: set[RequestType] = set()
+
+        self.max_concurrent_requests = max_concurrent_requests
+        self._order_keys: dict[RequestType, OrderKey] = {}
+        self._order_tails: dict[Hashable, asyncio.Task] = {}
+        self._handler_tasks: set[asyncio.Task] = set()
+        self._handler_slots = asyncio.Semaphore(max_concurrent_requests)
+
+        self.register_request_handler(Handshake, self.on_handshake)
 
         self.peername = self.writer.get_extra_info('peername')
 
     def __repr__(self):
         return f"{self.__class__.__name__}{self.peername}"
 
-    async def _handle_request(self, request: Request):
+    @staticmethod
+    def _type_of(data: StreamData | Envelope) -> Type[StreamData]:
+        return data.type_ if isinstance(data, Envelope) else data.__class__
+
+    async def _handle_request(self, request: Request | Envelope):
         """Call the request handler callback with the request as an argument.
         If the request handler returned a Response, write the response back to
         the paired stream."""
-        cb = self.request_handlers[type(request)]
+        type_ = self._type_of(request)
+        cb = self.request_handlers.get(type_)
+        if cb is None:
+            await self._reject_unhandled(request)
+            return
+        started = time.perf_counter()
         resp: None | Response | Coroutine = cb(request)
 
         # if the handler returned a coroutine, await it
         if iscoroutine(resp):
             resp: None | Response = await resp
+        if self.metrics is not None:
+            self.metrics.handled(type_, time.perf_counter() - started)
         
         # send any response back to the requester
         if isinstance(resp, Response):
             resp.uid = request.uid
             await self.write(resp)
 
+    async def _reject_unhandled(self, request: Request | Envelope):
+        """Answer a request this stream has no handler for with an error, so
+        the requester doesn't wait for its timeout"""
+        type_ = self._type_of(request)
+        if not request.needs_response():
+            print(f"{self} dropped {type_.__qualname__}, it has no handler")
+            return
+        resp = Response(error=f'{type_.__qualname__} is not handled here')
+        resp.uid = request.uid
+        await self.write(resp)
+
+    async def _dispatch_request(self, request: Request | Envelope):
+        """Handle the request inline, or in a task when concurrent dispatch is
+        enabled. Waits for a free slot so a client can't queue up unlimited
+        handlers"""
+        if self.max_concurrent_requests <= 1:
+            await self._handle_request(request)
+            return
+
+        type_ = self._type_of(request)
+        order_key = self._order_keys.get(type_)
+        key = (type_, order_key(request)) if order_key else type_
+
+        cb = self.request_handlers.get(type_)
+        if key not in self._order_tails and not iscoroutinefunction(cb):
+            # keeps its place among the responses read after it
+            await self._handle_request(request)
+            return
+
+        await self._handler_slots.acquire()
+
+        # chain the task after the last one with the same key
+        task = asyncio.create_task(
+            self._handle_request_after(request, self._order_tails.get(key))
+        )
+        self._order_tails[key] = task
+        self._handler_tasks.add(task)
+        task.add_done_callback(partial(self._on_handler_done, key))
+
+    async def _handle_request_after(self, request: Request | Envelope, previous: asyncio.Task | None):
+        if previous is not None:
+            await asyncio.wait((previous,))
+        await self._handle_request(request)
+
+    def _on_handler_done(self, key: Hashable, task: asyncio.Task):
+        self._handler_slots.release()
+        self._handler_tasks.discard(task)
+        if self._order_tails.get(key) is task:
+            del self._order_tails[key]
+
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            asyncio.get_running_loop().call_exception_handler({
+                'message': f'Request handler failed on {self}',
+                'exception': exc,
+                'task': task,
+            })
+
     def _handle_response(self, resp: Response):
         """Handle a response to a specific Request by setting the awaiting
-        Request waiter Future with the Response StreamData"""
-        resp_future = self.request_waiters[resp.uid]
-        resp_future.set_result(resp)
-
-    async def _read(self) -> StreamData:
-        """parse the json data from stream into a StreamData object"""
-        # get body length from header
-        body_length = int.from_bytes(
-            bytes=await self.reader.readexactly(HEADER_SIZE),
-            byteorder='big'
-        )
-        body: bytes = await self.reader.readexactly(body_length)
+        Request waiter Future with the Response StreamData. Responses that
+        arrive after their request timed out are dropped"""
+        self.request_waiters.resolve(resp)
+
+    async def _read_frame(self) -> Frame:
+        if isinstance(self.reader, FrameProtocol):
+            return await self.reader.read_frame()
 
-        return json_to_model(body)
+        header = FRAME_HEADER.unpack(await self.reader.readexactly(HEADER_SIZE))
+        check_frame_size(header, MAX_FRAME_SIZE)
+        return header, await self.reader.readexactly(header[-1])
 
-    async def write(self, data: StreamData) -> Optional[Response]:
+    async def _read(self) -> StreamData | Envelope:
+        """parse the frame data from stream into a StreamData object. Requests
+        without a handler and lazy requests are returned as an undecoded
+        Envelope"""
+        (flags, codec_id, type_id, _), body = await self._read_frame()
+        size = HEADER_SIZE + len(body)
+
+        type_ = None
+        if type_id:
+            type_ = id_to_type(type_id)
+            if self.metrics is not None:
+                self.metrics.received(type_, size)
+
+        if flags & FLAG_ENVELOPE:
+            envelope = Envelope(type_, flags, codec_id, body)
+            # unhandled requests are only answered by uid, don't decode them
+            if type_ in self._lazy_types or (
+                    issubclass(type_, Request) and type_ not in self.request_handlers):
+                return envelope.detach()
+            return envelope.model
+
+        if flags & FLAG_COMPRESSED:
+            body = decompress(body, flags)
+
+        data = CODECS[codec_id].decode(body, type_)
+        if type_ is None and self.metrics is not None:
+            self.metrics.received(data.__class__, size)  # the body named its type
+        return data
+
+    def encode_frame(self, data: StreamData | Envelope) -> bytes:
+        """Encode and compress the StreamData, and prepend the frame header.
+        An Envelope is forwarded as it is if this stream can, otherwise its
+        model is encoded again"""
+        if isinstance(data, Envelope):
+            if self.type_ids and data.codec_id == self.codec.id:
+                return data.frame(type_id_of(data.type_))
+            data = data.model
+
+        if not self.type_ids or type_id_of(data.__class__) is None:
+            body: bytes = self.codec.encode(data)
+            flags = 0
+            if self.compressor is not None:
+                body, flags = self.compressor.compress(body, self.compression_stats)
+            return FRAME_HEADER.pack(flags, self.codec.id, 0, len(body)) + body
+
+        return encode_frame(data, self.codec, self.compressor, self.compression_stats)
+
+    async def write(self, data: StreamData | Envelope,
+                    timeout: float | None = REQUEST_TIMEOUT,
+                    on_response: ResponseCallback | None = None) -> Optional[Response]:
         """Send the StreamData to the paired stream. If the StreamData is
         an instance of Request and the Request expects a response, await the
-        Response object"""
+        Response object. Raises asyncio.TimeoutError if no response arrives
+        within `timeout` seconds, or ConnectionResetError if the connection
+        closes first. `on_response` is called with the response before the
+        frames after it are handled, for state they depend on (e.g. the room
+        a JoinRoom response is for)"""
 
-        body: bytes = data.json().encode()
-        header: bytes = len(body).to_bytes(HEADER_SIZE, 'big')
+        frame: bytes = self.encode_frame(data)
+        type_ = self._type_of(data)
 
-        self.writer.writelines([header, body])
-        await self.writer.drain()
-
-        if not isinstance(data, Request) or not data.needs_response():
+        if not issubclass(type_, Request) or not data.needs_response():
+            await self._send(frame)
+            if self.metrics is not None:
+                self.metrics.sent(type_, len(frame))
             return
         
-        request: Request = data
+        request: Request | Envelope = data
 
-        # add a future to request waiters to be set when a response is received
-        response = asyncio.Future()
-        self.request_waiters[request.uid] = response
+        # add a future to request waiters to be set when a response is received,
+        # before sending so that a fast response can't beat it
+        response = self.request_waiters.add(request.uid, timeout, on_response)
 
         # wait for the response future to be set
         try:
-            await response
+            await self._send(frame)
+            if self.metrics is not None:
+                self.metrics.sent(type_, len(frame))
+            return await response
         finally:
-            del self.request_waiters[request.uid]
+            waited = self.request_waiters.remove(request.uid)
+            if self.metrics is not None and response.done() and not response.cancelled() \
+                    and response.exception() is None:
+                self.metrics.round_trip(type_, waited)
+
+    @property
+    def frame_format(self) -> Hashable:
+        """Streams with the same frame format write identical frames for the
+        same StreamData"""
+        return self.codec.id, self.type_ids, self.compressor
 
-        return response.result()
+    async def _send(self, frame: bytes, droppable: bool = False):
+        """Put a frame in the outbound queue, applying the overflow policy
+        if the queue is full"""
+        while not self._send_nowait(frame, droppable):
+            self._space.clear()
+            await self._space.wait()
+
+    def _send_nowait(self, frame: bytes, droppable: bool = False) -> bool:
+        """Put a frame in the outbound queue without waiting. Returns False
+        if the queue is full and the frame has to wait for room. Only
+        `droppable` frames are discarded by the DROP_OLDEST policy"""
+        if self.writer.is_closing() or self._closed is not None:
+            raise ConnectionResetError(f'{self} is closed')
+
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._write_frames())
+
+        queue = self._outbound
+        if len(queue) < self.queue_size:
+            pass
+        elif self.overflow is OverflowPolicy.BLOCK:
+            return False
+        elif self.overflow is OverflowPolicy.DROP_OLDEST:
+            if not self._drop_oldest():
+                if not droppable:
+                    return False
+                self.frames_dropped += 1  # it's the oldest broadcast frame itself
+                return True
+        elif self.overflow is OverflowPolicy.DISCONNECT:
+            self.frames_dropped += 1
+            if self._close_task is None:
+                self._close_task = asyncio.create_task(self.close_connection())
+            raise ConnectionResetError(f'{self} is too slow, disconnecting')
+
+        queue.append((frame, droppable))
+        self._frames_queued.set()
+        return True
+
+    def _drop_oldest(self) -> bool:
+        """Discard the oldest queued frame that can be dropped. Returns False
+        if there isn't one"""
+        for i, (_, droppable) in enumerate(self._outbound):
+            if droppable:
+                del self._outbound[i]
+                self.frames_dropped += 1
+                return True
+        return False
+
+    def _take_frames(self) -> list[bytes]:
+        frames = [frame for frame, _ in self._outbound]
+        self._outbound.clear()
+        self._space.set()
+        return frames
+
+    async def _write_frames(self):
+        """Drain the outbound queue. Every frame queued while the last write
+        was draining is coalesced into a single writelines call"""
+        try:
+            while True:
+                if not self._outbound:
+                    self._frames_queued.clear()
+                    await self._frames_queued.wait()
+                    continue
+
+                self.writer.writelines(self._take_frames())
+                await self.writer.drain()
+        except OSError:
+            pass  # connection lost, listen() will close the stream
 
     async def listen(self):
         """Read and handle Request and Responses"""
         try:
             while True:
-                data: StreamData = await self._read()
+                data: StreamData | Envelope = await self._read()
                 if isinstance(data, Response):
                     self._handle_response(data)
-                elif isinstance(data, Request):
-                    await self._handle_request(data)
+                elif isinstance(data, (Request, Envelope)):
+                    await self._dispatch_request(data)
         except (OSError, IncompleteReadError, ConnectionResetError) as e:
             pass
         finally:
             await self.close_connection()
     
-    def register_request_handler(self, type_: RequestType, cb: RequestHandler):
+    def register_request_handler(self, type_: RequestType, cb: RequestHandler,
+                                 order_by: OrderKey | None = None, lazy: bool = False):
         """Configure a callback to use when receiving Requests of the specified
-        type. The callback can be sync or async"""
+        type. The callback can be sync or async. With concurrent dispatch,
+        `order_by` narrows ordering from the whole type to requests of the type
+        that return the same key (e.g. the same room). A `lazy` handler is
+        called with an Envelope, which only decodes the request when a field
+        other than uid or routing_key is read"""
         self.request_handlers[type_] = cb
+        if order_by is not None:
+            self._order_keys[type_] = order_by
+        if lazy:
+            self._lazy_types.add(type_)
     
     def register_request_handlers(self, *handlers: tuple[RequestTypeAndHandler]):
         """Convencience function to multiple multiple request handlers with
-        a single function call"""
-        for type_, handler in handlers:
-            self.register_request_handler(type_, handler)
+        a single function call. Each handler tuple may end with an order key"""
+        for type_, handler, *order_by in handlers:
+            self.register_request_handler(type_, handler, *order_by)
+
+    async def handshake(self, codecs=PREFERRED_CODECS, compression=COMPRESSION,
+                        sealed: bool = True):
+        """Offer codecs and compressors (in order of preference) to the paired
+        stream and start writing with the ones it picks. With `sealed`, tell
+        it Sealed messages can be read on this side"""
+        resp: Handshake.Response = await self.write(Handshake(
+            codecs=list(codecs), compression=list(compression),
+            type_ids=TYPE_ID_VERSION, sealed=sealed
+        ))
+        self.codec = codec_by_name(resp.codec)
+        self.compressor = COMPRESSORS.get(resp.compression)
+        self.type_ids = resp.type_ids == TYPE_ID_VERSION
+        self.sealed = resp.sealed
+
+    def on_handshake(self, r: Handshake) -> Handshake.Response:
+        """Pick the first offered codec and compressor that are supported.
+        Frames written before the switch can still be read since each header
+        names its codec, compression and type"""
+        self.codec = choose_codec(r.codecs) or JSON
+        self.compressor = choose_compressor(r.compression)
+        self.type_ids = r.type_ids == TYPE_ID_VERSION
+        self.sealed = r.sealed
+        return Handshake.Response(
+            codec=self.codec.name,
+            compression=self.compressor and self.compressor.name,
+            type_ids=TYPE_ID_VERSION if self.type_ids else None,
+            sealed=self.sealed
+        )
 
     async def close_connection(self):
+        """Close the stream. Closing it again only waits for the first close
+        to finish"""
+        if self._closed is not None:
+            await self._closed.wait()
+            return
+        self._closed = asyncio.Event()
+
+        self.request_waiters.fail_all(ConnectionResetError(f'{self} closed'))
+
+        for task in self._handler_tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+
+        # hand any frames still queued to the transport, which flushes on close,
+        # and wake up writers waiting for room so they see the stream is closed
+        frames = self._take_frames()
+        if frames and not self.writer.is_closing():
+            self.writer.writelines(frames)
+
         self.writer.close()
-        await self.writer.wait_closed()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass  # the other end went away first
+        finally:
+            self._closed.set()
         print(f"Closed connection to {self}")
+
+
+async def broadcast(streams: Iterable[DataStream], data: StreamData | Envelope) -> int:
+    """Write data that doesn't expect a response to every stream. The data is
+    encoded once per frame format rather than once per stream, and the same
+    frame is queued on each stream. Streams that are closed or disconnected
+    by their overflow policy are skipped. Returns the number of streams the
+    frame was queued on"""
+    if issubclass(DataStream._type_of(data), Request) and data.needs_response():
+        raise ValueError(f'Can only broadcast requests without a response, not {data!r}')
+
+    frames: dict[Hashable, bytes] = {}
+    blocked: list[tuple[DataStream, bytes]] = []
+    sent = 0
+
+    type_ = DataStream._type_of(data)
+    for stream in streams:
+        key = stream.frame_format
+        if (frame := frames.get(key)) is None:
+            frame = frames[key] = stream.encode_frame(data)
+        try:
+            if stream._send_nowait(frame, droppable=True):
+                sent += 1
+            else:
+                blocked.append((stream, frame))
+        except ConnectionResetError:
+            continue
+        if stream.metrics is not None:
+            stream.metrics.sent(type_, len(frame))
+
+    # only streams with a full queue and the blocking policy are waited on
+    if blocked:
+        results = await asyncio.gather(
+            *[s._send(frame, droppable=True) for s, frame in blocked], return_exceptions=True
+        )
+        sent += sum(not isinstance(r, BaseException) for r in results)
+    return sent
@@ -0,0 +1,261 @@
+"""Frame transport built on asyncio.BufferedProtocol. Frames are received into
+one reusable buffer and handed to DataStream as memoryview slices, instead of
+StreamReader allocating new bytes for every header and body."""
+import asyncio
+from asyncio.exceptions import IncompleteReadError
+import struct
+from typing import Awaitable, Callable
+
+FRAME_HEADER = struct.Struct('>BBHI')  # flags, codec id, type id, body length
+HEADER_SIZE = FRAME_HEADER.size  # bytes
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # bytes, not counting the header
+BUFFER_SIZE = 256 * 1024  # bytes
+MIN_READ_SIZE = 64 * 1024  # bytes
+
+Header = tuple[int, ...]
+Frame = tuple[Header, memoryview | bytes]
+
+
+class FrameTooLarge(ConnectionError):
+    pass
+
+
+def check_frame_size(header: Header, max_frame_size: int):
+    """Raise FrameTooLarge if the header announces a body over the limit.
+    The body length is always the last header field"""
+    if header[-1] > max_frame_size:
+        raise FrameTooLarge(
+            f'Frame of {header[-1]} bytes exceeds the {max_frame_size} byte limit'
+        )
+
+
+class FrameProtocol(asyncio.BufferedProtocol):
+    """Reads frames for a DataStream (as its reader) and provides flow control
+    for the FrameWriter. A body returned by read_frame is a view into the
+    receive buffer and is only valid until read_frame is called again"""
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE,
+                 buffer_size: int = BUFFER_SIZE,
+                 client_connected_cb: Callable[..., Awaitable] | None = None):
+        self.max_frame_size = max_frame_size
+        self.high_water = buffer_size
+
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._keep = 0  # start of the frame last handed out
+        self._start = 0  # start of unread data
+        self._end = 0  # end of received data
+
+        self.transport: asyncio.Transport | None = None
+        self._reading_paused = False
+        self._eof = False
+        self._exc: BaseException | None = None
+        self._read_waiter: asyncio.Future | None = None
+
+        self._writing_paused = False
+        self._drain_waiters: list[asyncio.Future] = []
+        self._closed: asyncio.Future = asyncio.get_running_loop().create_future()
+
+        self._client_connected_cb = client_connected_cb
+        self._cb_task: asyncio.Task | None = None
+
+    # asyncio.BufferedProtocol
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        if self._client_connected_cb is not None:
+            writer = FrameWriter(transport, self)
+            self._cb_task = asyncio.create_task(self._client_connected_cb(self, writer))
+
+    def connection_lost(self, exc: BaseException | None):
+        self._eof = True
+        if exc is not None and self._exc is None:
+            self._exc = exc
+        self._wake_reader()
+
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_exception(ConnectionResetError('Connection lost'))
+        self._drain_waiters.clear()
+
+        if not self._closed.done():
+            self._closed.set_result(None)
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        needed = max(sizehint, MIN_READ_SIZE)
+        try:
+            pending = self._pending_frame_size()
+        except FrameTooLarge:
+            pending = None  # buffer_updated already closed the connection
+        if pending is not None:
+            needed = max(needed, pending - (self._end - self._start))
+
+        if len(self._buffer) - self._end < needed:
+            self._make_room(needed)
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes: int):
+        self._end += nbytes
+
+        try:
+            pending = self._pending_frame_size()
+        except FrameTooLarge as e:
+            self._fail(e)
+            return
+
+        # stop reading while the reader is behind, unless it's waiting for
+        # the rest of a frame larger than the high water mark
+        unread = self._end - self._start
+        if unread >= self.high_water and unread >= pending and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+        self._wake_reader()
+
+    def eof_received(self):
+        self._eof = True
+        self._wake_reader()
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        for waiter in self._drain_waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._drain_waiters.clear()
+
+    # buffer management
+
+    def _pending_frame_size(self) -> int | None:
+        """Size of the next frame including its header, if the header has
+        been received"""
+        if self._end - self._start < HEADER_SIZE:
+            return None
+        header = FRAME_HEADER.unpack_from(self._buffer, self._start)
+        check_frame_size(header, self.max_frame_size)
+        return HEADER_SIZE + header[-1]
+
+    def _make_room(self, needed: int):
+        """Move the unread data to the front of the buffer, or to a new buffer
+        if it's too small or the last frame handed out may still be in use
+        (moving data in place would overwrite it)"""
+        unread = self._end - self._start
+        if self._keep == self._start and len(self._buffer) - unread >= needed:
+            self._buffer[:unread] = self._buffer[self._start:self._end]
+        else:
+            buffer = bytearray(max(unread + needed, len(self._buffer)))
+            buffer[:unread] = self._buffer[self._start:self._end]
+            self._buffer = buffer
+            self._view = memoryview(buffer)
+
+        self._keep = self._start = 0
+        self._end = unread
+
+    def _resume_reading(self):
+        if self._reading_paused:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    def _wake_reader(self):
+        if self._read_waiter is not None and not self._read_waiter.done():
+            self._read_waiter.set_result(None)
+
+    def _fail(self, exc: BaseException):
+        self._exc = exc
+        self._wake_reader()
+        self.transport.close()
+
+    def _next_frame(self) -> Frame | None:
+        available = self._end - self._start
+        if available < HEADER_SIZE:
+            return None
+
+        header = FRAME_HEADER.unpack_from(self._buffer, self._start)
+        check_frame_size(header, self.max_frame_size)
+        frame_end = self._start + HEADER_SIZE + header[-1]
+        if frame_end > self._end:
+            return None
+
+        body = self._view[self._start + HEADER_SIZE:frame_end]
+        self._start = frame_end
+        return header, body
+
+    async def read_frame(self) -> Frame:
+        """Return the next frame's header and a view of its body"""
+        self._keep = self._start  # the last frame handed out is done with
+        if self._keep == self._end:
+            self._keep = self._start = self._end = 0
+
+        if self._end - self._start < self.high_water:
+            self._resume_reading()
+
+        while (frame := self._next_frame()) is None:
+            if self._exc is not None:
+                raise self._exc
+            if self._eof:
+                raise IncompleteReadError(bytes(self._view[self._start:self._end]), None)
+
+            self._resume_reading()
+            self._read_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+        return frame
+
+    # used by FrameWriter
+
+    async def drain(self):
+        if self.transport.is_closing():
+            # give connection_lost a chance to run, like StreamWriter.drain
+            await asyncio.sleep(0)
+            raise ConnectionResetError('Connection lost')
+        if self._writing_paused:
+            waiter = asyncio.get_running_loop().create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    async def wait_closed(self):
+        await self._closed
+
+
+class FrameWriter:
+    """The subset of asyncio.StreamWriter that DataStream uses"""
+    def __init__(self, transport: asyncio.Transport, protocol: FrameProtocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def writelines(self, data):
+        self.transport.writelines(data)
+
+    async def drain(self):
+        await self.protocol.drain()
+
+    def is_closing(self) -> bool:
+        return self.transport.is_closing()
+
+    def close(self):
+        self.transport.close()
+
+    async def wait_closed(self):
+        await self.protocol.wait_closed()
+
+
+async def open_connection(host=None, port=None, **kwargs) -> tuple[FrameProtocol, FrameWriter]:
+    """Like asyncio.open_connection, but with a FrameProtocol as the reader"""
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.create_connection(FrameProtocol, host, port, **kwargs)
+    return protocol, FrameWriter(transport, protocol)
+
+
+async def start_server(client_connected_cb, host=None, port=None, **kwargs) -> asyncio.Server:
+    """Like asyncio.start_server, but client_connected_cb is called with a
+    FrameProtocol reader and a FrameWriter"""
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: FrameProtocol(client_connected_cb=client_connected_cb),
+        host, port, **kwargs
+    )
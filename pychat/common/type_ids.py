@@ -0,0 +1,55 @@
+"""The type id of each model, written in frame headers once both sides of a
+stream agree on type ids (see Handshake). Ids are part of the wire format:
+give a new model an unused id here, keep a model's id when it's renamed,
+and never reuse the id of a model that was removed. Models that aren't
+listed are still sent, naming their type in the body instead.
+
+The ids were first derived from a crc32 of the names, which is why they
+look random."""
+
+TYPE_IDS: dict[str, int] = {
+    # pychat.common.models
+    'ChatMessage': 47114,
+    'ChatRoom': 59943,
+    'Encryptable': 50786,
+    'Encrypted': 39003,
+    'User': 42777,
+    # pychat.common.sealed
+    'Sealed': 46416,
+    # pychat.common.request
+    'CreateRoom': 3949,
+    'CreateRoom.Response': 10147,
+    'Error': 12179,
+    'GetDHKey': 13074,
+    'GetDHKey.Response': 39934,
+    'GetDHMixedKey': 12448,
+    'GetDHMixedKey.Response': 60878,
+    'GetHistory': 36338,
+    'GetHistory.Response': 24184,
+    'GetServerStats': 60614,
+    'GetServerStats.Response': 12234,
+    'Handshake': 4619,
+    'Handshake.Response': 35555,
+    'JoinRoom': 58841,
+    'JoinRoom.Response': 47134,
+    'KeyRequest': 64650,
+    'PostFinalKey': 19557,
+    'PostMessage': 48224,
+    'PostTreeKeys': 57143,
+    'RefreshTreeKey': 13695,
+    'RefreshTreeKey.Response': 62072,
+    'RegenerateDHKeyPair': 63577,
+    'RegenerateDHKeyPair.Response': 50908,
+    'Request': 43567,
+    'Response': 12476,
+    # pychat.server.bus
+    'Deliver': 16938,
+    'Forward': 15943,
+    'Forward.Response': 20090,
+    'GetRemoteHistory': 54662,
+    'GetRemoteHistory.Response': 29154,
+    'JoinRemoteRoom': 45357,
+    'JoinRemoteRoom.Response': 49966,
+    'LeaveRemoteRoom': 26341,
+    'PostToRoom': 58861,
+}
@@ -0,0 +1,284 @@
+"""Message bus between the worker processes of a multi-process server.
+
+Each room lives on the worker whose user created it. When a user joins a room
+held by another worker, that worker adds a RemoteUser to the room, whose
+stream forwards requests (the key exchange) over the bus to the user's worker.
+Messages posted by the user are sent to the room's worker to be broadcast,
+and broadcasts to remote members are sent to their workers once per worker.
+
+Every worker listens on a Unix socket in a shared directory and connects to
+the socket of every other worker. Bus traffic is DataStream frames, so bus
+requests get responses, deadlines and envelopes like client requests do."""
+import asyncio
+import os
+import time
+from typing import Optional, TYPE_CHECKING
+
+from pychat.common import models
+from pychat.common.codec import BINARY
+from pychat.common.envelope import Envelope
+from pychat.common import request as req
+from pychat.common.request import Request, Response
+from pychat.common.stream import DataStream, REQUEST_TIMEOUT, broadcast
+from pychat.server.users import RemoteUser, User
+
+if TYPE_CHECKING:
+    from pychat.server.rooms import ChatRooms
+
+CONNECT_TIMEOUT = 10  # seconds to wait for the other workers to start
+MAX_CONCURRENT_REQUESTS = 256  # per bus connection
+
+# sent instead of a response when a forwarded request's user isn't connected
+USER_GONE = 'user is not connected'
+
+
+def socket_path(bus_dir: str, worker: int) -> str:
+    return os.path.join(bus_dir, f'worker-{worker}.sock')
+
+
+# bus requests
+class JoinRemoteRoom(Request):
+    """Sent to every other worker, the one holding the room adds the user"""
+    worker: int  # the user's worker
+    user_uid: str
+    invite_code: str
+    sealed: bool = False  # the user reads Sealed messages
+
+    class Response(Response):
+        room: Optional[models.ChatRoom]
+
+class LeaveRemoteRoom(Request):
+    user_uid: str
+    room_uid: str
+
+class PostToRoom(Request):
+    """A PostMessage frame for the room's worker to broadcast"""
+    frame: bytes
+
+class Deliver(Request):
+    """A PostMessage frame for the worker of the users to send them"""
+    user_uids: list[str]
+    frame: bytes
+
+class GetRemoteHistory(Request):
+    """A GetHistory for the room's worker to answer with stored frames"""
+    request: req.GetHistory
+
+    class Response(Response):
+        first_seq: Optional[int]
+        frames: list[bytes] = []
+
+class Forward(Request):
+    """A request for the worker of the user to send them, and send back the
+    response to"""
+    user_uid: str
+    request: bytes
+
+    class Response(Response):
+        response: Optional[bytes]
+
+
+class RemoteStream:
+    """Stands in for the DataStream of a user connected to another worker"""
+    def __init__(self, bus: 'WorkerBus', worker: int, user_uid: str, sealed: bool = False):
+        self.bus = bus
+        self.worker = worker
+        self.user_uid = user_uid
+        self.sealed = sealed
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.worker}, {self.user_uid})"
+
+    def _peer(self) -> DataStream:
+        peer = self.bus.peers.get(self.worker)
+        if peer is None:
+            raise ConnectionResetError(f'{self}: worker {self.worker} is gone')
+        return peer
+
+    async def write(self, data: models.StreamData,
+                    timeout: float | None = REQUEST_TIMEOUT) -> Optional[Response]:
+        r = Forward(user_uid=self.user_uid, request=BINARY.encode(data))
+        resp: Forward.Response = await self._peer().write(r, timeout)
+
+        if resp.error is not None:
+            if resp.error == USER_GONE:
+                self.bus.drop_remote_user(self.user_uid)
+            raise ConnectionResetError(f'{self}: {resp.error}')
+        if resp.response is not None:
+            return BINARY.decode(resp.response)
+
+    async def deliver(self, user_uids: list[str], data):
+        """Send a PostMessage to users of this stream's worker"""
+        peer = self._peer()
+        await peer.write(Deliver(user_uids=user_uids, frame=peer.encode_frame(data)))
+
+
+class WorkerBus:
+    def __init__(self, worker_id: int, n_workers: int, bus_dir: str,
+                 rooms: 'ChatRooms', users: dict[str, User]):
+        self.worker_id = worker_id
+        self.n_workers = n_workers
+        self.bus_dir = bus_dir
+        self.rooms = rooms
+        self.users = users  # users connected to this worker, by uid
+
+        self.peers: dict[int, DataStream] = {}  # connections to other workers
+        self.remote_users: dict[str, RemoteUser] = {}  # members of rooms on this worker
+        self._joining: dict[str, asyncio.Future] = {}  # by user uid
+        self._server: asyncio.AbstractServer | None = None
+
+    async def start(self):
+        """Listen for the other workers and connect to each of them"""
+        self._server = await asyncio.start_unix_server(
+            self._handle_peer, path=socket_path(self.bus_dir, self.worker_id)
+        )
+        await asyncio.gather(*[
+            self._connect(worker) for worker in range(self.n_workers)
+            if worker != self.worker_id
+        ])
+
+    async def close(self):
+        for peer in self.peers.values():
+            await peer.close_connection()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _connect(self, worker: int):
+        path = socket_path(self.bus_dir, worker)
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                r, w = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.05)
+
+        stream = DataStream(r, w)
+        listen = asyncio.create_task(stream.listen())
+        listen.add_done_callback(lambda _: self._on_peer_lost(worker))
+        await stream.handshake(codecs=(BINARY.name,))
+        self.peers[worker] = stream
+
+    def _on_peer_lost(self, worker: int):
+        self.peers.pop(worker, None)
+        for user in [u for u in self.remote_users.values() if u.worker == worker]:
+            self.drop_remote_user(user.uid)
+
+    async def _handle_peer(self, r: asyncio.StreamReader, w: asyncio.StreamWriter):
+        stream = DataStream(r, w, max_concurrent_requests=MAX_CONCURRENT_REQUESTS)
+        stream.register_request_handlers(
+            (JoinRemoteRoom, self.on_join_remote_room),
+            (LeaveRemoteRoom, self.on_leave_remote_room),
+            (PostToRoom, self.on_post_to_room),
+            (Deliver, self.on_deliver),
+            (GetRemoteHistory, self.on_get_remote_history),
+            # a user's requests are answered in order, users don't wait on each other
+            (Forward, self.on_forward, lambda r: r.user_uid),
+        )
+        await stream.listen()
+
+    def remote_user(self, worker: int, user_uid: str, sealed: bool = False) -> RemoteUser:
+        user = self.remote_users.get(user_uid)
+        if user is None:
+            user = RemoteUser(user_uid, worker, RemoteStream(self, worker, user_uid, sealed))
+            self.remote_users[user_uid] = user
+        return user
+
+    def drop_remote_user(self, user_uid: str):
+        """Remove a remote user from every room on this worker"""
+        user = self.remote_users.pop(user_uid, None)
+        if user is not None:
+            self.rooms.purge_user(user)
+
+    # used by ChatRooms for users connected to this worker
+
+    async def join_room(self, user: User, invite_code: str) -> tuple[int, models.ChatRoom] | None:
+        """Ask the other workers to add the user to the room with the invite
+        code. Returns the worker holding the room and the room"""
+        workers = list(self.peers)
+        r = JoinRemoteRoom(worker=self.worker_id, user_uid=user.uid,
+                           invite_code=invite_code, sealed=user.stream.sealed)
+
+        # the room's worker starts a key exchange as soon as the user is added,
+        # which the user can only answer once they have the JoinRoom response
+        joined = self._joining[user.uid] = asyncio.get_running_loop().create_future()
+        try:
+            results = await asyncio.gather(
+                *[self.peers[w].write(r) for w in workers], return_exceptions=True
+            )
+        finally:
+            # the response is queued in the same step this returns in
+            del self._joining[user.uid]
+            asyncio.get_running_loop().call_soon(joined.set_result, None)
+
+        for worker, resp in zip(workers, results):
+            if isinstance(resp, JoinRemoteRoom.Response) and resp.room is not None:
+                return worker, resp.room
+
+    async def leave_room(self, worker: int, user: User, room_uid: str):
+        if (peer := self.peers.get(worker)) is not None:
+            try:
+                await peer.write(LeaveRemoteRoom(user_uid=user.uid, room_uid=room_uid))
+            except ConnectionError:
+                pass  # the worker is gone, and its rooms with it
+
+    async def post(self, worker: int, r):
+        """Send a PostMessage (or its Envelope) to the worker holding its room"""
+        peer = self.peers[worker]
+        await peer.write(PostToRoom(frame=peer.encode_frame(r)))
+
+    async def get_history(self, worker: int, r: req.GetHistory) -> tuple[int | None, list[bytes]]:
+        peer = self.peers.get(worker)
+        if peer is None:
+            return None, []
+        resp: GetRemoteHistory.Response = await peer.write(GetRemoteHistory(request=r))
+        return resp.first_seq, resp.frames
+
+    # bus request handlers
+
+    def on_join_remote_room(self, r: JoinRemoteRoom) -> JoinRemoteRoom.Response:
+        room = self.rooms.invite_codes.get(r.invite_code)
+        if room is None:
+            return JoinRemoteRoom.Response(room=None)
+
+        user = self.remote_user(r.worker, r.user_uid, r.sealed)
+        self.rooms.add_user_to_room(user, room.uid)
+        return JoinRemoteRoom.Response(room=room.model())
+
+    def on_leave_remote_room(self, r: LeaveRemoteRoom):
+        user = self.remote_users.get(r.user_uid)
+        if user is None:
+            return
+        self.rooms.leave_rooms(user, [r.room_uid])
+        if not self.rooms.rooms_of(user):
+            del self.remote_users[r.user_uid]
+
+    async def on_post_to_room(self, r: PostToRoom):
+        envelope = Envelope.from_frame(r.frame)
+        if (room := self.rooms.rooms.get(envelope.routing_key)) is not None:
+            await room.broadcast(envelope)
+
+    def on_get_remote_history(self, r: GetRemoteHistory) -> GetRemoteHistory.Response:
+        first_seq, frames = self.rooms.history_page(r.request)
+        return GetRemoteHistory.Response(first_seq=first_seq, frames=frames)
+
+    async def on_deliver(self, r: Deliver):
+        streams = [self.users[uid].stream for uid in r.user_uids if uid in self.users]
+        await broadcast(streams, Envelope.from_frame(r.frame))
+
+    async def on_forward(self, r: Forward) -> Forward.Response:
+        if (joining := self._joining.get(r.user_uid)) is not None:
+            await joining
+
+        user = self.users.get(r.user_uid)
+        if user is None:
+            return Forward.Response(error=USER_GONE)
+
+        try:
+            resp = await user.stream.write(BINARY.decode(r.request))
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            return Forward.Response(error=f'{e.__class__.__name__}: {e}')
+        return Forward.Response(response=resp and BINARY.encode(resp))
@@ -1,43 +1,245 @@
+from abc import ABC, abstractmethod
 import asyncio
 from collections import deque
+from functools import partial
+from itertools import islice
 import random
-from typing import Iterable, Sequence
+import time
+from typing import Hashable, Iterable, Sequence
 
+from pychat.common.metrics import Histogram
 from pychat.common.stream import DataStream
-from pychat.common.request import GetDHKey, GetDHMixedKey, PostFinalKey, RegenerateDHKeyPair
+from pychat.common.request import (
+    GetDHKey, GetDHMixedKey, PostFinalKey, RegenerateDHKeyPair, RefreshTreeKey, PostTreeKeys
+)
+from pychat.server.keytree import KeyTree
 
+KEY_EXCHANGE_DEBOUNCE = 0.05  # seconds, membership changes this close share an exchange
+MAX_SPONSOR_ATTEMPTS = 3  # members asked to refresh a node before giving up
 
-async def dh_Key_exchange(fernet_uid: str, clients: Iterable[DataStream]):
+
+async def dh_Key_exchange(fernet_uid: str, clients: Iterable[DataStream],
+                          epoch: int | None = None):
     """Created a shared sescret between clients. Creates N orderings where N
     is the number of clients where each client gets a chance to be the end
     of the sequence and set their secret key"""
-
-    ctx = {'fernet_uid': fernet_uid}
     clients = deque(clients)
+    ctx = {'fernet_uid': fernet_uid, 'epoch': epoch, 'seal': all_sealed(clients)}
+    if not clients:
+        return
 
     # prevents re-use of old public keys as shared secret (issue#1)
     # (ABC -> A'B) instead of (ABC -> AB)
-    await random.choice(clients).write(RegenerateDHKeyPair(**ctx)) # A -> A'
+    try:
+        await random.choice(clients).write(RegenerateDHKeyPair(**ctx)) # A -> A'
+    except (asyncio.TimeoutError, ConnectionError):
+        return  # the client left, its room will start a new exchange
 
+    exchanges = []
     for _ in range(len(clients)):
-        asyncio.create_task(_exchange(ctx, tuple(clients)))
+        exchanges.append(_exchange(ctx, tuple(clients)))
         clients.rotate()
+    await asyncio.gather(*exchanges)
 
 
 async def _exchange(ctx: dict, clients: Sequence[DataStream]):
     """Take a sequence of clients and create a shared secret for the last
-    client in the sequence"""
+    client in the sequence. Gives up if any client fails to answer in time"""
+    try:
+        # get public key from first client
+        first_client = clients[0]
+        r: GetDHKey.Response = await first_client.write(GetDHKey(**ctx))
+        key = r.key
 
-    # get public key from first client
-    first_client = clients[0]
-    r: GetDHKey.Response = await first_client.write(GetDHKey(**ctx))
-    key = r.key
+        # Exchange between intermediate clients
+        for client in clients[1:-1]:
+            r: GetDHMixedKey.Response = await client.write(GetDHMixedKey(key=key, **ctx))
+            key = r.key
 
-    # Exchange between intermediate clients
-    for client in clients[1:-1]:
-        r: GetDHMixedKey.Response = await client.write(GetDHMixedKey(key=key, **ctx))
-        key = r.key
+        # send key to final client to make secret
+        final_client = clients[-1]
+        await final_client.write(PostFinalKey(key=key, **ctx))
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+
+
+def all_sealed(streams: Iterable[DataStream]) -> bool:
+    """Whether every client agreed to read Sealed messages, so the key they
+    make can be used to send them"""
+    return all(stream.sealed for stream in streams)
+
+
+class KeyAgreement(ABC):
+    """Runs a room's key exchanges as its members change. Changes less than
+    `debounce` seconds apart share one exchange, and each exchange is given
+    the next epoch number. An exchange still going when the next one starts
+    is superseded, so a burst of joins costs about one exchange"""
+    def __init__(self, fernet_uid: str, debounce: float = KEY_EXCHANGE_DEBOUNCE):
+        self.fernet_uid = fernet_uid
+        self.debounce = debounce
+        self.epoch = 0
+        self.members: dict[Hashable, DataStream] = {}
+        self._timer: asyncio.TimerHandle | None = None
+        self._task: asyncio.Task | None = None
+        # how long exchanges that weren't superseded took, if set
+        self.durations: Histogram | None = None
+
+    def join(self, member: Hashable, stream: DataStream):
+        self.members[member] = stream
+        self._changed()
+
+    def leave(self, member: Hashable):
+        if self.members.pop(member, None) is not None:
+            self._changed()
+
+    def _changed(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(self.debounce, self._start)
+
+    def _start(self):
+        self._timer = None
+        self.epoch += 1
+        self._task = asyncio.create_task(self._exchange(self._task, self.epoch))
+        if self.durations is not None:
+            self._task.add_done_callback(
+                partial(self._exchange_done, self.epoch, time.perf_counter())
+            )
+
+    def _exchange_done(self, epoch: int, started: float, task: asyncio.Task):
+        if not task.cancelled() and not self.superseded(epoch):
+            self.durations.observe(time.perf_counter() - started)
+
+    def superseded(self, epoch: int) -> bool:
+        """Whether a newer exchange than `epoch` has started or is waiting to"""
+        return epoch != self.epoch or self._timer is not None
+
+    @abstractmethod
+    async def _exchange(self, previous: asyncio.Task | None, epoch: int):
+        """Give the members the room key of exchange `epoch`. `previous` is
+        the exchange before it, which may still be running"""
+
+    async def settled(self):
+        """Wait until no exchange is running or waiting to start"""
+        while True:
+            if self._timer is not None:
+                await asyncio.sleep(self.debounce)
+            elif self._task is not None and not self._task.done():
+                await asyncio.wait([self._task])
+            else:
+                return
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._task is not None:
+            self._task.cancel()
+
+
+class RingKeyAgreement(KeyAgreement):
+    """dh_Key_exchange between every member. A superseded exchange is
+    cancelled, its chains are of no use once the members changed"""
+    async def _exchange(self, previous: asyncio.Task | None, epoch: int):
+        if previous is not None:
+            previous.cancel()
+        await dh_Key_exchange(self.fernet_uid, list(self.members.values()), epoch)
+
+
+class TreeKeyAgreement(KeyAgreement):
+    """Keeps a room's key tree (see pychat.server.keytree) in step with its
+    members. A join or leave costs O(log N) exponentiations per member and one
+    message to each member, plus a round trip to the sponsor.
+
+    Exchanges take turns, each starting from the tree the last one left. A
+    superseded exchange stops at its next step instead of being cancelled, so
+    the blinded keys a sponsor sends back are never lost"""
+    def __init__(self, fernet_uid: str, debounce: float = KEY_EXCHANGE_DEBOUNCE):
+        super().__init__(fernet_uid, debounce)
+        self.tree = KeyTree()
+        self.streams: dict[Hashable, DataStream] = {}  # of the members in the tree
+
+    async def _exchange(self, previous: asyncio.Task | None, epoch: int):
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        ctx = {'fernet_uid': self.fernet_uid, 'epoch': epoch,
+               'seal': all_sealed(self.members.values())}
+        if self.superseded(epoch):
+            return
+        await self._update_tree(ctx)
+        if self.superseded(epoch):
+            return
+        has_key = await self._refresh(epoch, ctx)
+        if has_key is None or self.superseded(epoch):
+            return
+
+        await asyncio.gather(*(
+            self._post_tree_keys(member, stream, ctx)
+            for member, stream in self.streams.items() if member is not has_key
+        ))
+
+    async def _update_tree(self, ctx: dict):
+        """Add and remove leaves to match the members"""
+        for member in [m for m in self.tree.leaves if m not in self.members]:
+            self.tree.remove(member)
+            del self.streams[member]
+
+        joining = [(m, s) for m, s in self.members.items() if m not in self.tree]
+        keys = await asyncio.gather(*(self._leaf_key(s, ctx) for _, s in joining))
+        for (member, stream), key in zip(joining, keys):
+            # it may have left while we waited
+            if key is not None and self.members.get(member) is stream:
+                self.tree.insert(member, key)
+                self.streams[member] = stream
+
+    @staticmethod
+    async def _leaf_key(stream: DataStream, ctx: dict) -> int | None:
+        try:
+            r: GetDHKey.Response = await stream.write(GetDHKey(**ctx))
+            return r.key
+        except (asyncio.TimeoutError, ConnectionError):
+            return None
+
+    async def _refresh(self, epoch: int, ctx: dict) -> Hashable | bool | None:
+        """Have sponsors refresh the stale nodes, deepest first. Returns the
+        member that already worked out the new root, False if none did, or
+        None if the exchange stopped early"""
+        sponsors = set()
+        has_key = False
+        while (stale := self.tree.stale_node()) is not None:
+            if self.superseded(epoch):
+                return None
+            # any leaf under the node can refresh it
+            for leaf in islice(self.tree.leaves_under(stale), MAX_SPONSOR_ATTEMPTS):
+                to_root = await self._refresh_path(leaf.member, leaf.member not in sponsors, ctx)
+                if to_root is not None:
+                    sponsors.add(leaf.member)
+                    has_key = leaf.member if to_root else False
+                    break
+            else:
+                return None  # the nodes stay stale for the next exchange
+        return has_key
+
+    async def _refresh_path(self, member: Hashable, new_leaf: bool, ctx: dict) -> bool | None:
+        """Ask a sponsor to refresh its path, up to the first sibling whose
+        blinded key isn't known. Returns whether it reached the root, or None
+        if the sponsor didn't answer"""
+        co_path = self.tree.co_path(member)
+        to_root = None not in co_path
+        if not to_root:
+            co_path = co_path[:co_path.index(None)]
+        try:
+            r: RefreshTreeKey.Response = await self.streams[member].write(RefreshTreeKey(
+                co_path=co_path, to_root=to_root, new_leaf=new_leaf, **ctx
+            ))
+            self.tree.refresh_path(member, r.leaf_key, r.path_keys)
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            return None
+        return to_root
 
-    # send key to final client to make secret
-    final_client = clients[-1]
-    await final_client.write(PostFinalKey(key=key, **ctx))
+    async def _post_tree_keys(self, member: Hashable, stream: DataStream, ctx: dict):
+        try:
+            await stream.write(PostTreeKeys(co_path=self.tree.co_path(member), **ctx))
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
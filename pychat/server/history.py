@@ -0,0 +1,334 @@
+"""Per-room message history, kept on disk.
+
+Each room has an append-only MessageLog of the PostMessage frames broadcast
+to it, stored as they were relayed (usually an undecoded envelope), so the
+server never needs to read or decrypt them. A log is split into segment files
+named after their first sequence number:
+
+    record: seq (Q) | unix time (d) | frame length (I) | frame
+
+Appending only adds the record to a buffer. A task of the log writes what's
+buffered to the file on a thread shortly after, so broadcasts never wait on
+the disk. Segments that are full are sealed once written, and read through
+mmap. Whole segments are deleted once they fall outside the retention limits,
+which keeps disk use bounded without rewriting any files."""
+from array import array
+import asyncio
+from bisect import bisect_left
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+
+RECORD = struct.Struct('>QdI')  # seq, unix time, frame length
+SEGMENT_SIZE = 4 * 1024 * 1024  # bytes, a segment is sealed once it reaches this
+MAX_LOG_SIZE = 64 * 1024 * 1024  # bytes per room
+MAX_AGE = 7 * 24 * 60 * 60  # seconds
+PAGE_SIZE = 50  # messages
+MAX_PAGE_SIZE = 500  # messages
+WRITE_DELAY = 0.05  # seconds, appends in the meantime are written together
+
+Record = tuple[int, float, bytes]
+
+
+class Segment:
+    """One file of a MessageLog and an index of where each record starts.
+    Records are buffered until they're written, and read from the buffer
+    until then"""
+    def __init__(self, path: str, first_seq: int):
+        self.path = path
+        self.first_seq = first_seq
+        self.size = 0  # bytes, including the ones not written yet
+        self.written = 0  # bytes in the file
+        self.full = False  # no more appends, it's sealed once written
+        self._offsets = array('Q')  # by seq - first_seq
+        self._times = array('d')
+        self._buffer = bytearray()  # the bytes after `written`
+        self._fd: int | None = None  # while the segment isn't sealed
+        self._lock = threading.Lock()  # held while writing to or closing the file
+        self._map: mmap.mmap | None = None  # while sealed
+
+    def __len__(self):
+        return len(self._offsets)
+
+    @property
+    def next_seq(self) -> int:
+        return self.first_seq + len(self._offsets)
+
+    @property
+    def last_time(self) -> float:
+        return self._times[-1] if self._times else 0.0
+
+    def load(self):
+        """Index the records already in the file. A record cut short by a
+        crash is truncated away"""
+        with open(self.path, 'r+b') as f:
+            data = f.read()
+            pos = 0
+            while pos + RECORD.size <= len(data):
+                _, t, length = RECORD.unpack_from(data, pos)
+                if pos + RECORD.size + length > len(data):
+                    break
+                self._offsets.append(pos)
+                self._times.append(t)
+                pos += RECORD.size + length
+            if pos != len(data):
+                f.truncate(pos)
+        self.size = self.written = pos
+
+    @property
+    def unwritten(self) -> int:
+        return self.size - self.written
+
+    def append(self, seq: int, t: float, frame: bytes):
+        self._buffer += RECORD.pack(seq, t, len(frame))
+        self._buffer += frame
+        self._offsets.append(self.size)
+        self._times.append(t)
+        self.size += RECORD.size + len(frame)
+
+    def _open(self) -> int:
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        return self._fd
+
+    def _write(self, data: bytes, offset: int):
+        with self._lock:
+            if self._fd is not None:  # or it was closed in the meantime
+                os.pwrite(self._fd, data, offset)
+
+    def _wrote(self, n: int):
+        del self._buffer[:n]
+        self.written += n
+
+    def write(self):
+        """Write the buffered records to the file"""
+        data = bytes(self._buffer)
+        if data:
+            self._open()
+            self._write(data, self.written)
+            self._wrote(len(data))
+
+    async def write_async(self):
+        """Write the buffered records to the file on a thread. Records
+        appended in the meantime stay buffered"""
+        data = bytes(self._buffer)
+        if data:
+            self._open()
+            await asyncio.to_thread(self._write, data, self.written)
+            self._wrote(len(data))
+
+    def seal(self):
+        """Stop appending and read the segment through a memory map"""
+        self.full = True
+        self.write()
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        if self._map is None and self.size:
+            with open(self.path, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, start: int, end: int) -> list[Record]:
+        """Records with start <= seq < end, all in this segment. The bytes
+        already written are read in one go"""
+        first = self._offsets[start - self.first_seq]
+        last = self._offsets[end - self.first_seq] if end < self.next_seq else self.size
+
+        if self._map is not None:
+            data = self._map[first:last]
+        else:
+            data = b''
+            if first < self.written:
+                data = os.pread(self._open(), min(last, self.written) - first, first)
+            if last > self.written:
+                data += bytes(self._buffer[max(first - self.written, 0):last - self.written])
+
+        records, pos = [], 0
+        for seq in range(start, end):
+            _, t, length = RECORD.unpack_from(data, pos)
+            pos += RECORD.size
+            records.append((seq, t, data[pos:pos + length]))
+            pos += length
+        return records
+
+    def seq_at(self, t: float) -> int:
+        """The first seq written at or after time t"""
+        return self.first_seq + bisect_left(self._times, t)
+
+    def close(self):
+        """Write what's still buffered and close the file. Waits for a write
+        running on a thread"""
+        with self._lock:
+            if self._buffer:
+                os.pwrite(self._open(), bytes(self._buffer), self.written)
+                self._wrote(len(self._buffer))
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+class MessageLog:
+    """Append-only log of the frames broadcast to one room"""
+    def __init__(self, directory: str, segment_size: int = SEGMENT_SIZE,
+                 max_size: int = MAX_LOG_SIZE, max_age: float = MAX_AGE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.max_age = max_age
+
+        os.makedirs(directory, exist_ok=True)
+        self.segments: list[Segment] = []
+        self._writing: asyncio.Task | None = None
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log'):
+                segment = Segment(os.path.join(directory, name), int(name[:-4]))
+                segment.load()
+                self.segments.append(segment)
+        for segment in self.segments[:-1]:
+            segment.seal()
+
+        if not self.segments:
+            self._new_segment(0)
+        self.compact()
+
+    @property
+    def first_seq(self) -> int:
+        return self.segments[0].first_seq
+
+    @property
+    def next_seq(self) -> int:
+        return self.segments[-1].next_seq
+
+    @property
+    def size(self) -> int:
+        return sum(s.size for s in self.segments)
+
+    def _new_segment(self, first_seq: int):
+        path = os.path.join(self.directory, f'{first_seq:020d}.log')
+        self.segments.append(Segment(path, first_seq))
+
+    def append(self, frame: bytes, t: float | None = None) -> int:
+        """Add a frame to the end of the log and return its seq"""
+        active = self.segments[-1]
+        if active.size >= self.segment_size:
+            active.full = True  # sealed once it's been written
+            self._new_segment(active.next_seq)
+            self.compact()
+            active = self.segments[-1]
+
+        seq = active.next_seq
+        active.append(seq, time.time() if t is None else t, frame)
+        self._write_soon()
+        return seq
+
+    def _write_soon(self):
+        if self._writing is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.write()  # no loop to write from, e.g. a script
+            return
+        self._writing = loop.create_task(self._write_later())
+
+    async def _write_later(self):
+        try:
+            await asyncio.sleep(WRITE_DELAY)
+            while any(s.unwritten for s in self.segments):
+                for segment in [s for s in self.segments if s.unwritten]:
+                    await segment.write_async()
+                    if segment.full and not segment.unwritten:
+                        segment.seal()
+        finally:
+            self._writing = None
+
+    def write(self):
+        """Write every buffered record now"""
+        for segment in self.segments:
+            if segment.full:
+                segment.seal()
+            else:
+                segment.write()
+
+    def compact(self, now: float | None = None):
+        """Delete the oldest sealed segments while the log is over its size
+        limit, or their newest record is past the age limit"""
+        now = time.time() if now is None else now
+        size = self.size
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if size <= self.max_size and now - oldest.last_time <= self.max_age:
+                break
+            if oldest.unwritten:
+                break  # deleted once it's written, the writer task may be on it
+            size -= oldest.size
+            oldest.delete()
+            del self.segments[0]
+
+    def read(self, start: int, end: int) -> list[Record]:
+        """Records with start <= seq < end that are still retained"""
+        records = []
+        for segment in self.segments:
+            lo, hi = max(start, segment.first_seq), min(end, segment.next_seq)
+            if lo < hi:
+                records += segment.read(lo, hi)
+        return records
+
+    def seq_at(self, t: float) -> int:
+        """The first seq written at or after time t"""
+        for segment in self.segments:
+            if segment.last_time >= t:
+                return segment.seq_at(t)
+        return self.next_seq
+
+    def page(self, before: int | None = None, since: float | None = None,
+             limit: int = PAGE_SIZE) -> list[Record]:
+        """The newest `limit` records before seq `before` (or the end), and
+        written at or after time `since`, oldest first"""
+        end = self.next_seq if before is None else min(before, self.next_seq)
+        start = max(end - min(limit, MAX_PAGE_SIZE), self.first_seq)
+        if since is not None:
+            start = max(start, self.seq_at(since))
+        return self.read(start, end)
+
+    def close(self):
+        if self._writing is not None:
+            self._writing.cancel()
+        for segment in self.segments:
+            segment.close()
+
+
+class HistoryStore:
+    """The MessageLogs of every room, each in its own directory"""
+    def __init__(self, root: str, **log_options):
+        self.root = root
+        self.log_options = log_options
+        self.logs: dict[str, MessageLog] = {}
+
+    def create(self, room_uid: str) -> MessageLog:
+        log = self.logs[room_uid] = MessageLog(
+            os.path.join(self.root, room_uid), **self.log_options
+        )
+        return log
+
+    def delete(self, room_uid: str):
+        """Delete the room's log along with its files"""
+        log = self.logs.pop(room_uid, None)
+        if log is not None:
+            log.close()
+            shutil.rmtree(log.directory, ignore_errors=True)
+
+    def close(self):
+        for log in self.logs.values():
+            log.close()
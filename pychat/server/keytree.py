@@ -0,0 +1,178 @@
+"""Key tree for tree-based group Diffie-Hellman (TGDH).
+
+Members of a room are the leaves of a binary tree. Every node has a secret
+only the members below it know, and a blinded key (the public key of the
+secret, in the room's key backend) that anyone may know. A node's secret is
+the blinded key of one child mixed with the secret of the other, so a member
+can work out every secret on the way from its leaf to the root from its own
+secret and the blinded keys of the siblings on the way (its co-path). The
+root secret is the room key.
+
+When a member joins or leaves, only the blinded keys of the nodes above the
+change go stale. A sponsor member below them (the new member, or the
+rightmost leaf next to the one removed) picks a new leaf secret and sends
+back the blinded keys of its path, then every other member works out
+the new root from its new co-path. That is O(log N) exponentiations per
+member, where the ring exchange needs O(N) per member and O(N^2) in total.
+Several changes at once may need a sponsor each, see stale_node.
+
+The server only keeps the shape of the tree and the blinded keys, so it
+never learns any secret."""
+from typing import Hashable, Iterator
+
+
+class Node:
+    def __init__(self, member: Hashable | None = None):
+        self.member = member  # set on leaves only
+        self.parent: Node | None = None
+        self.left: Node | None = None
+        self.right: Node | None = None
+        self.key: int | None = None  # blinded key, None until it's known
+
+    @property
+    def is_leaf(self) -> bool:
+        return self.left is None
+
+    @property
+    def sibling(self) -> 'Node':
+        parent = self.parent
+        return parent.right if parent.left is self else parent.left
+
+    def set_children(self, left: 'Node', right: 'Node'):
+        self.left, self.right = left, right
+        left.parent = right.parent = self
+
+    def depth(self) -> int:
+        depth, node = 0, self
+        while node.parent is not None:
+            depth += 1
+            node = node.parent
+        return depth
+
+
+class KeyTree:
+    def __init__(self):
+        self.root: Node | None = None
+        self.leaves: dict[Hashable, Node] = {}
+
+    def __len__(self):
+        return len(self.leaves)
+
+    def __contains__(self, member: Hashable):
+        return member in self.leaves
+
+    @staticmethod
+    def leaves_under(node: Node) -> Iterator[Node]:
+        """The leaves below a node, rightmost first"""
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.is_leaf:
+                yield node
+            else:
+                stack += (node.left, node.right)
+
+    def _shallowest_node(self) -> Node:
+        """Where to insert a new leaf to keep the tree balanced: the
+        shallowest leaf, rightmost among equals"""
+        level = [self.root]
+        while True:
+            for node in reversed(level):
+                if node.is_leaf:
+                    return node
+            level = [child for node in level for child in (node.left, node.right)]
+
+    def insert(self, member: Hashable, key: int):
+        """Add a member with the blinded key of its leaf"""
+        leaf = Node(member)
+        leaf.key = key
+        self.leaves[member] = leaf
+
+        if self.root is None:
+            self.root = leaf
+            return
+
+        # the new leaf and the insertion point become children of a new node
+        at = self._shallowest_node()
+        parent = Node()
+        if at.parent is None:
+            self.root = parent
+        elif at.parent.left is at:
+            at.parent.left = parent
+            parent.parent = at.parent
+        else:
+            at.parent.right = parent
+            parent.parent = at.parent
+        parent.set_children(at, leaf)
+
+        self._forget_path(parent)
+
+    def remove(self, member: Hashable):
+        """Remove a member's leaf, its sibling takes the place of their parent"""
+        leaf = self.leaves.pop(member)
+        parent = leaf.parent
+        if parent is None:
+            self.root = None
+            return
+
+        sibling = leaf.sibling
+        grandparent = parent.parent
+        sibling.parent = grandparent
+        if grandparent is None:
+            self.root = sibling
+        elif grandparent.left is parent:
+            grandparent.left = sibling
+        else:
+            grandparent.right = sibling
+
+        # a sponsor under the sibling always picks a new leaf secret, or the
+        # nodes left above the change could make a room key the room had before
+        self._forget_path(next(self.leaves_under(sibling)))
+
+    @staticmethod
+    def _forget_path(node: Node):
+        """Blinded keys from the node up are stale until the sponsor's refresh"""
+        while node is not None:
+            node.key = None
+            node = node.parent
+
+    def path(self, member: Hashable) -> Iterator[Node]:
+        """The nodes from the member's leaf up to the root, excluding both"""
+        node = self.leaves[member].parent
+        while node is not None and node.parent is not None:
+            yield node
+            node = node.parent
+
+    def co_path(self, member: Hashable) -> list[int | None]:
+        """Blinded keys of the siblings on the way from the member's leaf to
+        the root, leaf level first"""
+        keys = []
+        node = self.leaves[member]
+        while node.parent is not None:
+            keys.append(node.sibling.key)
+            node = node.parent
+        return keys
+
+    def refresh_path(self, member: Hashable, leaf_key: int, path_keys: list[int]):
+        """Store the blinded keys a sponsor sent back after refreshing, from
+        its leaf's parent up to where it stopped"""
+        self.leaves[member].key = leaf_key
+        nodes = list(self.path(member))
+        if len(path_keys) > len(nodes):
+            raise ValueError(f'Expected up to {len(nodes)} path keys, got {len(path_keys)}')
+        for node, key in zip(nodes, path_keys):
+            node.key = key
+
+    def stale_node(self) -> Node | None:
+        """The deepest node whose blinded key isn't known, other than the root
+        unless it's a leaf. The nodes below it are all known, so any leaf
+        under it has what it needs to work its way up to it"""
+        stale, level = None, [self.root] if self.root is not None else []
+        while level:
+            stale = next((n for n in level if n.key is None
+                          and (n is not self.root or n.is_leaf)), stale)
+            level = [child for n in level if not n.is_leaf for child in (n.left, n.right)]
+        return stale
+
+    def depth(self) -> int:
+        return max((leaf.depth() for leaf in self.leaves.values()), default=0)
@@ -0,0 +1,24 @@
+"""What the server counts besides each connection's StreamMetrics, and the
+snapshot GetServerStats sends back"""
+from pychat.common.metrics import Histogram, StreamMetrics
+
+
+class ServerMetrics:
+    def __init__(self):
+        self.broadcast = Histogram()  # every room's broadcasts
+        self.broadcast_by_room: dict[str, Histogram] = {}  # of rooms that still exist
+        self.key_exchange = Histogram()  # from the membership change to the new key
+        self.closed = StreamMetrics()  # totals of connections that closed
+
+    def broadcast_done(self, room_uid: str, seconds: float):
+        self.broadcast.observe(seconds)
+        if (room := self.broadcast_by_room.get(room_uid)) is None:
+            room = self.broadcast_by_room[room_uid] = Histogram()
+        room.observe(seconds)
+
+    def room_deleted(self, room_uid: str):
+        self.broadcast_by_room.pop(room_uid, None)
+
+    def connection_closed(self, metrics: StreamMetrics | None):
+        if metrics is not None:
+            self.closed.merge(metrics)
@@ -1,21 +1,44 @@
 
 import asyncio
 from functools import partial
+import time
+from typing import Iterable, TYPE_CHECKING
 
-from pychat.server.diffiehellman import dh_Key_exchange
+from pychat.server.diffiehellman import KeyAgreement, RingKeyAgreement, TreeKeyAgreement
+from pychat.server.history import HistoryStore, MessageLog
+from pychat.server.metrics import ServerMetrics
+from pychat.common.codec import BINARY
+from pychat.common.envelope import Envelope, encode_frame
+from pychat.common.models import type_id_of
+from pychat.common.stream import broadcast
 from pychat.common.utils import make_uid, make_invite_code
 from pychat.common import models
 from pychat.common import request as req
 from pychat.server import users
 
+if TYPE_CHECKING:
+    from pychat.server.bus import WorkerBus
+
+# 'tree' for tree group key agreement, or 'ring' for the original exchange
+# where every member takes part in N chains of N - 1 key mixes
+KEY_AGREEMENT = 'tree'
+
 
 class ChatRoom:
-    def __init__(self, name: str):
+    def __init__(self, name: str, key_agreement: str = KEY_AGREEMENT,
+                 key_backend: str = models.DEFAULT_KEY_BACKEND):
         self.uid = make_uid()
         self.name = name
         self.invite_code = make_invite_code()
+        # the members do the key math, the server only tells them which kind
+        self.key_backend = key_backend
 
         self.users: set[users.User] = set()
+        self.log: MessageLog | None = None  # message history, if kept
+        self.metrics: ServerMetrics | None = None
+
+        agreement = TreeKeyAgreement if key_agreement == 'tree' else RingKeyAgreement
+        self.key_agreement: KeyAgreement = agreement(self.uid)
     
     @property
     def has_users(self):
@@ -27,34 +50,103 @@ class ChatRoom:
     
     def remove_user(self, user):
         self.users.remove(user)
-        self.do_key_exchange()
+        # an empty room is deleted, there's no one left to share a key with
+        if self.has_users:
+            self.do_key_exchange()
+        else:
+            self.key_agreement.close()
     
     def do_key_exchange(self):
-        streams = [u.stream for u in self.users]
-        asyncio.create_task(dh_Key_exchange(self.uid, streams))
+        """Start a key exchange for the current members. Changes made in quick
+        succession share one exchange"""
+        members = self.key_agreement.members
+        for user in self.users - members.keys():
+            self.key_agreement.join(user, user.stream)
+        for user in members.keys() - self.users:
+            self.key_agreement.leave(user)
 
     async def broadcast_messaage(self, message: models.ChatMessage | models.Encrypted):
-        r = req.PostMessage(message=message)
-        await asyncio.gather(*[u.stream.write(r) for u in self.users])
+        # the message was validated when it was received
+        await self.broadcast(req.PostMessage.construct(message=message))
+
+    async def broadcast(self, r: req.PostMessage | Envelope):
+        """Send a PostMessage to every member. It's framed once per frame
+        format, and an Envelope is forwarded without decoding it to members
+        that use the same codec"""
+        started = time.perf_counter()
+        if self.log is not None:
+            self.log.append(self.history_frame(r))
+
+        local, remote = [], {}
+        for u in self.users:
+            if isinstance(u, users.RemoteUser):
+                # one delivery per worker for its members
+                remote.setdefault(u.worker, (u.stream, []))[1].append(u.uid)
+            else:
+                local.append(u.stream)
+
+        # a member that disconnected mid-broadcast shouldn't fail the sender
+        await broadcast(local, r)
+        for stream, uids in remote.values():
+            try:
+                await stream.deliver(uids, r)
+            except ConnectionError:
+                pass
+
+        if self.metrics is not None:
+            self.metrics.broadcast_done(self.uid, time.perf_counter() - started)
+
+    @staticmethod
+    def history_frame(r: req.PostMessage | Envelope) -> bytes:
+        # frames are self-describing, so any client can read a stored frame
+        if isinstance(r, Envelope):
+            return r.frame(type_id_of(r.type_))
+        return encode_frame(r, BINARY)
 
     def model(self) -> models.ChatRoom:
-        return models.ChatRoom(uid=self.uid, name=self.name)
+        return models.ChatRoom(uid=self.uid, name=self.name, key_backend=self.key_backend)
+
+
+class RemoteRoom:
+    """A room held by another worker that users of this worker are in"""
+    def __init__(self, uid: str, worker: int):
+        self.uid = uid
+        self.worker = worker
+        self.users: set[users.User] = set()
 
 
 class ChatRooms:
-    def __init__(self):
+    def __init__(self, history: HistoryStore | None = None,
+                 metrics: ServerMetrics | None = None):
         self.invite_codes: dict[str, ChatRoom] = {}
+        self.history = history
+        self.metrics = metrics
         self.rooms: dict[str, ChatRoom] = {}
+        # uids of the rooms each user is in, kept in step with ChatRoom.users
+        self.memberships: dict[users.User, set[str]] = {}
+
+        # set when running as one of several workers
+        self.bus: 'WorkerBus | None' = None
+        self.remote_rooms: dict[str, RemoteRoom] = {}
+        self._bus_tasks: set[asyncio.Task] = set()
     
     def register_user(self, user: users.User):
         user.stream.register_request_handlers(
-            (req.PostMessage, self.on_post_message),
+            # messages to the same room are broadcast in the order they were
+            # sent, and relayed without decoding them
+            (req.PostMessage, partial(self.on_post_message, user), self.message_room_uid, True),
             (req.CreateRoom, partial(self.on_create_room, user)),
             (req.JoinRoom, partial(self.on_join_room, user)),
+            (req.GetHistory, partial(self.on_get_history, user)),
         )
 
-    def make_room(self, name: str) -> ChatRoom:
-        room = ChatRoom(name)
+    def make_room(self, name: str, key_backend: str = models.DEFAULT_KEY_BACKEND) -> ChatRoom:
+        room = ChatRoom(name, key_backend=key_backend)
+        if self.history is not None:
+            room.log = self.history.create(room.uid)
+        if self.metrics is not None:
+            room.metrics = self.metrics
+            room.key_agreement.durations = self.metrics.key_exchange
 
         self.rooms[room.uid] = room
         self.invite_codes[room.invite_code] = room
@@ -65,47 +157,145 @@ class ChatRooms:
         room = self.rooms[room_uid]
         del self.invite_codes[room.invite_code]
         del self.rooms[room.uid]
+        if self.history is not None:
+            self.history.delete(room.uid)
+        if self.metrics is not None:
+            self.metrics.room_deleted(room.uid)
+
+    def rooms_of(self, user: users.User) -> set[str]:
+        return self.memberships.get(user, set())
 
     def add_user_to_room(self, user, room_uid):
         room = self.rooms[room_uid]
         room.add_user(user)
+        self.memberships.setdefault(user, set()).add(room_uid)
+
+    def add_user_to_remote_room(self, user, worker: int, room_uid: str):
+        room = self.remote_rooms.get(room_uid)
+        if room is None:
+            room = self.remote_rooms[room_uid] = RemoteRoom(room_uid, worker)
+        room.users.add(user)
+        self.memberships.setdefault(user, set()).add(room_uid)
 
     def remove_user_from_room(self, user, room_uid):
-        room = self.rooms[room_uid]
-        room.remove_user(user)
+        if room_uid in self.remote_rooms:
+            self._remove_user_from_remote_room(user, room_uid)
+        else:
+            room = self.rooms[room_uid]
+            room.remove_user(user)
+            if not room.has_users:
+                self.delete_room(room_uid)
+
+        joined = self.memberships[user]
+        joined.discard(room_uid)
+        if not joined:
+            del self.memberships[user]
+
+    def _remove_user_from_remote_room(self, user, room_uid):
+        room = self.remote_rooms[room_uid]
+        room.users.remove(user)
+        if not room.users:
+            del self.remote_rooms[room_uid]
+        # called on disconnect, which can't wait for the room's worker
+        task = asyncio.create_task(self.bus.leave_room(room.worker, user, room_uid))
+        self._bus_tasks.add(task)
+        task.add_done_callback(self._on_bus_task_done)
+
+    def _on_bus_task_done(self, task: asyncio.Task):
+        self._bus_tasks.discard(task)
+        if not task.cancelled() and (exc := task.exception()) is not None:
+            asyncio.get_running_loop().call_exception_handler({
+                'message': 'Leaving a room on another worker failed',
+                'exception': exc,
+                'task': task,
+            })
+
+    def join_rooms(self, user: users.User, room_uids: Iterable[str]):
+        for room_uid in room_uids:
+            if room_uid not in self.rooms_of(user):
+                self.add_user_to_room(user, room_uid)
 
-        if not room.has_users:
-            self.delete_room(room_uid)
+    def leave_rooms(self, user: users.User, room_uids: Iterable[str] | None = None):
+        """Remove the user from the rooms, or from every room they are in"""
+        joined = self.rooms_of(user)
+        room_uids = tuple(joined if room_uids is None else joined.intersection(room_uids))
+        for room_uid in room_uids:
+            self.remove_user_from_room(user, room_uid)
 
     def purge_user(self, user):
-        for room in tuple(self.rooms.values()):
-            if user not in room.users: continue
-            self.remove_user_from_room(user, room.uid)
+        # only visits the user's own rooms
+        self.leave_rooms(user)
 
-    async def send_message(self, message: models.ChatMessage | models.Encrypted):
-        if isinstance(message, models.ChatMessage):
-            room_uid = message.room_uid
-        elif isinstance(message, models.Encrypted):
-            room_uid = message.fernet_id
+    @staticmethod
+    def message_room_uid(r: req.PostMessage | Envelope) -> str:
+        # read from the envelope, so the message isn't decoded
+        return r.routing_key
 
-        room = self.rooms[room_uid]
-        await room.broadcast_messaage(message)
+    async def send_message(self, r: req.PostMessage | Envelope):
+        room_uid = self.message_room_uid(r)
+        if (remote := self.remote_rooms.get(room_uid)) is not None:
+            await self.bus.post(remote.worker, r)
+        elif (room := self.rooms.get(room_uid)) is not None:
+            await room.broadcast(r)
+        else:
+            print(f"Dropped a message to unknown room {room_uid}")
 
-    async def on_post_message(self, r: req.PostMessage) -> None:
-        await self.send_message(r.message)
+    async def on_post_message(self, user: users.User, r: req.PostMessage | Envelope) -> None:
+        """Relay the message to the room in its routing key, for members only.
+        The routing key is all that's read, the payload is left encrypted"""
+        room_uid = self.message_room_uid(r)
+        if room_uid not in self.rooms_of(user):
+            print(f"Dropped a message from {user.uid} to room {room_uid}, not a member")
+            return
+        await self.send_message(r)
     
     def on_create_room(self, user: users.User, r: req.CreateRoom) -> req.CreateRoom.Response:
         # make a new room and add the requesting user to the room
-        room: ChatRoom = self.make_room(r.room_name)
+        # a backend this server doesn't know is swapped for the default, the
+        # room model tells the client which one it got
+        key_backend = r.key_backend if r.key_backend in models.KEY_BACKENDS \
+            else models.DEFAULT_KEY_BACKEND
+        room: ChatRoom = self.make_room(r.room_name, key_backend)
 
         self.add_user_to_room(user, room.uid)
 
         # return the room model and invite code
         return req.CreateRoom.Response(room=room.model(), invite_code=room.invite_code)
     
-    def on_join_room(self, user: users.User, r: req.JoinRoom) -> req.JoinRoom.Response:
+    async def on_join_room(self, user: users.User, r: req.JoinRoom) -> req.JoinRoom.Response:
         room = self.invite_codes.get(r.invite_code)
 
+        # the room may be held by another worker
+        if room is None and self.bus is not None:
+            if (found := await self.bus.join_room(user, r.invite_code)) is not None:
+                worker, room_model = found
+                self.add_user_to_remote_room(user, worker, room_model.uid)
+                return req.JoinRoom.Response(room=room_model)
+
+        if room is None:
+            return req.JoinRoom.Response(error='No room with that invite code')
         self.add_user_to_room(user, room.uid)
 
         return req.JoinRoom.Response(room=room.model())
+
+    def history_page(self, r: req.GetHistory) -> tuple[int | None, list[bytes]]:
+        """The first seq and frames of the page of a room on this worker"""
+        room = self.rooms.get(r.room_uid)
+        if room is None or room.log is None:
+            return None, []
+        records = room.log.page(r.before, r.since, r.limit)
+        return (records[0][0] if records else None), [frame for _, _, frame in records]
+
+    async def on_get_history(self, user: users.User, r: req.GetHistory) -> req.GetHistory.Response:
+        """Send a page of the room's stored messages, for members only"""
+        if r.room_uid not in self.rooms_of(user):
+            return req.GetHistory.Response(error='Not a member of the room')
+
+        if (remote := self.remote_rooms.get(r.room_uid)) is not None:
+            first_seq, frames = await self.bus.get_history(remote.worker, r)
+        else:
+            first_seq, frames = self.history_page(r)
+
+        for frame in frames:
+            await user.stream.write(Envelope.from_frame(frame))
+        return req.GetHistory.Response(first_seq=first_seq, count=len(frames))
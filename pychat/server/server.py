@@ -1,24 +1,63 @@
 import asyncio
 from asyncio import StreamReader, StreamWriter
+import json
+import os
 
 from pychat.common import request as req
-from pychat.common.stream import SERVER_IP, PORT, DataStream
+from pychat.common import transport
+from pychat.common.metrics import StreamMetrics
+from pychat.common.stream import SERVER_IP, PORT, DataStream, OverflowPolicy
+from pychat.server.history import HistoryStore
+from pychat.server.metrics import ServerMetrics
 from pychat.server.rooms import ChatRooms
 from pychat.server import users
 
 
+MAX_CONCURRENT_REQUESTS = 32  # per connection
+
+
 class PychatServer:
-    def __init__(self):
+    def __init__(self, buffered_transport: bool = True, host: str = SERVER_IP,
+                 port: int = PORT, reuse_port: bool = False,
+                 history_dir: str | None = None, stats_path: str | None = None,
+                 remote_stats: bool = False):
+        """With `buffered_transport`, connections use the zero-copy
+        FrameProtocol instead of asyncio streams. With `reuse_port`, several
+        worker processes can accept on the same port. Room history is only
+        kept with `history_dir`, in that directory.
+        With `stats_path`, the server's stats, each connection's included,
+        are written as JSON to anyone connecting to a Unix socket there.
+        Clients can only ask for them (GetServerStats) with `remote_stats`,
+        and never get the per-connection ones, which name every peer"""
         self._server: asyncio.Server|None = None
-        self.rooms = ChatRooms()
-        self.users: set[users.User] = set()
+        self._stats_server: asyncio.Server | None = None
+        self.stats_path = stats_path
+        self.remote_stats = remote_stats
+        self.buffered_transport = buffered_transport
+        self.host = host
+        self.port = port  # 0 picks a free one, read it back once listening
+        self.reuse_port = reuse_port
+        self.history = HistoryStore(history_dir) if history_dir is not None else None
+        self.metrics = ServerMetrics()
+        self.rooms = ChatRooms(self.history, self.metrics)
+        self.users: dict[str, users.User] = {}
+        self.listening = asyncio.Event()
     
     async def run(self):
         """Start accepting connection and cleanup when done"""
-        self._server = await asyncio.start_server(
+        start_server = transport.start_server if self.buffered_transport \
+            else asyncio.start_server
+        self._server = await start_server(
             self._handle_user,
-            host=SERVER_IP, port=PORT
+            host=self.host, port=self.port,
+            reuse_port=self.reuse_port or None
         )
+        self.port = self._server.sockets[0].getsockname()[1]
+        if self.stats_path is not None:
+            self._stats_server = await asyncio.start_unix_server(
+                self._serve_stats, path=self.stats_path
+            )
+        self.listening.set()
 
         # start serving then cleanup
         async with self._server:
@@ -27,19 +66,71 @@ class PychatServer:
             finally:
                 await self._cleanup()
 
-    async def _handle_user(self, r: StreamReader, w: StreamWriter):
+    async def _handle_user(self, r: StreamReader | transport.FrameProtocol,
+                           w: StreamWriter | transport.FrameWriter):
         """Create a new user and start listening for data"""
-        user = users.User(DataStream(r, w))
-        self.users.add(user)
+        # a client that can't keep up is dropped instead of stalling its rooms
+        user = users.User(DataStream(
+            r, w,
+            overflow=OverflowPolicy.DISCONNECT,
+            max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+        ))
+        self.users[user.uid] = user
 
         self.rooms.register_user(user)
+        if self.remote_stats:
+            user.stream.register_request_handler(req.GetServerStats, self.on_get_server_stats)
 
         try:
             await user.listen()
         finally:
             self.rooms.purge_user(user)
-            self.users.remove(user)
+            del self.users[user.uid]
+            self.metrics.connection_closed(user.stream.metrics)
+
+    def stats(self, connections: bool = False) -> dict:
+        """Totals over every connection so far, and the server's own numbers.
+        With `connections`, each open connection's counters too"""
+        streams = StreamMetrics()
+        streams.merge(self.metrics.closed)
+        for user in self.users.values():
+            if user.stream.metrics is not None:
+                streams.merge(user.stream.metrics)
+
+        stats = {
+            'connections': len(self.users),
+            'rooms': len(self.rooms.rooms),
+            'streams': streams.to_dict(),
+            'broadcast': self.metrics.broadcast.to_dict(),
+            'broadcast_by_room': {
+                uid: h.to_dict() for uid, h in self.metrics.broadcast_by_room.items()
+            },
+            'key_exchange': self.metrics.key_exchange.to_dict(),
+        }
+        if connections:
+            stats['by_connection'] = {
+                str(user.stream.peername): user.stream.metrics.to_dict()
+                for user in self.users.values() if user.stream.metrics is not None
+            }
+        return stats
+
+    def on_get_server_stats(self, r: req.GetServerStats) -> req.GetServerStats.Response:
+        return req.GetServerStats.Response(stats=self.stats())
+
+    async def _serve_stats(self, r: StreamReader, w: StreamWriter):
+        w.write(json.dumps(self.stats(connections=True)).encode() + b'\n')
+        try:
+            await w.drain()
+        finally:
+            w.close()
 
     async def _cleanup(self):
-        coros = [user.cleanup() for user in self.users]
+        coros = [user.cleanup() for user in self.users.values()]
         await asyncio.gather(*coros)
+
+        if self._stats_server is not None:
+            self._stats_server.close()
+            os.unlink(self.stats_path)
+
+        if self.history is not None:
+            self.history.close()
@@ -1,10 +1,28 @@
+from pychat.common.utils import make_uid
+
 
 class User:
     def __init__(self, stream):
+        self.uid = make_uid()
         self.stream = stream
-    
+
     async def listen(self):
         await self.stream.listen()
 
     async def cleanup(self):
-        await self.stream.close_connection()
\ No newline at end of file
+        await self.stream.close_connection()
+
+
+class RemoteUser(User):
+    """A member of a room on this worker who is connected to another worker.
+    Its stream forwards requests to them over the worker bus"""
+    def __init__(self, uid: str, worker: int, stream):
+        self.uid = uid
+        self.worker = worker
+        self.stream = stream
+
+    async def listen(self):
+        pass
+
+    async def cleanup(self):
+        pass
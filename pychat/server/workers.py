@@ -0,0 +1,83 @@
+"""Run the server as several worker processes accepting on one port.
+
+Each worker is a PychatServer bound with SO_REUSEPORT, so the kernel spreads
+new connections over the workers (Linux and BSD only). The workers reach each
+other's users over a WorkerBus in a temporary directory."""
+import asyncio
+import multiprocessing
+import os
+import signal
+import tempfile
+
+from pychat.common.stream import SERVER_IP, PORT
+from pychat.server.bus import WorkerBus
+from pychat.server.server import PychatServer
+
+
+def make_worker(worker_id: int, n_workers: int, bus_dir: str,
+                host: str = SERVER_IP, port: int = PORT, reuse_port: bool = True,
+                history_dir: str | None = None, remote_stats: bool = False) -> PychatServer:
+    """Make one worker's server, its bus is `server.rooms.bus`. Room uids are
+    unique, so the workers can keep history in the same directory"""
+    server = PychatServer(host=host, port=port, reuse_port=reuse_port,
+                          history_dir=history_dir, remote_stats=remote_stats)
+    server.rooms.bus = WorkerBus(worker_id, n_workers, bus_dir, server.rooms, server.users)
+    return server
+
+
+async def run_worker(server: PychatServer):
+    """Run a worker made by make_worker. It's listening (`server.listening`)
+    once it's connected to the other workers. Workers can also share a
+    process (and event loop), each on its own port, which is how the tests
+    run several of them"""
+    bus = server.rooms.bus
+    await bus.start()
+    try:
+        await server.run()
+    finally:
+        await bus.close()
+
+
+async def serve_worker(*args, **kwargs):
+    """Make and run one worker, see make_worker"""
+    await run_worker(make_worker(*args, **kwargs))
+
+
+def _run_worker(*args):
+    try:
+        asyncio.run(serve_worker(*args))
+    except KeyboardInterrupt:
+        pass
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_workers(n_workers: int | None = None, host: str = SERVER_IP, port: int = PORT,
+                history_dir: str | None = None, remote_stats: bool = False):
+    """Start `n_workers` worker processes (one per core by default) and wait
+    for them to exit"""
+    n_workers = n_workers or os.cpu_count() or 1
+    # stop the workers along with this process
+    signal.signal(signal.SIGTERM, _interrupt)
+    context = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory(prefix='pychat-bus-') as bus_dir:
+        processes = [
+            context.Process(
+                target=_run_worker,
+                args=(worker, n_workers, bus_dir, host, port, True, history_dir, remote_stats),
+                name=f'pychat-worker-{worker}', daemon=True
+            )
+            for worker in range(n_workers)
+        ]
+        for p in processes:
+            p.start()
+        try:
+            for p in processes:
+                p.join()
+        except KeyboardInterrupt:
+            for p in processes:
+                p.terminate()
+                p.join()
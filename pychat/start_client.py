@@ -1,13 +1,17 @@
 import asyncio
 
+from pychat.client import events
 from pychat.client.client import start_client
 from pychat.client.gui.root import GUIRoot
 
 
 async def main():
     gui = GUIRoot()
-    await start_client()
-    await gui.closed.wait()
+    try:
+        await start_client()
+        await gui.closed.wait()
+    finally:
+        events.pubsub.close()
 
 
 if __name__ == '__main__':
@@ -1,11 +1,32 @@
+import argparse
 import asyncio
 
 from pychat.server.server import PychatServer
+from pychat.server.workers import run_workers
 
 
-async def main():
-    await PychatServer().run()
+async def main(history_dir: str | None, stats_path: str | None, remote_stats: bool):
+    await PychatServer(history_dir=history_dir, stats_path=stats_path,
+                       remote_stats=remote_stats).run()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='Run the PyChat server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes, 0 for one per core')
+    parser.add_argument('--history-dir',
+                        help='keep room history in this directory, none is kept without it')
+    parser.add_argument('--stats-path',
+                        help='serve the server\'s stats as JSON on a Unix socket there, '
+                             'one worker only')
+    parser.add_argument('--remote-stats', action='store_true',
+                        help='let clients ask for the server\'s stats')
+    args = parser.parse_args()
+    if args.stats_path is not None and args.workers != 1:
+        parser.error('--stats-path needs a single worker')
+
+    if args.workers == 1:
+        asyncio.run(main(args.history_dir, args.stats_path, args.remote_stats))
+    else:
+        run_workers(args.workers or None, history_dir=args.history_dir,
+                    remote_stats=args.remote_stats)
@@ -0,0 +1,102 @@
+import pytest
+import asyncio
+import random
+
+from pychat.common.codec import CODECS, BINARY, JSON, pack, unpack
+from pychat.common import models
+from pychat.common import request as req
+from pychat.common.type_ids import TYPE_IDS
+
+
+@pytest.fixture(params=list(CODECS.values()), ids=lambda c: c.name)
+def codec(request):
+    return request.param
+
+
+def test_can_pack_and_unpack():
+    value = {
+        'none': None, 'bools': [True, False], 'small': 7, 'negative': -5,
+        'int64': -2 ** 40, 'bigint': 2 ** 2047 + 12345, 'neg_bigint': -2 ** 100,
+        'float': 1.5, 'str': 'x' * 300, 'bytes': b'\x00\xff' * 40000,
+        'nested': {str(i): list(range(i)) for i in range(20)},
+    }
+    assert unpack(pack(value)) == value
+
+
+def test_can_encode_and_decode_models(codec):
+    room = models.ChatRoom(uid='uid', name='room')
+    msg = models.ChatMessage(
+        user=models.User(name='name', uid='uid'), text='hello', room_uid='uid'
+    )
+    for data in (
+        req.GetDHMixedKey(fernet_uid='fernid', key=random.getrandbits(2048)),
+        req.PostMessage(message=msg),
+        req.JoinRoom.Response(uid='uid', room=room),
+    ):
+        assert codec.decode(codec.encode(data)) == data
+
+
+def test_binary_codec_is_smaller_for_dh_keys():
+    data = req.GetDHKey.Response(uid='uid', key=2 ** 2047 + 1)
+    assert len(BINARY.encode(data)) < len(JSON.encode(data)) / 2
+
+
+@pytest.mark.asyncio
+async def test_handshake_switches_codec(streams):
+    server, client = streams[0]
+    await client.handshake(codecs=['unknown', 'binary'])
+
+    assert client.codec is BINARY
+    assert server.codec is BINARY
+
+
+def test_type_ids_are_unique_and_cover_every_model():
+    assert len(set(TYPE_IDS.values())) == len(TYPE_IDS)
+    assert all(0 < type_id <= 0xFFFF for type_id in TYPE_IDS.values())
+
+    import pychat.server.bus  # noqa: F401, its models too
+    shipped = [t for t in models._MODELS.values() if t.__module__.startswith('pychat.')]
+    assert [t for t in shipped if models.type_id_of(t) is None] == []
+    assert models.id_to_type(TYPE_IDS['GetDHMixedKey.Response']) is req.GetDHMixedKey.Response
+
+    with pytest.raises(TypeError):
+        # same __qualname__ as an existing model
+        type('User', (models.StreamData,), {'__qualname__': 'User', '__module__': __name__})
+
+
+class Unlisted(req.Request):
+    text: str
+
+
+@pytest.mark.asyncio
+async def test_models_without_type_id_are_named_in_the_body(streams):
+    server, client = streams[0]
+    await client.handshake()
+    received = asyncio.Queue()
+    server.register_request_handler(Unlisted, received.put_nowait)
+
+    assert models.type_id_of(Unlisted) is None
+    assert b'Unlisted' in client.encode_frame(Unlisted(text='hi'))
+    await client.write(Unlisted(text='hi'))
+    assert (await asyncio.wait_for(received.get(), 1)).text == 'hi'
+
+
+@pytest.mark.asyncio
+async def test_handshake_enables_type_ids(streams):
+    server, client = streams[0]
+    await client.handshake()
+    frame = client.encode_frame(req.GetDHKey(fernet_uid='fernid'))
+
+    assert client.type_ids and server.type_ids
+    assert b'GetDHKey' not in frame
+    assert await client.write(req.Handshake(codecs=['json'])) is not None
+
+
+@pytest.mark.asyncio
+async def test_handshake_agrees_on_sealing(streams):
+    server, client = streams[0]
+    await client.handshake(sealed=False)
+    assert not client.sealed and not server.sealed
+
+    await client.handshake()
+    assert client.sealed and server.sealed
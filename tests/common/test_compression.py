@@ -0,0 +1,86 @@
+import pytest
+import asyncio
+import os
+import random
+
+from pychat.common.codec import BINARY
+from pychat.common.compression import (
+    CHAT_DICTIONARY_COMPRESSOR, COMPRESSORS, CompressionStats, FLAG_COMPRESSED,
+    FLAG_DICTIONARY, decompress
+)
+from pychat.common.models import serializer_for
+from pychat.common.request import (
+    GetDHMixedKey, PostFinalKey, PostMessage, PostTreeKeys, RefreshTreeKey
+)
+from pychat.common.sealed import Sealed
+
+
+@pytest.mark.parametrize('name', COMPRESSORS)
+def test_can_compress_and_decompress(name):
+    compressor = COMPRESSORS[name]
+    body = b'{"uid": "abc", "context": null, "key": 7}' * 10
+    stats = CompressionStats()
+
+    compressed, flags = compressor.compress(body, stats)
+
+    assert flags & FLAG_COMPRESSED
+    assert bool(flags & FLAG_DICTIONARY) == (compressor.zdict is not None)
+    assert decompress(compressed, flags) == body
+    assert stats.compressed == 1 and stats.ratio < 1
+
+
+def test_small_bodies_are_not_compressed():
+    stats = CompressionStats()
+    body, flags = COMPRESSORS[CHAT_DICTIONARY_COMPRESSOR].compress(b'{}', stats)
+
+    assert (body, flags) == (b'{}', 0)
+    assert stats.frames == 1 and stats.compressed == 0
+
+
+@pytest.mark.asyncio
+async def test_handshake_enables_compression(connect):
+    server, client = await connect()
+    received = []
+    server.register_request_handler(PostFinalKey, received.append)
+
+    await client.handshake(compression=['unknown', CHAT_DICTIONARY_COMPRESSOR])
+    await client.write(PostFinalKey(fernet_uid='fernid', key=2 ** 2047))
+    await asyncio.sleep(0.05)
+
+    assert server.compressor is client.compressor is COMPRESSORS[CHAT_DICTIONARY_COMPRESSOR]
+    assert received[0].key == 2 ** 2047
+    assert client.compression_stats.compressed == 1
+
+
+def body_of(data) -> bytes:
+    """The part of a binary frame that gets compressed, see encode_frame"""
+    d = serializer_for(data.__class__).to_dict(data, named=False)
+    d.pop('uid', None)
+    return BINARY.dumps(d)
+
+
+def test_dictionary_improves_ratio_on_current_frames():
+    rng = random.Random(0)
+    key = lambda: rng.getrandbits(255)  # an x25519 public key
+    bodies = []
+    for epoch in range(1, 20):
+        room = os.urandom(5).hex()
+        sealed = Sealed(encrypted_type='ChatMessage', fernet_id=room, epoch=epoch,
+                        nonce=os.urandom(12), ciphertext=os.urandom(rng.randint(80, 120)))
+        bodies += [
+            body_of(PostMessage(message=sealed)),
+            body_of(GetDHMixedKey(fernet_uid=room, epoch=epoch, seal=True, key=key())),
+            body_of(RefreshTreeKey(fernet_uid=room, epoch=epoch, seal=True,
+                                   co_path=[key() for _ in range(3)])),
+            body_of(PostTreeKeys(fernet_uid=room, epoch=epoch, seal=True,
+                                 co_path=[key() for _ in range(2)])),
+        ]
+
+    ratios = {}
+    for name in (CHAT_DICTIONARY_COMPRESSOR, 'zlib'):
+        stats = CompressionStats()
+        for body in bodies:
+            COMPRESSORS[name].compress(body, stats)
+        ratios[name] = stats.ratio
+
+    assert ratios[CHAT_DICTIONARY_COMPRESSOR] < 0.9 * ratios['zlib']
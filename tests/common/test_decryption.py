@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+from pychat.client import diffiehellman as dh
+from pychat.client.decryption import DecryptionPipeline
+from pychat.client.rooms import ChatRoom
+from pychat.common.sealed import NONCE_SIZE, Sealed, associated_data, seal
+from pychat.common import models
+
+
+@pytest.fixture
+def room():
+    room = ChatRoom('room', 'roomuid')
+    room.use_key(dh.secret_key(), epoch=1)
+    return room
+
+
+def make_message(text: str) -> models.ChatMessage:
+    return models.ChatMessage(user=models.User(name='name', uid='uid'), text=text, room_uid='roomuid')
+
+
+@pytest.mark.asyncio
+async def test_messages_are_delivered_in_order(room):
+    delivered = []
+    pipeline = DecryptionPipeline({room.uid: room}, lambda m: delivered.append(m.text), batch_size=4)
+    other_key = dh.create_aead(dh.secret_key())
+
+    texts = [str(i) for i in range(10)]
+    for i, text in enumerate(texts):
+        msg = make_message(text)
+        if i % 3 == 0:
+            pipeline.submit(msg.encrypt(room.dh_fernet, room.uid, room.epoch))
+        elif i % 3 == 1:
+            pipeline.submit(seal(msg, room.dh_aead, room.uid, room.epoch))
+        else:
+            pipeline.submit(msg)
+    pipeline.submit(seal(make_message('lost'), other_key, room.uid, room.epoch))
+    pipeline.submit(seal(make_message('old'), room.dh_aead, room.uid, epoch=0))
+    assert pipeline.queue_depth == 12
+
+    await pipeline.drain()
+    assert delivered == texts
+    assert pipeline.queue_depth == 0
+    assert pipeline.stats.messages == 12
+    assert pipeline.stats.failed == 2
+    assert pipeline.stats.batches == 3
+    pipeline.close()
+
+
+@pytest.mark.asyncio
+async def test_malformed_message_is_dropped(room):
+    delivered = []
+    pipeline = DecryptionPipeline({room.uid: room}, lambda m: delivered.append(m.text))
+
+    # sealed under the right key, but the plaintext isn't a packed message
+    nonce = os.urandom(NONCE_SIZE)
+    ad = associated_data(room.uid, room.epoch, 'ChatMessage')
+    garbage = Sealed.construct(
+        encrypted_type='ChatMessage', fernet_id=room.uid, epoch=room.epoch, nonce=nonce,
+        ciphertext=room.dh_aead.encrypt(nonce, b'\xc1 not packed', ad)
+    )
+    pipeline.submit(garbage)
+    pipeline.submit(seal(make_message('after'), room.dh_aead, room.uid, room.epoch))
+
+    await pipeline.drain()
+    assert delivered == ['after']
+    assert pipeline.stats.failed == 1
+    assert pipeline.queue_depth == 0
+    pipeline.close()
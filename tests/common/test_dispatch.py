@@ -0,0 +1,104 @@
+import pytest
+import asyncio
+
+from pychat.client.rooms import ChatRoom, ChatRooms
+from pychat.common.request import GetDHKey, PostFinalKey
+
+
+@pytest.mark.asyncio
+async def test_slow_handler_does_not_block_other_requests(connect):
+    server, client = await connect(max_concurrent_requests=4)
+    release = asyncio.Event()
+
+    async def slow(r: PostFinalKey):
+        await release.wait()
+
+    server.register_request_handlers(
+        (PostFinalKey, slow),
+        (GetDHKey, lambda r: GetDHKey.Response(key=777)),
+    )
+
+    await client.write(PostFinalKey(fernet_uid='fernid', key=1))
+    resp = await asyncio.wait_for(client.write(GetDHKey(fernet_uid='fernid')), 1)
+
+    assert resp.key == 777
+    release.set()
+
+
+@pytest.mark.asyncio
+async def test_requests_with_same_order_key_keep_order(connect):
+    server, client = await connect(max_concurrent_requests=8)
+    handled = []
+
+    async def handle(r: PostFinalKey):
+        # earlier requests of a room take longer than later ones
+        await asyncio.sleep(0.01 * (5 - r.key))
+        handled.append((r.fernet_uid, r.key))
+
+    server.register_request_handler(PostFinalKey, handle, order_by=lambda r: r.fernet_uid)
+
+    for key in range(5):
+        for room in ('a', 'b'):
+            await client.write(PostFinalKey(fernet_uid=room, key=key))
+    await asyncio.sleep(0.3)
+
+    for room in ('a', 'b'):
+        assert [k for r, k in handled if r == room] == list(range(5))
+
+
+@pytest.mark.asyncio
+async def test_close_connection_cancels_handlers(connect):
+    server, client = await connect(max_concurrent_requests=4)
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def handle(r: PostFinalKey):
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    server.register_request_handler(PostFinalKey, handle)
+    await client.write(PostFinalKey(fernet_uid='fernid', key=1))
+    await asyncio.wait_for(started.wait(), 1)
+
+    await server.close_connection()
+
+    assert cancelled.is_set()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('type_ids', (False, True))
+async def test_unhandled_request_gets_an_error(connect, type_ids):
+    server, client = await connect()
+    if type_ids:
+        await client.handshake()
+
+    resp = await asyncio.wait_for(client.write(GetDHKey(fernet_uid='fernid')), 1)
+
+    assert 'GetDHKey' in resp.error
+
+
+@pytest.mark.asyncio
+async def test_client_key_requests_for_rooms_overlap(connect, monkeypatch):
+    # the "server" end here is the client's stream
+    stream, server = await connect(max_concurrent_requests=4)
+    rooms = ChatRooms(stream)
+    for uid in ('slow', 'fast'):
+        rooms.rooms[uid] = ChatRoom(uid, uid)
+    rooms.rooms['fast'].set_keys((1, 2))
+    release = asyncio.Event()
+
+    async def slow_keys():
+        await release.wait()
+        rooms.rooms['slow'].set_keys((3, 4))
+    monkeypatch.setattr(rooms.rooms['slow'], 'ensure_keys', slow_keys)
+
+    slow = asyncio.create_task(server.write(GetDHKey(fernet_uid='slow')))
+    resp = await asyncio.wait_for(server.write(GetDHKey(fernet_uid='fast')), 1)
+
+    assert resp.key == 2 and not slow.done()
+    release.set()
+    assert (await slow).key == 4
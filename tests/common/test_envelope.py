@@ -0,0 +1,46 @@
+import pytest
+import asyncio
+
+from pychat.common import models
+from pychat.common.envelope import Envelope
+from pychat.common.request import PostMessage
+
+
+@pytest.fixture
+def post(fernet) -> PostMessage:
+    message = models.ChatMessage(
+        user=models.User(name='name', uid='useruid'), text='hello', room_uid='roomuid'
+    )
+    return PostMessage(message=message.encrypt(fernet, 'roomuid'))
+
+
+@pytest.mark.asyncio
+async def test_lazy_handler_gets_undecoded_envelope(connect, post):
+    server, client = await connect()
+    received = asyncio.Future()
+    server.register_request_handler(PostMessage, received.set_result, lazy=True)
+    await client.handshake()
+
+    await client.write(post)
+    envelope = await asyncio.wait_for(received, 1)
+
+    assert isinstance(envelope, Envelope)
+    assert envelope.uid == post.uid
+    assert envelope.routing_key == 'roomuid'
+    assert envelope._model is None
+
+    assert envelope.model == post
+    assert envelope.message.fernet_id == 'roomuid'
+
+
+@pytest.mark.asyncio
+async def test_forwarded_envelope_decodes_on_other_side(connect, post):
+    server, client = await connect()
+    server.register_request_handler(PostMessage, server.write, lazy=True)
+    forwarded = asyncio.Future()
+    client.register_request_handler(PostMessage, forwarded.set_result)
+    await client.handshake()
+
+    await client.write(post)
+
+    assert await asyncio.wait_for(forwarded, 1) == post
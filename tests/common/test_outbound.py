@@ -0,0 +1,138 @@
+import pytest
+import asyncio
+
+from pychat.common.codec import JSON
+from pychat.common.request import PostFinalKey
+from pychat.common.stream import DataStream, OverflowPolicy, FRAME_HEADER, broadcast
+
+
+class StalledWriter:
+    """StreamWriter stand-in whose drain() blocks until released"""
+    def __init__(self):
+        self.written: list[bytes] = []
+        self.released = asyncio.Event()
+        self.closed = False
+        self.writelines_calls = 0
+
+    def get_extra_info(self, name):
+        return ('stalled', 0)
+
+    def writelines(self, frames):
+        self.writelines_calls += 1
+        self.written.extend(frames)
+
+    async def drain(self):
+        await self.released.wait()
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+
+def keys(writer: StalledWriter) -> list[int]:
+    return [
+        JSON.decode(frame[FRAME_HEADER.size:]).key for frame in writer.written
+    ]
+
+
+async def write_keys(stream: DataStream, n: int):
+    for key in range(n):
+        await stream.write(PostFinalKey(fernet_uid='fernid', key=key))
+    await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_queued_frames_are_coalesced():
+    writer = StalledWriter()
+    stream = DataStream(None, writer)
+
+    await write_keys(stream, 10)
+    writer.released.set()
+    await asyncio.sleep(0.01)
+
+    assert keys(writer) == list(range(10))
+    assert writer.writelines_calls == 1
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_policy():
+    writer = StalledWriter()
+    stream = DataStream(None, writer, queue_size=3, overflow=OverflowPolicy.DROP_OLDEST)
+
+    for key in range(10):
+        await broadcast([stream], PostFinalKey(fernet_uid='fernid', key=key))
+    writer.released.set()
+    await asyncio.sleep(0.01)
+
+    assert keys(writer) == [7, 8, 9]
+    assert stream.frames_dropped == 7
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest_policy_keeps_written_frames():
+    writer = StalledWriter()
+    stream = DataStream(None, writer, queue_size=3, overflow=OverflowPolicy.DROP_OLDEST)
+
+    await write_keys(stream, 1)  # taken by the writer task, stuck draining
+    for key in (1, 2):
+        await broadcast([stream], PostFinalKey(fernet_uid='fernid', key=key))
+    for key in (3, 4, 5):  # makes room by dropping the broadcasts
+        await stream.write(PostFinalKey(fernet_uid='fernid', key=key))
+    task = asyncio.create_task(stream.write(PostFinalKey(fernet_uid='fernid', key=6)))
+    await asyncio.sleep(0)
+    assert not task.done()
+
+    writer.released.set()
+    await asyncio.wait_for(task, 1)
+    await asyncio.sleep(0.01)
+    assert keys(writer) == [0, 3, 4, 5, 6]
+    assert stream.frames_dropped == 2
+
+
+@pytest.mark.asyncio
+async def test_disconnect_policy():
+    writer = StalledWriter()
+    stream = DataStream(None, writer, queue_size=3, overflow=OverflowPolicy.DISCONNECT)
+
+    with pytest.raises(ConnectionResetError):
+        await write_keys(stream, 10)
+    await stream._close_task
+    assert writer.closed
+
+    # listen() closing it again once the connection is gone
+    await stream.close_connection()
+    with pytest.raises(ConnectionResetError):
+        await write_keys(stream, 1)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_encodes_once_per_frame_format():
+    writers = [StalledWriter() for _ in range(3)]
+    streams = [DataStream(None, w) for w in writers]
+    writers[0].closed = True
+
+    assert await broadcast(streams, PostFinalKey(fernet_uid='fernid', key=5)) == 2
+    await asyncio.sleep(0)
+
+    assert writers[0].written == []
+    assert keys(writers[1]) == keys(writers[2]) == [5]
+    assert writers[1].written[0] is writers[2].written[0]
+
+
+@pytest.mark.asyncio
+async def test_broadcast_waits_on_blocking_streams():
+    writer = StalledWriter()
+    stream = DataStream(None, writer, queue_size=1)
+    await write_keys(stream, 2)
+
+    task = asyncio.create_task(broadcast([stream], PostFinalKey(fernet_uid='fernid', key=2)))
+    await asyncio.sleep(0)
+    assert not task.done()
+
+    writer.released.set()
+    assert await asyncio.wait_for(task, 1) == 1
@@ -0,0 +1,207 @@
+import asyncio
+import gc
+
+import pytest
+
+from pychat.common.pubsub import Overflow, PubSub
+
+
+class Event:
+    def __init__(self, topic_key=None):
+        self.topic_key = topic_key
+
+
+class Listener:
+    def __init__(self):
+        self.events = []
+
+    def on_event(self, e):
+        self.events.append(e)
+
+
+def test_events_go_to_their_key_and_to_any_key():
+    pubsub = PubSub()
+    room_a, room_b, everything = [], [], []
+    pubsub.subscribe(Event, room_a.append, key='a')
+    pubsub.subscribe(Event, room_b.append, key='b')
+    pubsub.subscribe(Event, everything.append)
+
+    events = [Event('a'), Event('b'), Event()]
+    for e in events:
+        pubsub.publish(e)
+    assert (room_a, room_b, everything) == ([events[0]], [events[1]], events)
+
+
+def test_unsubscribe():
+    pubsub = PubSub()
+    received = []
+    sub = pubsub.subscribe(Event, received.append, key='a')
+    sub.unsubscribe()
+    sub.unsubscribe()
+    pubsub.publish(Event('a'))
+    assert received == [] and pubsub.subscribers == {}
+
+
+def test_weak_subscriptions_dont_keep_subscribers_alive():
+    pubsub = PubSub()
+    listener = Listener()
+    pubsub.subscribe(Event, listener.on_event, key='a', weak=True)
+    pubsub.publish(Event('a'))
+    assert len(listener.events) == 1
+
+    del listener
+    gc.collect()
+    assert pubsub.subscribers == {}
+    pubsub.publish(Event('a'))
+
+
+@pytest.mark.asyncio
+async def test_coroutine_subscribers_run_as_tasks():
+    pubsub = PubSub()
+    received = []
+
+    async def on_event(e):
+        received.append(e)
+    pubsub.subscribe(Event, on_event)
+    pubsub.publish(Event())
+    assert received == []
+    await asyncio.sleep(0)
+    assert len(received) == 1
+
+
+@pytest.mark.asyncio
+async def test_coroutine_subscribers_are_bounded_and_ordered():
+    pubsub = PubSub(workers=2)
+    running, most_running = 0, 0
+    received = {name: [] for name in 'abc'}
+
+    def make_subscriber(name):
+        async def on_event(e):
+            nonlocal running, most_running
+            running += 1
+            most_running = max(most_running, running)
+            await asyncio.sleep(0.001)
+            received[name].append(e.topic_key)
+            running -= 1
+        return on_event
+
+    for name in received:
+        pubsub.subscribe(Event, make_subscriber(name))
+    for i in range(10):
+        pubsub.publish(Event(i))
+    await pubsub.join()
+
+    assert all(r == list(range(10)) for r in received.values())
+    assert most_running == 2
+    assert pubsub.delayed == 27 and pubsub.dropped == 0
+    pubsub.close()
+
+
+@pytest.mark.asyncio
+async def test_full_queues_drop_or_wait():
+    pubsub = PubSub(workers=1, queue_size=2)
+    received = []
+
+    async def on_event(e):
+        await asyncio.sleep(0.001)
+        received.append(e.topic_key)
+    sub = pubsub.subscribe(Event, on_event)
+
+    for i in range(4):
+        pubsub.publish(Event(i))
+    assert sub.dropped == 2
+    for i in range(4, 8):
+        await pubsub.publish_wait(Event(i))
+    await pubsub.join()
+
+    assert received == [0, 1, 4, 5, 6, 7]
+    pubsub.close()
+
+
+@pytest.mark.asyncio
+async def test_failing_subscribers_are_reported():
+    pubsub = PubSub()
+    errors, received = [], []
+    asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context['exception']))
+
+    async def on_event(e):
+        if e.topic_key == 'bad':
+            raise ValueError(e.topic_key)
+        received.append(e.topic_key)
+    pubsub.subscribe(Event, on_event)
+
+    for key in ('bad', 'good'):
+        pubsub.publish(Event(key))
+    await pubsub.join()
+
+    assert received == ['good'] and isinstance(errors[0], ValueError)
+    pubsub.close()
+
+
+@pytest.mark.asyncio
+async def test_kept_events_are_never_dropped():
+    pubsub = PubSub(workers=1, queue_size=2)
+    received = []
+
+    async def on_event(e):
+        await asyncio.sleep(0.001)
+        received.append(e.topic_key)
+    sub = pubsub.subscribe(Event, on_event, overflow=Overflow.KEEP)
+
+    for i in range(5):
+        pubsub.publish(Event(i))
+    await pubsub.join()
+
+    assert received == list(range(5)) and sub.dropped == 0
+    pubsub.close()
+
+
+@pytest.mark.asyncio
+async def test_workers_exit_when_idle_and_on_close():
+    pubsub = PubSub(workers=2)
+    started, received = asyncio.Event(), []
+
+    async def on_event(e):
+        received.append(e.topic_key)
+        if e.topic_key == 'slow':
+            started.set()
+            await asyncio.sleep(10)
+    pubsub.subscribe(Event, on_event)
+
+    pubsub.publish(Event('fast'))
+    await pubsub.join()
+    await asyncio.sleep(0)
+    assert received == ['fast'] and not pubsub._worker_tasks
+
+    pubsub.publish(Event('slow'))
+    pubsub.publish(Event('dropped'))
+    await started.wait()
+    pubsub.close()
+    await pubsub.join()
+    assert received == ['fast', 'slow']
+
+    # still usable after closing
+    pubsub.publish(Event('again'))
+    await pubsub.join()
+    assert received[-1] == 'again'
+    pubsub.close()
+
+
+@pytest.mark.asyncio
+async def test_event_published_as_a_worker_exits_is_handled():
+    pubsub = PubSub(workers=1)
+    received = []
+
+    async def on_event(e):
+        received.append(e.topic_key)
+    pubsub.subscribe(Event, on_event)
+
+    # the worker's loop ends before its task is done
+    pubsub.publish(Event(1))
+    asyncio.get_running_loop().call_soon(pubsub.publish, Event(2))
+    await asyncio.wait_for(pubsub.join(), 1)
+    await asyncio.sleep(0)
+    await asyncio.wait_for(pubsub.join(), 1)
+
+    assert received == [1, 2]
+    pubsub.close()
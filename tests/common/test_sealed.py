@@ -0,0 +1,43 @@
+import pytest
+from cryptography.exceptions import InvalidTag
+
+from pychat.client import diffiehellman as dh
+from pychat.common.codec import CODECS
+from pychat.common.sealed import Sealed, seal
+from pychat.common import models
+from pychat.common import request as req
+
+
+@pytest.fixture
+def aead():
+    return dh.create_aead(dh.secret_key())
+
+
+@pytest.fixture
+def msg():
+    return models.ChatMessage(
+        user=models.User(name='name', uid='uid'), text='hello', room_uid='room'
+    )
+
+
+def test_can_seal_and_open(aead, msg):
+    sealed = seal(msg, aead, 'room', epoch=3)
+    assert sealed.decrypt(aead) == msg
+
+
+def test_room_and_epoch_are_authenticated(aead, msg):
+    sealed = seal(msg, aead, 'room', epoch=3)
+    for changes in ({'fernet_id': 'other'}, {'epoch': 4}, {'encrypted_type': 'User'}):
+        with pytest.raises(InvalidTag):
+            sealed.copy(update=changes).decrypt(aead)
+
+    with pytest.raises(InvalidTag):
+        sealed.decrypt(dh.create_aead(dh.secret_key()))
+
+
+@pytest.mark.parametrize('codec', CODECS.values(), ids=lambda c: c.name)
+def test_sealed_messages_survive_codecs(codec, aead, msg):
+    data = req.PostMessage(message=seal(msg, aead, 'room', epoch=None))
+    decoded = codec.decode(codec.encode(data))
+    assert isinstance(decoded.message, Sealed)
+    assert decoded.message.decrypt(aead) == msg
@@ -0,0 +1,41 @@
+import pytest
+from pydantic import ValidationError
+
+from pychat.common import models
+from pychat.common import request as req
+from pychat.common.models import serializer_for
+
+
+USER = models.User(name='name', uid='uid')
+
+
+@pytest.mark.parametrize('data', [
+    req.PostMessage(message=models.ChatMessage(user=USER, text='hi', room_uid='room')),
+    req.PostMessage(message=models.Encrypted(encrypted_type='ChatMessage', fernet_id='f', ciphertext='c')),
+    req.GetDHKey.Response(uid='uid', key=2 ** 2047),
+    req.Handshake(codecs=['json'], context={'a': [1, 2]}),
+], ids=lambda d: d.__class__.__qualname__)
+def test_serializer_matches_pydantic(data):
+    serializer = serializer_for(data.__class__)
+    d = data.dict()
+    d['__name__'] = data.__class__.__qualname__
+
+    assert serializer.to_dict(data) == d
+    parsed = serializer.parse(d)
+    assert parsed == data
+    assert type(parsed.__dict__.get('message')) is type(data.__dict__.get('message'))
+    assert parsed.__fields_set__ == data.__class__.parse_obj(d).__fields_set__
+
+
+def test_serializer_validates():
+    serializer = serializer_for(req.GetDHMixedKey)
+
+    assert serializer.parse({'fernet_uid': 'f', 'key': '12'}).key == 12
+    with pytest.raises(ValidationError):
+        serializer.parse({'fernet_uid': 'f', 'key': 'twelve'})
+    with pytest.raises(ValidationError):
+        serializer.parse({'fernet_uid': 'f'})
+
+
+def test_serializer_is_cached():
+    assert serializer_for(models.User) is serializer_for(models.User)
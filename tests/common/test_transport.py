@@ -0,0 +1,65 @@
+import pytest
+import asyncio
+import socket
+
+from pychat.common import transport
+from pychat.common.codec import BINARY
+from pychat.common.request import PostFinalKey
+from pychat.common.stream import DataStream, FRAME_HEADER
+
+
+async def buffered_pair(**kwargs) -> tuple[DataStream, asyncio.StreamWriter]:
+    """Return a DataStream on a FrameProtocol and a raw writer to feed it"""
+    server_sock, client_sock = socket.socketpair()
+    loop = asyncio.get_running_loop()
+    tr, protocol = await loop.create_connection(
+        lambda: transport.FrameProtocol(**kwargs), sock=server_sock
+    )
+    _, writer = await asyncio.open_connection(sock=client_sock)
+    stream = DataStream(protocol, transport.FrameWriter(tr, protocol), codec=BINARY)
+    return stream, writer
+
+
+@pytest.mark.asyncio
+async def test_can_receive_frames_larger_than_buffer():
+    stream, writer = await buffered_pair(buffer_size=1024)
+    received = []
+    stream.register_request_handler(PostFinalKey, received.append)
+    asyncio.create_task(stream.listen())
+
+    keys = [2 ** (8 * n) for n in (1, 5000, 3, 20000, 7)]
+    for key in keys:
+        writer.write(stream.encode_frame(PostFinalKey(fernet_uid='fernid', key=key)))
+    await writer.drain()
+    await asyncio.sleep(0.1)
+
+    assert [r.key for r in received] == keys
+    writer.close()
+
+
+@pytest.mark.asyncio
+async def test_frame_over_limit_closes_connection():
+    stream, writer = await buffered_pair(max_frame_size=100)
+    listening = asyncio.create_task(stream.listen())
+
+    writer.write(FRAME_HEADER.pack(0, 0, 0, 101))
+    await writer.drain()
+    await asyncio.wait_for(listening, 1)
+
+    assert stream.writer.is_closing()
+    writer.close()
+
+
+@pytest.mark.asyncio
+async def test_buffered_streams_can_make_requests():
+    server_sock, client_sock = socket.socketpair()
+    server = DataStream(*await transport.open_connection(sock=server_sock))
+    client = DataStream(*await transport.open_connection(sock=client_sock))
+    for s in (server, client):
+        asyncio.create_task(s.listen())
+
+    await client.handshake()
+
+    assert server.codec is client.codec
+    for s in (server, client):
+        s.writer.close()
@@ -0,0 +1,45 @@
+import pytest
+import asyncio
+import time
+
+from pychat.common.request import GetDHKey
+
+
+@pytest.mark.asyncio
+async def test_request_times_out(connect):
+    server, client = await connect()
+
+    async def never_respond(r: GetDHKey):
+        await asyncio.sleep(10)
+
+    server.register_request_handler(GetDHKey, never_respond)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await client.write(GetDHKey(fernet_uid='fernid'), timeout=0.05)
+
+    assert len(client.request_waiters) == 0
+
+
+@pytest.mark.asyncio
+async def test_waiters_fail_when_connection_closes(connect):
+    server, client = await connect(max_concurrent_requests=4)
+    server.register_request_handler(GetDHKey, lambda r: asyncio.sleep(10))
+
+    pending = [
+        asyncio.create_task(client.write(GetDHKey(fernet_uid='fernid')))
+        for _ in range(3)
+    ]
+    await asyncio.sleep(0)  # the requests are sent and waited on
+    added = time.monotonic()
+    # loop timers can fire a little early, so it's measured rather than assumed
+    await asyncio.sleep(0.05)
+
+    assert len(client.request_waiters) == 3
+    assert client.request_waiters.oldest_age >= time.monotonic() - added > 0
+
+    await client.close_connection()
+
+    for task in pending:
+        with pytest.raises(ConnectionResetError):
+            await task
+    assert len(client.request_waiters) == 0
@@ -1,5 +1,6 @@
 import pytest, pytest_asyncio
 import asyncio
+import socket
 
 from pychat.client.diffiehellman import create_fernet
 from pychat.common.stream import DataStream, SERVER_IP, PORT
@@ -50,6 +51,27 @@ async def streams() -> list[tuple[DataStream, DataStream]]:
     await server.wait_closed()
 
 
+@pytest_asyncio.fixture
+async def connect():
+    """Return a function that connects a server DataStream to a client
+    DataStream over a socket pair. Keyword arguments go to the server stream"""
+    streams: list[DataStream] = []
+
+    async def connect(**kwargs) -> tuple[DataStream, DataStream]:
+        server_sock, client_sock = socket.socketpair()
+        server = DataStream(*await asyncio.open_connection(sock=server_sock), **kwargs)
+        client = DataStream(*await asyncio.open_connection(sock=client_sock))
+        for s in (server, client):
+            asyncio.create_task(s.listen())
+            streams.append(s)
+        return server, client
+
+    yield connect
+
+    for s in streams:
+        s.writer.close()
+
+
 @pytest.fixture
 def fernet():
     return create_fernet(123478686)
\ No newline at end of file
@@ -0,0 +1,117 @@
+import pytest
+import asyncio
+import os
+
+from pychat.client import events
+from pychat.client.client import MAX_CONCURRENT_REQUESTS
+from pychat.client.rooms import ChatRooms
+from pychat.common import models
+from pychat.common import request as req
+from pychat.common.stream import DataStream
+from pychat.server.history import MessageLog, RECORD, WRITE_DELAY
+from pychat.server.server import PychatServer
+
+PORT = 8920
+
+
+def test_log_pages_across_segments(tmp_path):
+    log = MessageLog(str(tmp_path), segment_size=100, max_age=float('inf'))
+    for i in range(20):
+        assert log.append(b'frame %d' % i, t=float(i)) == i
+
+    assert len(log.segments) > 1
+    assert [seq for seq, _, _ in log.page(limit=3)] == [17, 18, 19]
+    assert [frame for _, _, frame in log.page(before=2)] == [b'frame 0', b'frame 1']
+    assert [seq for seq, _, _ in log.page(since=15.5)] == [16, 17, 18, 19]
+
+
+def test_log_reloads_and_drops_partial_record(tmp_path):
+    log = MessageLog(str(tmp_path), segment_size=100)
+    for i in range(10):
+        log.append(b'frame %d' % i)
+    log.close()
+
+    # a crash in the middle of writing a record
+    with open(log.segments[-1].path, 'ab') as f:
+        f.write(RECORD.pack(10, 0.0, 100) + b'cut')
+
+    log = MessageLog(str(tmp_path), segment_size=100)
+    assert log.next_seq == 10
+    assert log.append(b'next') == 10
+    assert [frame for _, _, frame in log.page(limit=2)] == [b'frame 9', b'next']
+
+
+def test_retention_deletes_oldest_segments(tmp_path):
+    log = MessageLog(str(tmp_path), segment_size=100, max_size=300, max_age=50)
+    for i in range(40):
+        log.append(b'x' * 20, t=float(i))
+
+    assert log.size <= 300 + 100
+    assert len(os.listdir(tmp_path)) == len(log.segments)
+    assert log.page(before=log.first_seq) == []
+
+    log.compact(now=1000.0)
+    assert len(log.segments) == 1
+
+
+@pytest.mark.asyncio
+async def test_appends_are_written_off_the_loop(tmp_path):
+    log = MessageLog(str(tmp_path), segment_size=100)
+    for i in range(10):
+        log.append(b'frame %d' % i)
+
+    # buffered, and readable before they're written
+    assert not os.path.exists(log.segments[0].path)
+    assert [frame for _, _, frame in log.page(limit=2)] == [b'frame 8', b'frame 9']
+
+    await asyncio.sleep(WRITE_DELAY * 2)
+    assert all(not s.unwritten for s in log.segments)
+    assert sum(os.path.getsize(s.path) for s in log.segments) == log.size
+    # part written, part still buffered
+    log.append(b'next')
+    assert [frame for _, _, frame in log.page(limit=2)] == [b'frame 9', b'next']
+
+    log.close()
+    assert MessageLog(str(tmp_path), segment_size=100).next_seq == 11
+
+
+@pytest.mark.asyncio
+async def test_joining_user_gets_history(tmp_path):
+    server = PychatServer(port=PORT, history_dir=str(tmp_path))
+    task = asyncio.create_task(server.run())
+    await asyncio.sleep(0.1)
+
+    clients = []
+    for _ in range(2):
+        stream = DataStream(*await asyncio.open_connection('127.0.0.1', PORT),
+                            max_concurrent_requests=MAX_CONCURRENT_REQUESTS)
+        clients.append(ChatRooms(stream))
+        asyncio.create_task(stream.listen())
+        await stream.handshake()
+
+    resp = await clients[0].stream.write(
+        req.CreateRoom(room_name='room'), on_response=lambda r: clients[0].add_room(r.room)
+    )
+    user = models.User(name='name', uid='useruid')
+    for text in ('one', 'two', 'three'):
+        message = models.ChatMessage(user=user, text=text, room_uid=resp.room.uid)
+        await clients[0].stream.write(req.PostMessage(message=message))
+
+    # not a member yet
+    history = await clients[1].get_history(resp.room.uid)
+    assert history.error is not None
+
+    await clients[1].stream.write(
+        req.JoinRoom(invite_code=resp.invite_code),
+        on_response=lambda r: clients[1].add_room(r.room)
+    )
+    await clients[0].decryption.drain()  # its own messages coming back
+    received = []
+    events.pubsub.subscribe(events.MessageReceived, lambda e: received.append(e.message.text))
+
+    history = await clients[1].get_history(resp.room.uid, before=3, limit=2)
+    assert received == ['two', 'three']
+    assert (history.first_seq, history.count) == (1, 2)
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
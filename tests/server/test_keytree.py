@@ -0,0 +1,199 @@
+import pytest
+import asyncio
+import math
+
+from cryptography.fernet import InvalidToken
+
+from pychat.client.rooms import ChatRoom as ClientRoom, ChatRooms as ClientRooms
+from pychat.common import models
+from pychat.server.diffiehellman import KeyAgreement, TreeKeyAgreement, dh_Key_exchange
+from pychat.server.keytree import KeyTree
+
+ROOM_UID = 'room'
+
+
+class Loopback:
+    """Stands in for a client's connection by calling its handlers directly"""
+    def __init__(self, sealed: bool = True):
+        self.handlers = {}
+        self.sealed = sealed  # agreed in the Handshake
+
+    def register_request_handlers(self, *handlers):
+        for type_, callback, *_ in handlers:
+            self.handlers[type_] = callback
+
+    async def write(self, r):
+        resp = self.handlers[type(r)](r)
+        if asyncio.iscoroutine(resp):
+            resp = await resp
+        return resp
+
+
+def make_client(key_backend: str = 'ffdh', sealed: bool = True) -> tuple[ClientRooms, Loopback]:
+    stream = Loopback(sealed)
+    client = ClientRooms(stream)
+    client.rooms[ROOM_UID] = ClientRoom('room', ROOM_UID, key_backend)
+    return client, stream
+
+
+def shares_key(a: ClientRooms, b: ClientRooms) -> bool:
+    token = a.rooms[ROOM_UID].dh_fernet.encrypt(b'hello')
+    try:
+        return b.rooms[ROOM_UID].dh_fernet.decrypt(token) == b'hello'
+    except InvalidToken:
+        return False
+
+
+def test_tree_stays_balanced():
+    tree = KeyTree()
+    for member in range(100):
+        tree.insert(member, 1)
+        assert tree.depth() == math.ceil(math.log2(member + 1))
+
+    for member in range(0, 100, 2):
+        tree.remove(member)
+    assert len(tree) == 50
+    assert tree.depth() <= 7
+    assert all(len(tree.co_path(m)) == tree.leaves[m].depth() for m in tree.leaves)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('key_backend', ['ffdh', 'x25519'])
+async def test_members_agree_after_joins_and_leaves(key_backend):
+    agreement = TreeKeyAgreement(ROOM_UID, debounce=0)
+    clients = [make_client(key_backend) for _ in range(7)]
+    for client, stream in clients:
+        agreement.join(client, stream)
+        await agreement.settled()
+
+    first = clients[0][0]
+    assert all(shares_key(first, client) for client, _ in clients[1:])
+
+    gone = [client for client, _ in clients[1::2]]
+    for client in gone:
+        agreement.leave(client)
+        await agreement.settled()
+    staying = [client for client, _ in clients[::2]]
+
+    assert all(shares_key(first, client) for client in staying[1:])
+    # members who left can't read messages sent with the new key
+    assert not any(shares_key(first, client) for client in gone)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('n_members', [2, 3, 4, 5])
+async def test_room_key_changes_whenever_a_member_leaves(n_members):
+    for leaving in range(n_members):
+        agreement = TreeKeyAgreement(ROOM_UID, debounce=0)
+        clients = [make_client('x25519') for _ in range(n_members)]
+        room_keys = set()
+        for client, stream in clients:
+            agreement.join(client, stream)
+            await agreement.settled()
+            room_keys.add(clients[0][0].rooms[ROOM_UID].tree_secrets[-1])
+
+        gone, _ = clients.pop(leaving)
+        agreement.leave(gone)
+        await agreement.settled()
+
+        staying = [client for client, _ in clients]
+        new_keys = {client.rooms[ROOM_UID].tree_secrets[-1] for client in staying}
+        assert len(new_keys) == 1
+        assert not new_keys & room_keys, f'member {leaving} of {n_members} left'
+
+
+@pytest.mark.asyncio
+async def test_changes_close_together_share_an_exchange():
+    agreement = TreeKeyAgreement(ROOM_UID, debounce=0.05)
+    clients = [make_client() for _ in range(6)]
+    for client, stream in clients[:3]:
+        agreement.join(client, stream)
+    await asyncio.sleep(0.01)
+    for client, stream in clients[3:]:
+        agreement.join(client, stream)
+    agreement.leave(clients[0][0])
+    await agreement.settled()
+
+    assert agreement.epoch == 1
+    rooms = [client.rooms[ROOM_UID] for client, _ in clients[1:]]
+    assert all(room.epoch == 1 for room in rooms)
+    assert all(shares_key(clients[1][0], client) for client, _ in clients[2:])
+    assert clients[0][0].rooms[ROOM_UID].dh_fernet is None
+
+
+@pytest.mark.asyncio
+async def test_messages_decrypt_with_the_key_of_their_epoch():
+    agreement = TreeKeyAgreement(ROOM_UID, debounce=0)
+    (alice, alice_stream), (bob, bob_stream) = make_client(), make_client()
+    agreement.join(alice, alice_stream)
+    agreement.join(bob, bob_stream)
+    await agreement.settled()
+
+    room = alice.rooms[ROOM_UID]
+    message = models.ChatMessage(user=models.User(name='a', uid='a'), text='hi', room_uid=ROOM_UID)
+    sent = message.encrypt(room.dh_fernet, ROOM_UID, room.epoch)
+
+    # a new exchange finishes before the message arrives
+    carol, carol_stream = make_client()
+    agreement.join(carol, carol_stream)
+    await agreement.settled()
+
+    bob_room = bob.rooms[ROOM_UID]
+    assert bob_room.epoch == sent.epoch + 1
+    assert sent.decrypt(bob_room.fernet_for(sent)) == message
+    assert carol.rooms[ROOM_UID].fernet_for(sent) is None
+
+
+@pytest.mark.asyncio
+async def test_ring_exchange_with_x25519():
+    clients = [make_client('x25519') for _ in range(4)]
+    await dh_Key_exchange(ROOM_UID, [stream for _, stream in clients], epoch=1)
+
+    first = clients[0][0]
+    assert all(shares_key(first, client) for client, _ in clients[1:])
+
+
+@pytest.mark.asyncio
+async def test_rooms_seal_once_every_member_can_read_it():
+    agreement = TreeKeyAgreement(ROOM_UID, debounce=0)
+    clients = [make_client(), make_client()]
+    for client, stream in clients:
+        agreement.join(client, stream)
+    await agreement.settled()
+    rooms = [client.rooms[ROOM_UID] for client, _ in clients]
+    assert all(room.sealing for room in rooms)
+
+    # a client that only reads Fernet tokens joins
+    old, old_stream = make_client(sealed=False)
+    agreement.join(old, old_stream)
+    await agreement.settled()
+    rooms.append(old.rooms[ROOM_UID])
+    assert not any(room.sealing for room in rooms)
+
+    message = models.ChatMessage(user=models.User(name='a', uid='a'), text='hi', room_uid=ROOM_UID)
+    sent = rooms[0].encrypt(message)
+    assert isinstance(sent, models.Encrypted)
+    assert sent.decrypt(rooms[2].fernet_for(sent)) == message
+
+    agreement.leave(old)
+    await agreement.settled()
+    assert all(room.sealing for room in rooms[:2])
+
+
+def test_key_agreement_needs_an_exchange():
+    with pytest.raises(TypeError):
+        KeyAgreement(ROOM_UID)
+
+
+@pytest.mark.asyncio
+async def test_client_room_takes_keypair_on_first_request():
+    room = ClientRoom('room', ROOM_UID, 'x25519')
+    assert room.dh_public is None
+
+    # requests arriving together share the first keypair
+    await asyncio.gather(*(room.ensure_keys() for _ in range(3)))
+    public = room.dh_public
+    assert public is not None and room.tree_secrets == [room.dh_secret]
+
+    await room.ensure_keys()
+    assert room.dh_public == public
@@ -0,0 +1,71 @@
+import pytest
+
+from pychat.common import models
+from pychat.common import request as req
+from pychat.server.rooms import ChatRoom, ChatRooms
+from pychat.server.users import User
+
+
+@pytest.fixture
+def exchanges(monkeypatch) -> list[str]:
+    """Record key exchanges instead of running them"""
+    started = []
+    monkeypatch.setattr(ChatRoom, 'do_key_exchange', lambda room: started.append(room.uid))
+    return started
+
+
+def test_purge_user_only_leaves_own_rooms(exchanges):
+    rooms = ChatRooms()
+    alice, bob = User(None), User(None)
+    shared, own = rooms.make_room('shared'), rooms.make_room('own')
+    rooms.join_rooms(alice, [shared.uid, own.uid])
+    rooms.join_rooms(bob, [shared.uid])
+    exchanges.clear()
+
+    rooms.purge_user(alice)
+
+    assert rooms.rooms_of(alice) == set()
+    assert alice not in rooms.memberships
+    assert shared.users == {bob}
+    assert own.uid not in rooms.rooms
+    # the empty room doesn't start an exchange
+    assert exchanges == [shared.uid]
+
+
+def test_index_follows_joins_and_leaves(exchanges):
+    rooms = ChatRooms()
+    alice = User(None)
+    a, b, c = (rooms.make_room(name) for name in 'abc')
+
+    rooms.join_rooms(alice, [a.uid, b.uid, c.uid])
+    rooms.join_rooms(alice, [a.uid])
+    rooms.leave_rooms(alice, [b.uid, 'unknown'])
+
+    assert rooms.rooms_of(alice) == {a.uid, c.uid}
+    assert all((alice in room.users) == (room.uid in rooms.rooms_of(alice))
+               for room in (a, c))
+    assert b.uid not in rooms.rooms
+
+
+@pytest.mark.asyncio
+async def test_messages_only_relayed_for_members(exchanges, monkeypatch):
+    sent = []
+
+    async def record(room, r):
+        sent.append(room.uid)
+
+    monkeypatch.setattr(ChatRoom, 'broadcast', record)
+    rooms = ChatRooms()
+    alice, bob = User(None), User(None)
+    room = rooms.make_room('room')
+    rooms.join_rooms(alice, [room.uid])
+
+    def post(room_uid: str) -> req.PostMessage:
+        user = models.User(name='name', uid='useruid')
+        return req.PostMessage(message=models.ChatMessage(user=user, text='hi', room_uid=room_uid))
+
+    await rooms.on_post_message(bob, post(room.uid))
+    await rooms.on_post_message(alice, post('unknown'))
+    await rooms.on_post_message(alice, post(room.uid))
+
+    assert sent == [room.uid]
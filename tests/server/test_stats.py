@@ -0,0 +1,104 @@
+import asyncio
+import json
+import socket
+
+import pytest, pytest_asyncio
+
+from pychat.client.rooms import ChatRooms
+from pychat.common.metrics import Histogram
+from pychat.common import models
+from pychat.common import request as req
+from pychat.common.stream import DataStream
+from pychat.server.server import PychatServer
+
+
+def test_histogram_percentiles():
+    h = Histogram()
+    for ms in range(1, 101):
+        h.observe(ms / 1000)
+    assert h.count == 100 and h.max == 0.1
+    # within a bucket (a factor of 2) of the real values
+    assert 0.05 <= h.percentile(50) < 0.1
+    assert 0.099 <= h.percentile(99) < 0.2
+
+    other = Histogram()
+    other.observe(1.0)
+    h.merge(other)
+    assert h.count == 101 and h.max == 1.0
+
+
+@pytest_asyncio.fixture
+async def serve():
+    """Return a function that connects a client to a PychatServer over a
+    socket pair, like conftest's connect"""
+    tasks: list[asyncio.Task] = []
+
+    async def serve(server: PychatServer) -> ChatRooms:
+        server_sock, client_sock = socket.socketpair()
+        r, w = await asyncio.open_connection(sock=server_sock)
+        tasks.append(asyncio.create_task(server._handle_user(r, w)))
+        client = ChatRooms(DataStream(*await asyncio.open_connection(sock=client_sock)))
+        tasks.append(asyncio.create_task(client.stream.listen()))
+        await client.stream.handshake()
+        return client
+
+    yield serve
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_server_stats(tmp_path, serve):
+    server = PychatServer(history_dir=str(tmp_path), remote_stats=True)
+    clients = [await serve(server) for _ in range(2)]
+
+    resp = await clients[0].stream.write(
+        req.CreateRoom(room_name='room'), on_response=lambda r: clients[0].add_room(r.room)
+    )
+    await clients[1].stream.write(
+        req.JoinRoom(invite_code=resp.invite_code),
+        on_response=lambda r: clients[1].add_room(r.room)
+    )
+    await server.rooms.rooms[resp.room.uid].key_agreement.settled()
+
+    user = models.User(name='name', uid='useruid')
+    for text in ('one', 'two'):
+        message = models.ChatMessage(user=user, text=text, room_uid=resp.room.uid)
+        await clients[0].stream.write(req.PostMessage(message=message))
+    while any(c.decryption.stats.messages < 2 for c in clients):
+        await asyncio.sleep(0.01)
+
+    r = await clients[1].stream.write(req.GetServerStats())
+    stats = r.stats
+    assert (stats['connections'], stats['rooms']) == (2, 1)
+    assert stats['streams']['by_type']['PostMessage']['frames_in'] == 2
+    assert stats['streams']['by_type']['PostMessage']['frames_out'] == 4
+    assert stats['streams']['by_type']['CreateRoom']['handler']['count'] == 1
+    assert stats['streams']['by_type']['GetDHKey']['round_trip']['count'] == 2
+    assert stats['broadcast_by_room'][resp.room.uid]['count'] == 2
+    assert stats['key_exchange']['count'] >= 1
+    # peers' addresses are only on the local socket
+    assert 'by_connection' not in stats
+    # the client counts its own side
+    assert clients[1].stream.metrics.of(req.GetServerStats).round_trip.count == 1
+    server.history.close()
+
+
+@pytest.mark.asyncio
+async def test_connection_stats_only_on_local_socket(tmp_path, serve):
+    stats_path = str(tmp_path / 'stats.sock')
+    server = PychatServer(stats_path=stats_path)
+    client = await serve(server)
+
+    r = await client.stream.write(req.GetServerStats())
+    assert r.error is not None
+
+    stats_server = await asyncio.start_unix_server(server._serve_stats, path=stats_path)
+    reader, writer = await asyncio.open_unix_connection(stats_path)
+    stats = json.loads(await reader.read())
+    assert stats['connections'] == 1 and len(stats['by_connection']) == 1
+    writer.close()
+    stats_server.close()
+    await stats_server.wait_closed()
@@ -0,0 +1,87 @@
+import pytest, pytest_asyncio
+import asyncio
+
+from pychat.client import events
+from pychat.client.rooms import ChatRooms
+from pychat.common import models
+from pychat.common import request as req
+from pychat.common.stream import DataStream
+from pychat.server.server import PychatServer
+from pychat.server.workers import make_worker, run_worker
+
+N_WORKERS = 2
+
+
+@pytest_asyncio.fixture
+async def workers(tmp_path) -> list[PychatServer]:
+    """Run N workers in this event loop, each on a free port"""
+    servers = [
+        make_worker(w, N_WORKERS, str(tmp_path), port=0, reuse_port=False)
+        for w in range(N_WORKERS)
+    ]
+    tasks = [asyncio.create_task(run_worker(server)) for server in servers]
+    await asyncio.wait_for(asyncio.gather(*(s.listening.wait() for s in servers)), 5)
+    yield servers
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def until(condition, timeout: float = 5.0):
+    """Wait for `condition()` to hold"""
+    async def check():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(check(), timeout)
+
+
+async def connect(port: int) -> ChatRooms:
+    stream = DataStream(*await asyncio.open_connection('127.0.0.1', port))
+    rooms = ChatRooms(stream)
+    asyncio.create_task(stream.listen())
+    await stream.handshake()
+    return rooms
+
+
+@pytest.mark.asyncio
+async def test_room_spans_workers(workers):
+    # a member on each worker, the room is on the first
+    ports = [server.port for server in workers]
+    clients = [await connect(port) for port in ports + ports[:1]]
+    received = []
+    sub = events.pubsub.subscribe(events.MessageReceived, lambda e: received.append(e.message.text))
+    try:
+        await clients[0].on_create_room(events.CreateRoom(room_name='room'))
+        room_uid, = clients[0].rooms
+        await until(lambda: received)  # the message with the invite code
+        invite = received[-1].rsplit(' ', 1)[-1]
+        for client in clients[1:]:
+            await client.on_join_room(events.JoinRoom(invite_code=invite))
+        await workers[0].rooms.rooms[room_uid].key_agreement.settled()
+
+        # the key exchange reached the member on the other worker
+        rooms = [c.rooms[room_uid] for c in clients]
+        await until(lambda: None not in [r.dh_fernet for r in rooms])
+        assert len({r.dh_fernet._signing_key for r in rooms}) == 1
+
+        received.clear()
+        message = models.ChatMessage(
+            user=models.User(name='name', uid='useruid'), text='across', room_uid=room_uid
+        )
+        await clients[1].on_send_message(events.SendMessage(message=message))
+        await until(lambda: received.count('across') == len(clients))
+
+        assert received == ['across'] * len(clients)
+    finally:
+        sub.unsubscribe()
+
+
+@pytest.mark.asyncio
+async def test_unknown_invite_code(workers):
+    client = await connect(workers[0].port)
+
+    resp = await client.stream.write(req.JoinRoom(invite_code='nope'))
+
+    assert resp.error is not None and resp.room is None
+    assert client.rooms == {}